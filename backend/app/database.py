@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import UniqueConstraint, and_, create_engine, func, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -8,16 +9,90 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
+def get_async_database_url(url: str) -> str:
+    # Use the asyncio driver for the same database: aiosqlite for SQLite, asyncpg for PostgreSQL
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:"):
+        return url.replace("postgresql:", "postgresql+asyncpg:", 1)
+    if url.startswith("postgres:"):
+        return url.replace("postgres:", "postgresql+asyncpg:", 1)
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or get_async_database_url(SQLALCHEMY_DATABASE_URL)
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+# Objects stay readable after commit, since async sessions cannot lazy-load expired attributes
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
+def add_columns(bind):
+    # create_all() skips tables that already exist, so add columns introduced later; they
+    # are all nullable, so existing rows need no value
+    inspector = inspect(bind)
+    preparer = bind.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            with bind.begin() as connection:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+                    f"{column.type.compile(dialect=bind.dialect)}"
+                )
+
+def create_indexes(bind):
+    # create_all() skips tables that already exist, so add indexes and unique constraints
+    # introduced later
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint) and constraint.name:
+                add_unique_constraint(bind, inspector, constraint)
+
+def add_unique_constraint(bind, inspector, constraint: UniqueConstraint):
+    # A unique index enforces the same thing and, unlike the constraint, can be added
+    # to an existing SQLite table
+    table = constraint.table
+    columns = [column.name for column in constraint.columns]
+    existing = [unique["column_names"] for unique in inspector.get_unique_constraints(table.name)]
+    existing += [index["column_names"] for index in inspector.get_indexes(table.name) if index["unique"]]
+    if columns in existing:
+        return
+
+    key = [table.c[name] for name in columns]
+    preparer = bind.dialect.identifier_preparer
+    with bind.begin() as connection:
+        # Older databases may hold duplicates the index would refuse: keep one row of each
+        duplicates = connection.execute(select(*key).group_by(*key).having(func.count() > 1)).all()
+        for duplicate in duplicates:
+            where = and_(*(column == value for column, value in zip(key, duplicate)))
+            row = connection.execute(table.select().where(where).limit(1)).mappings().first()
+            connection.execute(table.delete().where(where))
+            connection.execute(table.insert().values(**row))
+        connection.exec_driver_sql(
+            f"CREATE UNIQUE INDEX {preparer.quote(constraint.name)} ON {preparer.format_table(table)} "
+            f"({', '.join(preparer.quote(name) for name in columns)})"
+        )
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,10 +1,19 @@
-from fastapi import FastAPI, WebSocket, Depends, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket
+from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
 from . import models
-from .database import engine, get_db
-from .routes import auth, users, servers, channels, messages
+from .database import async_engine, engine, add_columns, create_indexes
+from .routes import auth, users, servers, channels, messages, bootstrap, metrics, admin
 from .sockets.chat import handle_chat_connection, handle_voice_connection
+from .sockets.connection_manager import manager
+from .sockets.gateway import handle_gateway_connection
+from .sockets.persistence import message_writer
+from .utils.archive import message_archive
+from .utils.codecs import FastJSONResponse
+from .utils.metrics import METRICS_DB_TIMING, RouteContextMiddleware, instrument_database, loop_monitor
+from .utils.passwords import password_hasher
+from .utils.search import search_index
+from .utils.tracing import TracingMiddleware, instrument_database as trace_database, tracer
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -13,6 +22,17 @@ import logging
 
 # Create tables
 models.Base.metadata.create_all(bind=engine)
+add_columns(engine)
+create_indexes(engine)
+search_index.create(engine)
+
+# Time database statements and commits for /metrics
+if METRICS_DB_TIMING:
+    instrument_database(engine, async_engine.sync_engine)
+
+# Spans for database statements and commits, when tracing is on
+if tracer.enabled:
+    trace_database(engine, async_engine.sync_engine)
 
 # Setup rate limiting
 limiter = Limiter(key_func=get_remote_address)
@@ -21,7 +41,8 @@ limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(
     title="AnkaChat API",
     description="API for AnkaChat - Türkiye'nin Açık Kaynak Sohbet Uygulaması",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse
 )
 
 # Register rate limiter
@@ -42,14 +63,40 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+# Lets database timings know which route they belong to
+app.add_middleware(RouteContextMiddleware)
+
+# One trace per request, when tracing is on
+app.add_middleware(TracingMiddleware)
+
 # Include API routes
 app.include_router(auth.router)
 app.include_router(users.router)
 app.include_router(servers.router)
 app.include_router(channels.router)
 app.include_router(messages.router)
+app.include_router(bootstrap.router)
+app.include_router(metrics.router)
+app.include_router(admin.router)
+
+@app.on_event("startup")
+async def start_background_services():
+    message_writer.start()
+    await manager.start()
+    message_archive.start()
+    loop_monitor.start()
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    await loop_monitor.stop()
+    await message_writer.stop()
+    await manager.stop()
+    await message_archive.stop()
+    password_hasher.shutdown()
+    tracer.shutdown()
 
 # WebSocket endpoints
 @app.websocket("/ws/chat/{channel_id}")
@@ -57,26 +104,42 @@ async def websocket_chat_endpoint(
     websocket: WebSocket, 
     channel_id: int, 
     token: str = None,
-    db: Session = Depends(get_db)
+    binary: bool = False,
+    since: Optional[int] = None,
+    coalesce_ms: int = 0
 ):
     if not token:
         await websocket.close(code=4001)  # Unauthorized
         return
     
-    await handle_chat_connection(websocket, channel_id, token, db)
+    await handle_chat_connection(websocket, channel_id, token, binary, since, coalesce_ms)
 
 @app.websocket("/ws/voice/{channel_id}")
 async def websocket_voice_endpoint(
     websocket: WebSocket, 
     channel_id: int, 
     token: str = None,
-    db: Session = Depends(get_db)
+    binary: bool = False,
+    coalesce_ms: int = 0
+):
+    if not token:
+        await websocket.close(code=4001)  # Unauthorized
+        return
+    
+    await handle_voice_connection(websocket, channel_id, token, binary, coalesce_ms)
+
+@app.websocket("/ws/gateway")
+async def websocket_gateway_endpoint(
+    websocket: WebSocket, 
+    token: str = None,
+    binary: bool = False,
+    coalesce_ms: int = 0
 ):
     if not token:
         await websocket.close(code=4001)  # Unauthorized
         return
     
-    await handle_voice_connection(websocket, channel_id, token, db)
+    await handle_gateway_connection(websocket, token, binary, coalesce_ms)
 
 @app.get("/")
 async def root():
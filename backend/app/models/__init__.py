@@ -3,4 +3,4 @@ from ..database import Base
 from .user import User
 from .server import Server, server_members
 from .channel import Channel, ChannelType
-from .message import Message
+from .message import Message, MessageOverlay
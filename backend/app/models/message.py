@@ -1,10 +1,18 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import BigInteger, Boolean, Column, Integer, String, ForeignKey, DateTime, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..database import Base
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Channel history is read newest first by id (keyset pagination)
+        Index("ix_messages_channel_id_id", "channel_id", "id"),
+        # Messages a resuming client missed, by the sequence numbers it saw
+        Index("ix_messages_channel_id_seq", "channel_id", "seq"),
+        # Ids are never handed out twice, even once every message has moved to the archive
+        {"sqlite_autoincrement": True},
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     content = Column(Text)
@@ -12,7 +20,24 @@ class Message(Base):
     channel_id = Column(Integer, ForeignKey("channels.id"))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # The broker's sequence number for the chat_message event, stored once it is published
+    seq = Column(BigInteger, nullable=True)
 
     # Relationships
     user = relationship("User")
     channel = relationship("Channel", back_populates="messages")
+
+class MessageOverlay(Base):
+    """Edits and deletions of messages that have moved to the archive.
+
+    Archive segments are append-only, so a change to an archived message is
+    recorded here and applied on top of the archived copy when it is read.
+    """
+    __tablename__ = "message_overlays"
+
+    message_id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, index=True)
+    content = Column(Text, nullable=True)
+    # A tombstone: the message was deleted after it was archived
+    deleted = Column(Boolean, default=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
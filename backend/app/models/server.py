@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Table
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Table, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..database import Base
@@ -8,7 +8,9 @@ server_members = Table(
     "server_members",
     Base.metadata,
     Column("user_id", Integer, ForeignKey("users.id")),
-    Column("server_id", Integer, ForeignKey("servers.id"))
+    Column("server_id", Integer, ForeignKey("servers.id")),
+    # Keeps a user from joining twice, and backs the membership EXISTS lookup
+    UniqueConstraint("server_id", "user_id", name="uq_server_members_server_id_user_id")
 )
 
 class Server(Base):
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from typing import Optional
+from dotenv import load_dotenv
+from datetime import datetime
+import asyncio
+import hmac
+import os
+from ..utils.profiler import PROFILER_INTERVAL_MS, PROFILER_MAX_SECONDS, ProfilerBusy, collapsed, profiler
+from ..utils.tracing import MemoryExporter, tracer
+
+load_dotenv()
+
+# Bearer token for the operator endpoints; they are disabled when it is not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    # Check if the admin endpoints are enabled at all
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    # Check if the caller has the admin token
+    if not hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(require_admin)],
+    include_in_schema=False
+)
+
+@router.post("/profile")
+async def profile(
+    seconds: float = Query(10, gt=0, le=PROFILER_MAX_SECONDS),
+    interval_ms: float = Query(PROFILER_INTERVAL_MS, ge=1, le=1000)
+):
+    # Sample in a thread of its own: the event loop keeps serving, and shows up in the profile doing so
+    loop = asyncio.get_running_loop()
+    try:
+        counts = await loop.run_in_executor(None, profiler.profile, seconds, interval_ms / 1000)
+    except ProfilerBusy:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A profile is already running"
+        )
+
+    name = f"profile-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.folded"
+    return Response(
+        collapsed(counts),
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="{name}"'}
+    )
+
+@router.get("/traces")
+async def get_traces(
+    limit: int = Query(100, ge=1, le=10000),
+    trace_id: Optional[str] = None,
+    min_ms: float = Query(0, ge=0)
+):
+    # Check if spans are kept in memory
+    exporter = tracer.exporter(MemoryExporter)
+    if exporter is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="The memory span exporter is not enabled (TRACING_EXPORTERS)"
+        )
+
+    return {
+        "spans": exporter.recent(limit, trace_id, min_ms),
+        "sample_rate": tracer.sample_rate
+    }
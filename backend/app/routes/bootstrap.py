@@ -0,0 +1,104 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+from ..database import get_async_db
+from ..schemas.bootstrap import BootstrapResponse
+from ..models import Server, server_members
+from ..schemas.auth import Principal
+from ..sockets.connection_manager import manager
+from ..utils.auth import get_current_active_user
+from ..utils.membership import membership
+from .messages import next_cursor, read_history
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for voice participants from the broker before answering without them
+BOOTSTRAP_PRESENCE_TIMEOUT = float(os.getenv("BOOTSTRAP_PRESENCE_TIMEOUT", "1.0"))
+
+router = APIRouter(tags=["bootstrap"])
+
+async def voice_participants(channel_ids: List[int]) -> Dict[int, List[dict]]:
+    if not channel_ids:
+        return {}
+    try:
+        users = await asyncio.wait_for(
+            asyncio.gather(*(manager.broker.presence_users(channel_id) for channel_id in channel_ids)),
+            BOOTSTRAP_PRESENCE_TIMEOUT
+        )
+    except (asyncio.TimeoutError, ConnectionError):
+        logger.warning("Voice participants unavailable for bootstrap")
+        return {}
+    return dict(zip(channel_ids, users))
+
+@router.get("/bootstrap", response_model=BootstrapResponse)
+async def bootstrap(
+    channel_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    # The user's servers with all of their channels, in two queries however many there are
+    servers = (await db.execute(
+        select(Server)
+        .join(server_members, server_members.c.server_id == Server.id)
+        .where(server_members.c.user_id == current_user.id)
+        .options(selectinload(Server.channels))
+        .order_by(Server.id)
+    )).scalars().all()
+    channels = {channel.id: channel for server in servers for channel in server.channels}
+    
+    messages = []
+    if channel_id is not None:
+        # Membership is already known from the servers loaded above
+        channel = channels.get(channel_id)
+        if channel is None:
+            # Check if channel exists
+            if await membership.channel_server(db, channel_id) is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Channel with ID {channel_id} not found"
+                )
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You are not a member of this server"
+            )
+        if channel.type == "text":
+            messages = await read_history(db, channel_id, limit)
+    
+    participants = await voice_participants([channel.id for channel in channels.values() if channel.type == "voice"])
+    
+    return {
+        "user": current_user,
+        "servers": [
+            {
+                "id": server.id,
+                "name": server.name,
+                "description": server.description,
+                "owner_id": server.owner_id,
+                "created_at": server.created_at,
+                "channels": [
+                    {
+                        "id": channel.id,
+                        "name": channel.name,
+                        "type": channel.type,
+                        "server_id": channel.server_id,
+                        "created_at": channel.created_at,
+                        "participants": participants.get(channel.id, [])
+                    }
+                    for channel in sorted(server.channels, key=lambda channel: channel.id)
+                ]
+            }
+            for server in servers
+        ],
+        "channel_id": channel_id,
+        "messages": messages,
+        "next_cursor": next_cursor(messages, limit)
+    }
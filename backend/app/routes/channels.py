@@ -1,36 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from ..database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import List, Optional
+from ..database import get_async_db
 from ..schemas.channel import ChannelCreate, ChannelResponse, ChannelUpdate
-from ..models import Channel, Server, User
+from ..models import Channel, MessageOverlay
+from ..schemas.auth import Principal
+from ..utils.archive import message_archive
 from ..utils.auth import get_current_active_user
+from ..utils.export import ExportFilter, export_response
+from ..utils.history_cache import history_cache
+from ..utils.membership import membership
+from ..utils.response_cache import response_cache
+from ..utils.search import search_index
 
 router = APIRouter(prefix="/channels", tags=["channels"])
 
 @router.post("/", response_model=ChannelResponse, status_code=status.HTTP_201_CREATED)
-def create_channel(
+async def create_channel(
     channel_data: ChannelCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if server exists
-    server = db.query(Server).filter(Server.id == channel_data.server_id).first()
-    if not server:
+    owner_id = await membership.server_owner(db, channel_data.server_id)
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Server with ID {channel_data.server_id} not found"
         )
     
     # Check if user is a member of the server
-    if current_user not in server.members:
+    if not await membership.is_member(db, channel_data.server_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this server"
         )
     
     # Only server owner can create channels
-    if server.owner_id != current_user.id:
+    if owner_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only the server owner can create channels"
@@ -44,45 +53,52 @@ def create_channel(
     )
     
     db.add(db_channel)
-    db.commit()
-    db.refresh(db_channel)
+    await db.commit()
+    await db.refresh(db_channel)
+    response_cache.channels_changed(db_channel.server_id)
     
     return db_channel
 
 @router.get("/server/{server_id}", response_model=List[ChannelResponse])
-def get_channels_by_server(
+async def get_channels_by_server(
     server_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if server exists
-    server = db.query(Server).filter(Server.id == server_id).first()
-    if not server:
+    if await membership.server_owner(db, server_id) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Server with ID {server_id} not found"
         )
     
     # Check if user is a member of the server
-    if current_user not in server.members:
+    if not await membership.is_member(db, server_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this server"
         )
     
-    # Get all channels in the server
-    channels = db.query(Channel).filter(Channel.server_id == server_id).all()
+    # Get all channels in the server, unless they are cached at their current version
+    cached = response_cache.get("channels", server_id)
+    if cached is None:
+        version = response_cache.version("channels", server_id)
+        channels = (await db.execute(select(Channel).where(Channel.server_id == server_id))).scalars().all()
+        cached = response_cache.put(
+            "channels", server_id, version, [ChannelResponse.model_validate(channel) for channel in channels]
+        )
     
-    return channels
+    return response_cache.respond(request, cached)
 
 @router.get("/{channel_id}", response_model=ChannelResponse)
-def get_channel(
+async def get_channel(
     channel_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == channel_id).first()
+    channel = await db.get(Channel, channel_id)
     if not channel:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -90,8 +106,7 @@ def get_channel(
         )
     
     # Check if user is a member of the server
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if current_user not in server.members:
+    if not await membership.is_member(db, channel.server_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this server"
@@ -99,15 +114,46 @@ def get_channel(
     
     return channel
 
+@router.get("/{channel_id}/export")
+async def export_channel(
+    channel_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    gzip: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    # Check if channel exists
+    server_id = await membership.channel_server(db, channel_id)
+    if server_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel with ID {channel_id} not found"
+        )
+    
+    # Check if user is a member of the server
+    if not await membership.is_member(db, server_id, current_user.id):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not a member of this server"
+        )
+    
+    # Stream the channel's history as NDJSON, oldest first; resume with after_id=<last id received>
+    return export_response(
+        [channel_id], ExportFilter(after_id, before_id, since, until), f"channel-{channel_id}", gzip
+    )
+
 @router.put("/{channel_id}", response_model=ChannelResponse)
-def update_channel(
+async def update_channel(
     channel_id: int,
     channel_update: ChannelUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == channel_id).first()
+    channel = await db.get(Channel, channel_id)
     if not channel:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -115,8 +161,7 @@ def update_channel(
         )
     
     # Check if user is the server owner
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if server.owner_id != current_user.id:
+    if await membership.server_owner(db, channel.server_id) != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only the server owner can update channels"
@@ -126,19 +171,20 @@ def update_channel(
     if channel_update.name:
         channel.name = channel_update.name
     
-    db.commit()
-    db.refresh(channel)
+    await db.commit()
+    await db.refresh(channel)
+    response_cache.channels_changed(channel.server_id)
     
     return channel
 
 @router.delete("/{channel_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_channel(
+async def delete_channel(
     channel_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == channel_id).first()
+    channel = await db.get(Channel, channel_id)
     if not channel:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -146,15 +192,20 @@ def delete_channel(
         )
     
     # Check if user is the server owner
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if server.owner_id != current_user.id:
+    if await membership.server_owner(db, channel.server_id) != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only the server owner can delete channels"
         )
     
     # Delete channel
-    db.delete(channel)
-    db.commit()
+    await search_index.remove_channels(db, [channel_id])
+    await db.execute(delete(MessageOverlay).where(MessageOverlay.channel_id == channel_id))
+    await db.delete(channel)
+    await db.commit()
+    membership.channel_deleted(channel_id)
+    response_cache.channels_changed(channel.server_id)
+    history_cache.drop(channel_id)
+    message_archive.drop_channels([channel_id])
     
     return
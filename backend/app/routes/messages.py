@@ -1,22 +1,41 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from ..database import get_db
-from ..schemas.message import MessageCreate, MessageResponse, MessageUpdate, MessageWithUserResponse
-from ..models import Message, Channel, Server, User
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from ..database import get_async_db
+from ..schemas.message import (
+    MessageBatchResponse, MessageCreate, MessageResponse, MessageSearchResult, MessageUpdate, MessageWithUserResponse
+)
+from ..models import Message, Channel, User, server_members
+from ..schemas.auth import Principal
+from ..utils.archive import ArchivedMessage, message_archive
 from ..utils.auth import get_current_active_user
-from sqlalchemy import desc
+from ..utils.batch import id_list
+from ..utils.codecs import FastJSONResponse
+from ..utils.history_cache import history_cache
+from ..utils.membership import membership
+from ..utils.search import render_snippet, search_index
+from sqlalchemy import desc, func, select
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
+def message_to_dict(message: Message, username: str) -> dict:
+    return {
+        "id": message.id,
+        "content": message.content,
+        "user_id": message.user_id,
+        "channel_id": message.channel_id,
+        "created_at": message.created_at,
+        "username": username
+    }
+
 @router.post("/", response_model=MessageResponse, status_code=status.HTTP_201_CREATED)
-def create_message(
+async def create_message(
     message_data: MessageCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == message_data.channel_id).first()
+    channel = await db.get(Channel, message_data.channel_id)
     if not channel:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -24,8 +43,7 @@ def create_message(
         )
     
     # Check if user is a member of the server
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if current_user not in server.members:
+    if not await membership.is_member(db, channel.server_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this server"
@@ -46,65 +64,279 @@ def create_message(
     )
     
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.flush()
+    await search_index.add(db, [db_message])
+    await db.commit()
+    await db.refresh(db_message)
+    history_cache.add(db_message.channel_id, message_to_dict(db_message, current_user.username))
     
     return db_message
 
-@router.get("/channel/{channel_id}", response_model=List[MessageWithUserResponse])
-def get_messages_by_channel(
+@router.get("/", response_model=MessageBatchResponse)
+async def get_messages(
+    ids: List[int] = Depends(id_list),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    # Look up the messages in one query, then the archive for the rest
+    rows = (await db.execute(
+        select(Message, User.username).join(User, Message.user_id == User.id).where(Message.id.in_(ids))
+    )).all()
+    found = {message.id: message_to_dict(message, username) for message, username in rows}
+    archived = await message_archive.get_many(db, [message_id for message_id in ids if message_id not in found])
+    if archived:
+        user_ids = {message.user_id for message in archived.values()}
+        usernames = dict((await db.execute(select(User.id, User.username).where(User.id.in_(user_ids)))).all())
+        for message in archived.values():
+            found[message.id] = message_to_dict(message, usernames.get(message.user_id))
+    
+    # Check which of the messages' channels the user can read, in one query
+    channel_ids = {message["channel_id"] for message in found.values()}
+    readable = set((await db.execute(
+        select(Channel.id)
+        .join(server_members, server_members.c.server_id == Channel.server_id)
+        .where(Channel.id.in_(channel_ids), server_members.c.user_id == current_user.id)
+    )).scalars()) if channel_ids else set()
+    
+    result = {"messages": [], "not_found": [], "forbidden": []}
+    for message_id in ids:
+        message = found.get(message_id)
+        if message is None:
+            result["not_found"].append(message_id)
+        elif message["channel_id"] not in readable:
+            result["forbidden"].append(message_id)
+        else:
+            result["messages"].append(message)
+    
+    return result
+
+@router.get("/search", response_model=List[MessageSearchResult])
+async def search_messages(
+    q: str,
+    response: Response,
+    server_id: Optional[int] = None,
+    channel_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(25, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    # Check if search is available
+    if not search_index.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Message search is not available"
+        )
+    
+    channel_ids, server_ids = None, None
+    if channel_id is not None:
+        # Check if channel exists
+        channel_server_id = await membership.channel_server(db, channel_id)
+        if channel_server_id is None or (server_id is not None and channel_server_id != server_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Channel with ID {channel_id} not found"
+            )
+        server_id = channel_server_id
+        channel_ids = [channel_id]
+    elif server_id is not None:
+        # Check if server exists
+        if await membership.server_owner(db, server_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Server with ID {server_id} not found"
+            )
+        server_ids = [server_id]
+    else:
+        # Every server the user is a member of
+        server_ids = (await db.execute(
+            select(server_members.c.server_id).where(server_members.c.user_id == current_user.id)
+        )).scalars().all()
+    
+    # Check if user is a member of the server
+    if server_id is not None and not await membership.is_member(db, server_id, current_user.id):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not a member of this server"
+        )
+    
+    parsed = search_index.parse(q)
+    if parsed is None:
+        return []
+    
+    rows = await search_index.search(db, parsed, channel_ids, server_ids, before_id, limit)
+    
+    # Matches that have moved to the archive since they were indexed
+    archived = await message_archive.get_many(db, [message_id for message_id, message, _, _ in rows if message is None])
+    usernames, snippets = {}, {}
+    if archived:
+        user_ids = {message.user_id for message in archived.values()}
+        usernames = dict((await db.execute(select(User.id, User.username).where(User.id.in_(user_ids)))).all())
+        snippets = await search_index.snippets(db, parsed, {
+            message_id: archived[message_id].content
+            for message_id, message, _, snippet in rows if message is None and snippet is None and message_id in archived
+        })
+    
+    result = []
+    for message_id, message, username, snippet in rows:
+        if message is None:
+            message = archived.get(message_id)
+            if message is None:
+                continue
+            username = usernames.get(message.user_id)
+            snippet = snippet if snippet is not None else snippets[message_id]
+        result.append({**message_to_dict(message, username), "snippet": render_snippet(snippet)})
+    
+    # A full page may have more behind it: hand out the cursor for the next one
+    cursor = next_cursor(result, limit)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+    
+    return result
+
+def next_cursor(result: List[dict], limit: int, forward: bool = False) -> Optional[str]:
+    if result and len(result) == limit:
+        return f"after_id={result[0]['id']}" if forward else f"before_id={result[-1]['id']}"
+    return None
+
+async def read_history(
+    db: AsyncSession,
     channel_id: int,
     limit: int = 50,
     offset: int = 0,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None
+) -> List[dict]:
+    """A page of a channel's history, newest first, from the cache, the messages table and the archive.
+
+    The caller has checked that the user may read the channel.
+    """
+    first_page = before_id is None and after_id is None and offset == 0
+    if first_page:
+        # Serve the newest page of a hot channel from its ring buffer
+        cached = history_cache.latest(channel_id, limit)
+        if cached is not None:
+            return cached
+    
+    if not first_page or limit > history_cache.capacity:
+        return await load_history(db, channel_id, limit, offset, before_id, after_id)
+    
+    # Read a whole buffer's worth once so later first pages skip the database
+    seed_token = history_cache.begin_seed(channel_id)
+    try:
+        result = await load_history(db, channel_id, history_cache.capacity)
+    except BaseException:
+        # The next read seeds the channel instead
+        history_cache.abort_seed(channel_id)
+        raise
+    history_cache.seed(channel_id, result, seed_token)
+    return result[:limit]
+
+async def load_history(
+    db: AsyncSession,
+    channel_id: int,
+    limit: int,
+    offset: int = 0,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None
+) -> List[dict]:
+    """read_history() without the cache: the messages table, then the archive."""
+    query = select(Message, User.username).join(User, Message.user_id == User.id) \
+        .where(Message.channel_id == channel_id)
+    
+    # Messages up to the watermark have moved to the archive
+    watermark = message_archive.current_watermark()
+    if watermark:
+        query = query.where(Message.id > watermark)
+    
+    forward = after_id is not None and before_id is None
+    archived = []
+    if before_id is not None or after_id is not None:
+        # Cursor pagination: seek on the (channel_id, id) index instead of skipping rows
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        if after_id is not None:
+            query = query.where(Message.id > after_id)
+        if forward:
+            # Walk forward from the cursor, then return the page newest first like the others
+            if after_id < watermark:
+                # The walk starts in the archive
+                archived = await message_archive.page(db, channel_id, limit, after_id=after_id)
+            messages = []
+            if len(archived) < limit:
+                messages = (await db.execute(query.order_by(Message.id).limit(limit - len(archived)))).all()
+            messages.reverse()
+        else:
+            messages = (await db.execute(query.order_by(desc(Message.id)).limit(limit))).all()
+    else:
+        # Get messages from channel, newest first
+        messages = (await db.execute(query.order_by(desc(Message.id)).limit(limit).offset(offset))).all()
+    
+    # Convert to response model format
+    result = [message_to_dict(message, username) for message, username in messages]
+    
+    if watermark and not forward and len(result) < limit:
+        # The messages table ran out: continue with older messages from the archive
+        archive_offset = 0
+        if offset and not result:
+            # The offset reaches past the messages table; skip what it holds
+            hot_count = (await db.execute(
+                select(func.count()).select_from(Message).where(Message.channel_id == channel_id, Message.id > watermark)
+            )).scalar()
+            archive_offset = max(0, offset - hot_count)
+        # Clamped rather than dropped: with after_id alone the archive would walk forward
+        archived = await message_archive.page(
+            db, channel_id, limit - len(result),
+            before_id=min(before_id, watermark + 1) if before_id is not None else None,
+            after_id=after_id,
+            offset=archive_offset
+        )
+    result += archived
+    return result
+
+@router.get("/channel/{channel_id}", response_model=List[MessageWithUserResponse])
+async def get_messages_by_channel(
+    channel_id: int,
+    limit: int = Query(50, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == channel_id).first()
-    if not channel:
+    server_id = await membership.channel_server(db, channel_id)
+    if server_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Channel with ID {channel_id} not found"
         )
     
     # Check if user is a member of the server
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if current_user not in server.members:
+    if not await membership.is_member(db, server_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this server"
         )
     
-    # Get messages from channel, newest first
-    messages = db.query(Message, User.username).join(User, Message.user_id == User.id) \
-        .filter(Message.channel_id == channel_id) \
-        .order_by(desc(Message.created_at)) \
-        .limit(limit).offset(offset).all()
+    result = await read_history(db, channel_id, limit, offset, before_id, after_id)
     
-    # Convert to response model format
-    result = []
-    for message, username in messages:
-        message_dict = {
-            "id": message.id,
-            "content": message.content,
-            "user_id": message.user_id,
-            "channel_id": message.channel_id,
-            "created_at": message.created_at,
-            "username": username
-        }
-        result.append(message_dict)
+    # A full page may have more behind it: hand out the cursor for the next one
+    cursor = next_cursor(result, limit, after_id is not None and before_id is None)
+    headers = {"X-Next-Cursor": cursor} if cursor else None
     
-    return result
+    # Built from our own rows, already in the response shape: encode without re-validating
+    return FastJSONResponse(result, headers=headers)
 
 @router.put("/{message_id}", response_model=MessageResponse)
-def update_message(
+async def update_message(
     message_id: int,
     message_update: MessageUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    # Check if message exists
-    message = db.query(Message).filter(Message.id == message_id).first()
+    # Check if message exists, in the messages table or the archive
+    message = await db.get(Message, message_id) or await message_archive.get(db, message_id)
     if not message:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -119,41 +351,58 @@ def update_message(
         )
     
     # Update message
+    archived = isinstance(message, ArchivedMessage)
     if message_update.content:
         message.content = message_update.content
+        if archived:
+            await message_archive.edit(db, message)
+        # The search index keeps archived messages too
+        await search_index.update(db, message)
     
-    db.commit()
-    db.refresh(message)
+    await db.commit()
+    if archived:
+        message_archive.overlays_changed(message.channel_id)
+    else:
+        await db.refresh(message)
+    history_cache.update(message.channel_id, message.id, message.content)
     
     return message
 
 @router.delete("/{message_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_message(
+async def delete_message(
     message_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    # Check if message exists
-    message = db.query(Message).filter(Message.id == message_id).first()
+    # Check if message exists, in the messages table or the archive
+    message = await db.get(Message, message_id) or await message_archive.get(db, message_id)
     if not message:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Message with ID {message_id} not found"
         )
     
-    # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == message.channel_id).first()
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
+    # Look up the owner of the message's server
+    server_id = await membership.channel_server(db, message.channel_id)
+    owner_id = await membership.server_owner(db, server_id)
     
     # Check if user is the author of the message or the server owner
-    if message.user_id != current_user.id and server.owner_id != current_user.id:
+    if message.user_id != current_user.id and owner_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You can only delete your own messages or as the server owner"
         )
     
-    # Delete message
-    db.delete(message)
-    db.commit()
+    # Delete message; archived ones get a tombstone
+    archived = isinstance(message, ArchivedMessage)
+    if archived:
+        await message_archive.delete(db, message)
+    else:
+        await db.delete(message)
+    await search_index.remove(db, [message_id])
+    await db.commit()
+    if archived:
+        message_archive.overlays_changed(message.channel_id)
+    history_cache.remove(message.channel_id, message_id)
     
     return
@@ -0,0 +1,130 @@
+from fastapi import APIRouter, Header, HTTPException, Response, status
+from typing import Optional
+from dotenv import load_dotenv
+import hmac
+import os
+from ..sockets.connection_manager import manager
+from ..sockets.persistence import message_writer
+from ..utils.archive import message_archive
+from ..utils.auth import principal_cache
+from ..utils.history_cache import history_cache
+from ..utils.membership import membership
+from ..utils.metrics import metrics
+from ..utils.passwords import password_hasher
+from ..utils.response_cache import response_cache
+from ..utils.search import search_index
+
+load_dotenv()
+
+# Bearer token scrapers must send; /metrics is open when it is not set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+router = APIRouter(tags=["metrics"])
+
+# Read from the components' own counters at scrape time: nothing is recorded on their hot paths
+caches = {
+    "auth": principal_cache,
+    "membership": membership,
+    "response": response_cache,
+    "history": history_cache,
+}
+metrics.counter(
+    "ankachat_cache_hits_total", "Lookups answered from an in-memory cache", ["cache"],
+    function=lambda: {name: cache.stats["hits"] for name, cache in caches.items()}
+)
+metrics.counter(
+    "ankachat_cache_misses_total", "Lookups an in-memory cache could not answer", ["cache"],
+    function=lambda: {name: cache.stats["misses"] for name, cache in caches.items()}
+)
+
+metrics.gauge(
+    "ankachat_ws_connections", "Open WebSocket connections", ["kind", "encoding"],
+    function=manager.connection_counts
+)
+metrics.gauge(
+    "ankachat_ws_channels", "Channels with sockets on this worker",
+    function=lambda: len(manager.active_connections)
+)
+metrics.gauge(
+    "ankachat_ws_queued_frames", "Frames waiting in outbound socket queues",
+    function=lambda: manager.queue_totals()["frames"]
+)
+metrics.gauge(
+    "ankachat_ws_queued_bytes", "Bytes waiting in outbound socket queues",
+    function=lambda: manager.queue_totals()["bytes"]
+)
+metrics.gauge(
+    "ankachat_ws_queue_depth_max", "Frames waiting in the deepest outbound socket queue",
+    function=lambda: manager.queue_totals()["max"]
+)
+metrics.counter(
+    "ankachat_ws_dropped_messages_total", "Events dropped for slow consumers",
+    function=lambda: manager.stats["dropped_messages"]
+)
+metrics.counter(
+    "ankachat_ws_slow_disconnects_total", "Sockets closed for not keeping up",
+    function=lambda: manager.stats["slow_disconnects"]
+)
+metrics.counter(
+    "ankachat_presence_diffs_total", "Presence updates sent out",
+    function=lambda: manager.presence.stats["diffs"]
+)
+
+metrics.counter(
+    "ankachat_messages_persisted_total", "Chat messages written by the message writer",
+    function=lambda: message_writer.stats["messages"]
+)
+metrics.counter(
+    "ankachat_persist_batches_total", "Batches committed by the message writer",
+    function=lambda: message_writer.stats["batches"]
+)
+metrics.counter(
+    "ankachat_persist_errors_total", "Batches the message writer failed to commit",
+    function=lambda: message_writer.stats["errors"]
+)
+metrics.counter(
+    "ankachat_persist_failed_messages_total", "Chat messages that failed on their own after a batch failed",
+    function=lambda: message_writer.stats["failed"]
+)
+metrics.counter(
+    "ankachat_persist_rejected_total", "Chat messages refused because the write queue stayed full",
+    function=lambda: message_writer.stats["rejected"]
+)
+metrics.gauge(
+    "ankachat_persist_queue_depth", "Chat messages waiting to be written",
+    function=lambda: message_writer.queue_depth
+)
+
+metrics.counter(
+    "ankachat_password_operations_total", "Password hashes and verifications", ["operation"],
+    function=lambda: {"hash": password_hasher.stats["hashes"], "verify": password_hasher.stats["verifications"]}
+)
+metrics.counter(
+    "ankachat_password_rejected_total", "Password operations turned away with 503",
+    function=lambda: password_hasher.stats["rejected"]
+)
+metrics.gauge(
+    "ankachat_password_in_flight", "Password operations running or queued",
+    function=lambda: password_hasher.in_flight
+)
+
+metrics.counter(
+    "ankachat_searches_total", "Message searches run",
+    function=lambda: search_index.stats["searches"]
+)
+metrics.counter(
+    "ankachat_archived_messages_total", "Messages moved to the archive by this worker",
+    function=lambda: message_archive.stats["archived"]
+)
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    # Check if the scraper is allowed in
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -1,10 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from ..database import get_db
-from ..schemas.server import ServerCreate, ServerResponse, ServerUpdate, ServerWithMembersResponse
-from ..models import Server, User, server_members
+from ..schemas.server import (
+    ServerCreate, ServerMembersAdd, ServerMembersAddResult, ServerResponse, ServerUpdate, ServerWithMembersResponse
+)
+from ..models import Channel, MessageOverlay, Server, User, server_members
+from ..schemas.auth import Principal
+from ..utils.archive import message_archive
 from ..utils.auth import get_current_active_user
+from ..utils.batch import BATCH_MAX_MEMBERS, unique_ids
+from ..utils.export import ExportFilter, export_response
+from ..utils.history_cache import history_cache
+from ..utils.membership import membership
+from ..utils.response_cache import response_cache
+from ..utils.search import search_index
 
 router = APIRouter(prefix="/servers", tags=["servers"])
 
@@ -12,7 +25,7 @@ router = APIRouter(prefix="/servers", tags=["servers"])
 def create_server(
     server_data: ServerCreate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Create new server
     db_server = Server(
@@ -26,26 +39,75 @@ def create_server(
     db.refresh(db_server)
     
     # Add owner as a member
-    db_server.members.append(current_user)
+    db.execute(server_members.insert().values(server_id=db_server.id, user_id=current_user.id))
     db.commit()
+    membership.server_created(db_server.id, current_user.id)
     
     return db_server
 
 @router.get("/", response_model=List[ServerResponse])
 def get_servers(
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Get all servers that the user is a member of
-    return current_user.servers
+    return db.query(Server).join(server_members, server_members.c.server_id == Server.id) \
+        .filter(server_members.c.user_id == current_user.id).all()
 
 @router.get("/{server_id}", response_model=ServerWithMembersResponse)
 def get_server(
     server_id: int,
+    request: Request,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    # Check if server exists and user is a member
+    # A cached body means the server exists; otherwise load it
+    cached = response_cache.get("server", server_id)
+    if cached is None:
+        version = response_cache.version("server", server_id)
+        
+        # Check if server exists
+        server = db.query(Server).filter(Server.id == server_id).first()
+        if not server:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Server with ID {server_id} not found"
+            )
+    
+    # Check if user is a member of the server
+    if not membership.is_member_sync(db, server_id, current_user.id):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not a member of this server"
+        )
+    
+    if cached is None:
+        member_ids = db.execute(
+            select(server_members.c.user_id).where(server_members.c.server_id == server_id)
+        ).scalars().all()
+        cached = response_cache.put("server", server_id, version, ServerWithMembersResponse(
+            id=server.id,
+            name=server.name,
+            description=server.description,
+            owner_id=server.owner_id,
+            created_at=server.created_at,
+            members=member_ids
+        ))
+    
+    return response_cache.respond(request, cached)
+
+@router.get("/{server_id}/export")
+def export_server(
+    server_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    gzip: bool = False,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    # Check if server exists
     server = db.query(Server).filter(Server.id == server_id).first()
     if not server:
         raise HTTPException(
@@ -54,20 +116,24 @@ def get_server(
         )
     
     # Check if user is a member of the server
-    if current_user not in server.members:
+    if not membership.is_member_sync(db, server_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this server"
         )
     
-    return server
+    # Stream every channel's history as NDJSON, merged in id order; resume with after_id=<last id received>
+    channel_ids = db.execute(select(Channel.id).where(Channel.server_id == server_id)).scalars().all()
+    return export_response(
+        channel_ids, ExportFilter(after_id, before_id, since, until), f"server-{server_id}", gzip
+    )
 
 @router.put("/{server_id}", response_model=ServerResponse)
 def update_server(
     server_id: int,
     server_update: ServerUpdate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if server exists
     server = db.query(Server).filter(Server.id == server_id).first()
@@ -92,6 +158,7 @@ def update_server(
     
     db.commit()
     db.refresh(server)
+    response_cache.server_changed(server_id)
     
     return server
 
@@ -99,7 +166,7 @@ def update_server(
 def delete_server(
     server_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if server exists
     server = db.query(Server).filter(Server.id == server_id).first()
@@ -117,8 +184,17 @@ def delete_server(
         )
     
     # Delete server
+    channel_ids = [channel.id for channel in server.channels]
+    search_index.remove_channels_sync(db, channel_ids)
+    db.query(MessageOverlay).filter(MessageOverlay.channel_id.in_(channel_ids)).delete(synchronize_session=False)
     db.delete(server)
     db.commit()
+    membership.server_deleted(server_id)
+    response_cache.server_changed(server_id)
+    response_cache.channels_changed(server_id)
+    for channel_id in channel_ids:
+        history_cache.drop(channel_id)
+    message_archive.drop_channels(channel_ids)
     
     return
 
@@ -127,7 +203,7 @@ def add_member(
     server_id: int,
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if server exists
     server = db.query(Server).filter(Server.id == server_id).first()
@@ -152,25 +228,96 @@ def add_member(
             detail=f"User with ID {user_id} not found"
         )
     
-    # Check if user is already a member
-    if user in server.members:
+    # Check if user is already a member; asks the table, since the cached answer may be stale
+    already_member = db.execute(
+        select(server_members.c.user_id).where(
+            server_members.c.server_id == server_id,
+            server_members.c.user_id == user_id
+        )
+    ).first()
+    if already_member:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"User is already a member of this server"
         )
     
-    # Add user to server
-    server.members.append(user)
-    db.commit()
+    # Add user to server; the unique constraint catches a concurrent add of the same user
+    try:
+        db.execute(server_members.insert().values(server_id=server_id, user_id=user_id))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"User is already a member of this server"
+        )
+    membership.member_added(server_id, user_id)
+    response_cache.server_changed(server_id)
     
     return
 
+@router.post("/{server_id}/members", response_model=ServerMembersAddResult)
+def add_members(
+    server_id: int,
+    members: ServerMembersAdd,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    user_ids = unique_ids(members.user_ids, BATCH_MAX_MEMBERS)
+    
+    # Check if server exists
+    server = db.query(Server).filter(Server.id == server_id).first()
+    if not server:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Server with ID {server_id} not found"
+        )
+    
+    # Check if user is the owner
+    if server.owner_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only the server owner can add members"
+        )
+    
+    # Sort the users out with one query each for existing users and existing members
+    existing = set(db.execute(select(User.id).where(User.id.in_(user_ids))).scalars())
+    members_already = set(db.execute(
+        select(server_members.c.user_id).where(
+            server_members.c.server_id == server_id,
+            server_members.c.user_id.in_(user_ids)
+        )
+    ).scalars())
+    added = [user_id for user_id in user_ids if user_id in existing and user_id not in members_already]
+    
+    # Add the new members in a single statement
+    if added:
+        try:
+            db.execute(server_members.insert(), [{"server_id": server_id, "user_id": user_id} for user_id in added])
+            db.commit()
+        except IntegrityError:
+            # Someone added one of them meanwhile; nothing was added, so the call can be retried
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Server members changed, please try again"
+            )
+        for user_id in added:
+            membership.member_added(server_id, user_id)
+        response_cache.server_changed(server_id)
+    
+    return {
+        "added": added,
+        "already_members": [user_id for user_id in user_ids if user_id in members_already],
+        "not_found": [user_id for user_id in user_ids if user_id not in existing]
+    }
+
 @router.delete("/{server_id}/members/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 def remove_member(
     server_id: int,
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # Check if server exists
     server = db.query(Server).filter(Server.id == server_id).first()
@@ -203,14 +350,19 @@ def remove_member(
         )
     
     # Check if user is a member
-    if user not in server.members:
+    if not membership.is_member_sync(db, server_id, user_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"User is not a member of this server"
         )
     
     # Remove user from server
-    server.members.remove(user)
+    db.execute(server_members.delete().where(
+        server_members.c.server_id == server_id,
+        server_members.c.user_id == user_id
+    ))
     db.commit()
+    membership.member_removed(server_id, user_id)
+    response_cache.server_changed(server_id)
     
     return
@@ -1,55 +1,90 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..database import get_db
-from ..schemas.user import UserResponse, UserUpdate
+from typing import List
+from ..database import get_async_db, get_db
+from ..schemas.user import UserBatchResponse, UserResponse, UserUpdate
 from ..models import User
-from ..utils.auth import get_current_active_user, get_password_hash
+from ..schemas.auth import Principal
+from ..utils.auth import get_current_active_user, principal_cache
+from ..utils.batch import id_list
+from ..utils.passwords import password_hasher
+from ..utils.response_cache import response_cache
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 @router.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: User = Depends(get_current_active_user)):
-    return current_user
+def get_current_user_info(request: Request, current_user: Principal = Depends(get_current_active_user)):
+    cached = response_cache.get("user", current_user.id)
+    if cached is None:
+        version = response_cache.version("user", current_user.id)
+        cached = response_cache.put("user", current_user.id, version, UserResponse.model_validate(current_user))
+    return response_cache.respond(request, cached)
+
+@router.get("/", response_model=UserBatchResponse)
+async def get_users(
+    ids: List[int] = Depends(id_list),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    # Look up every requested user in one query
+    users = {user.id: user for user in (await db.execute(select(User).where(User.id.in_(ids)))).scalars()}
+    
+    return {
+        "users": [users[user_id] for user_id in ids if user_id in users],
+        "not_found": [user_id for user_id in ids if user_id not in users]
+    }
 
 @router.get("/{user_id}", response_model=UserResponse)
-def get_user(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User with ID {user_id} not found"
-        )
-    return user
+def get_user(user_id: int, request: Request, db: Session = Depends(get_db)):
+    cached = response_cache.get("user", user_id)
+    if cached is None:
+        version = response_cache.version("user", user_id)
+        user = db.query(User).filter(User.id == user_id).first()
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"User with ID {user_id} not found"
+            )
+        cached = response_cache.put("user", user_id, version, UserResponse.model_validate(user))
+    return response_cache.respond(request, cached)
 
 @router.put("/me", response_model=UserResponse)
-def update_user(
+async def update_user(
     user_update: UserUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
+    user = (await db.execute(select(User).where(User.id == current_user.id))).scalars().first()
+    
     # Update user details
     if user_update.username:
-        existing_user = db.query(User).filter(User.username == user_update.username).first()
-        if existing_user and existing_user.id != current_user.id:
+        existing_user = (await db.execute(select(User).where(User.username == user_update.username))).scalars().first()
+        if existing_user and existing_user.id != user.id:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Username already taken"
             )
-        current_user.username = user_update.username
+        user.username = user_update.username
     
     if user_update.email:
-        existing_user = db.query(User).filter(User.email == user_update.email).first()
-        if existing_user and existing_user.id != current_user.id:
+        existing_user = (await db.execute(select(User).where(User.email == user_update.email))).scalars().first()
+        if existing_user and existing_user.id != user.id:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email already registered"
             )
-        current_user.email = user_update.email
+        user.email = user_update.email
     
     if user_update.password:
-        current_user.hashed_password = get_password_hash(user_update.password)
+        user.hashed_password = await password_hasher.hash(user_update.password)
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    await db.refresh(user)
     
-    return current_user
+    # Cached principals and profiles for this user are now stale
+    principal_cache.invalidate_user(user.id)
+    response_cache.user_changed(user.id)
+    
+    return user
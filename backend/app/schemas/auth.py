@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from datetime import datetime
 
 class Token(BaseModel):
     access_token: str
@@ -6,3 +7,15 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: str
+
+class Principal(BaseModel):
+    # Read-only snapshot of an authenticated user, safe to share between requests
+    id: int
+    username: str
+    email: str
+    is_active: bool
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+        frozen = True
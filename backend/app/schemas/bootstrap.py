@@ -0,0 +1,25 @@
+from pydantic import BaseModel
+from typing import List, Optional
+from .channel import ChannelResponse
+from .message import MessageWithUserResponse
+from .server import ServerResponse
+from .user import UserResponse
+
+class Participant(BaseModel):
+    id: int
+    username: str
+
+class BootstrapChannel(ChannelResponse):
+    # Users connected to a voice channel; empty for text channels
+    participants: List[Participant] = []
+
+class BootstrapServer(ServerResponse):
+    channels: List[BootstrapChannel]
+
+class BootstrapResponse(BaseModel):
+    user: UserResponse
+    servers: List[BootstrapServer]
+    # First history page of the requested channel, newest first
+    channel_id: Optional[int] = None
+    messages: List[MessageWithUserResponse] = []
+    next_cursor: Optional[str] = None
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 class MessageBase(BaseModel):
@@ -25,3 +25,14 @@ class MessageWithUserResponse(MessageResponse):
     
     class Config:
         from_attributes = True
+
+class MessageSearchResult(MessageWithUserResponse):
+    # Matching part of the content, HTML-escaped, with matches wrapped in <mark>
+    snippet: str
+
+class MessageBatchResponse(BaseModel):
+    # Found messages in the order they were asked for
+    messages: List[MessageWithUserResponse]
+    not_found: List[int]
+    # In servers the user is not a member of
+    forbidden: List[int]
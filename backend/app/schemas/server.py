@@ -26,3 +26,11 @@ class ServerWithMembersResponse(ServerResponse):
     
     class Config:
         from_attributes = True
+
+class ServerMembersAdd(BaseModel):
+    user_ids: List[int]
+
+class ServerMembersAddResult(BaseModel):
+    added: List[int]
+    already_members: List[int]
+    not_found: List[int]
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 class UserBase(BaseModel):
@@ -24,3 +24,8 @@ class UserResponse(UserBase):
 
 class UserInDB(UserResponse):
     hashed_password: str
+
+class UserBatchResponse(BaseModel):
+    # Found users in the order they were asked for
+    users: List[UserResponse]
+    not_found: List[int]
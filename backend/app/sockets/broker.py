@@ -0,0 +1,575 @@
+"""Pub/sub backends that carry channel events between worker processes.
+
+Every event published for a channel goes through the broker and comes back
+to each process that has local sockets in that channel, including the one
+that published it, so all workers see a channel's events in the same order.
+Channel presence (see presence.py) is merged across workers by the broker
+as well.
+
+The broker also numbers every channel-wide event with a per-channel sequence
+number (spliced into the event as "seq") and keeps a bounded log of recent
+events, so a reconnecting client can ask for what it missed since the last
+sequence number it saw. Older chat messages are remembered only as
+(seq, message id) pairs; the caller loads those from the database.
+Sequence numbers start from the wall clock (milliseconds x 1000) when a
+channel's log is created, so they keep increasing across broker restarts
+and log evictions. The worker that published a chat message is handed its
+message id back with the numbered event and stores the sequence number on
+the message, so a client resuming across a restart or eviction gets the
+chat messages it missed from the database (other events from before the
+current log are lost).
+
+Two implementations are provided:
+
+- MemoryBroker: in-process, the default. Several ConnectionManagers can
+  share one MemoryHub to simulate multiple workers in a single process.
+- SocketBroker: talks to a standalone broker over a Unix or TCP socket,
+  so several uvicorn workers (or machines) can share channels:
+
+      python -m app.sockets.broker unix:///tmp/ankachat-broker.sock
+      BROKER_URL=unix:///tmp/ankachat-broker.sock uvicorn main:app --workers 4
+"""
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+from ..utils.codecs import dumps, loads
+from .frames import Frame
+from .presence import PresenceDiff, PresenceRegistry, presence_frame
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+BROKER_URL = os.getenv("BROKER_URL", "memory://")
+
+# Recent events kept per channel for replay
+REPLAY_LOG_SIZE = int(os.getenv("WS_REPLAY_LOG_SIZE", "128"))
+# Largest gap, in sequence numbers, a reconnecting client can resume across
+RESUME_MAX_GAP = int(os.getenv("WS_RESUME_MAX_GAP", "1000"))
+# Channels with a replay log before the least recently used is evicted
+REPLAY_CHANNELS = int(os.getenv("WS_REPLAY_CHANNELS", "10000"))
+# Bytes the broker process buffers for a worker that is not reading before dropping it;
+# a worker buffers as much for a broker that is not reading before dropping events
+BROKER_MAX_BUFFER = int(os.getenv("BROKER_MAX_BUFFER", str(16 * 1024 * 1024)))
+# How long a worker waits for the broker to answer a request, or to take its writes
+BROKER_REQUEST_TIMEOUT_MS = float(os.getenv("BROKER_REQUEST_TIMEOUT_MS", "5000"))
+
+# deliver(channel_id, frame, exclude, target_user_id, seq, message_id)
+DeliverCallback = Callable[[int, Frame, Optional[str], Optional[int], Optional[int], Optional[int]], None]
+
+class Replay(NamedTuple):
+    # Logged events after the requested sequence number, oldest first
+    events: List[Tuple[int, Frame]]
+    # Chat messages older than the log, as (seq, message id), oldest first
+    messages: List[Tuple[int, int]]
+    # (after, through): the log started after the requested sequence number, so chat
+    # messages with a stored seq in that range come from the database
+    stored: Optional[Tuple[int, int]] = None
+
+class Broker:
+    """Interface used by ConnectionManager."""
+
+    async def start(self, deliver: DeliverCallback):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, channel_id: int):
+        raise NotImplementedError
+
+    def unsubscribe(self, channel_id: int):
+        raise NotImplementedError
+
+    def publish(
+        self,
+        channel_id: int,
+        frame: Frame,
+        exclude: str = None,
+        target_user_id: int = None,
+        message_id: int = None
+    ):
+        raise NotImplementedError
+
+    async def drain(self):
+        # Wait until published events can be sent on; callers await it after publish()
+        pass
+
+    async def replay(self, channel_id: int, since: int) -> Optional[Replay]:
+        raise NotImplementedError
+
+    async def presence_update(self, channel_id: int, added: List[dict], removed: List[int]) -> PresenceDiff:
+        raise NotImplementedError
+
+    async def presence_users(self, channel_id: int) -> List[dict]:
+        raise NotImplementedError
+
+class ChannelLog:
+    def __init__(self, log_size: int, max_gap: int):
+        self.seq = int(time.time() * 1000) * 1000
+        # Sequence numbers up to this one were handed out before the log existed
+        self.start = self.seq
+        self.events = deque(maxlen=log_size)
+        self.messages = deque(maxlen=max_gap)
+        # Every event after these sequence numbers is still in events / messages
+        self.events_after = self.seq
+        self.messages_after = self.seq
+
+class ReplayLog:
+    """Per-channel sequence numbers and bounded replay logs, LRU-evicted across channels."""
+
+    def __init__(
+        self,
+        log_size: int = REPLAY_LOG_SIZE,
+        max_gap: int = RESUME_MAX_GAP,
+        max_channels: int = REPLAY_CHANNELS
+    ):
+        self.log_size = log_size
+        self.max_gap = max_gap
+        self.max_channels = max_channels
+        self.channels: OrderedDict = OrderedDict()
+
+    def append(self, channel_id: int, frame: Frame, message_id: int = None) -> Tuple[int, Frame]:
+        log = self.channels.get(channel_id)
+        if log is None:
+            log = self.channels[channel_id] = ChannelLog(self.log_size, self.max_gap)
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        self.channels.move_to_end(channel_id)
+
+        log.seq += 1
+        frame = frame.with_seq(log.seq)
+        if len(log.events) == log.events.maxlen:
+            log.events_after = log.events[0][0]
+        log.events.append((log.seq, frame))
+        if message_id is not None:
+            if len(log.messages) == log.messages.maxlen:
+                log.messages_after = log.messages[0][0]
+            log.messages.append((log.seq, message_id))
+        return log.seq, frame
+
+    def replay(self, channel_id: int, since: int) -> Optional[Replay]:
+        # None means the gap cannot be filled and the client has to resync
+        log = self.channels.get(channel_id)
+        if log is None:
+            # Nothing published since the broker restarted or evicted the log
+            return Replay([], [], (since, None))
+        stored = None
+        if since < log.start:
+            # The rest of the gap, up to the start of this log, is in the database
+            stored = (since, log.start)
+            since = log.start
+        elif since > log.seq or log.seq - since > self.max_gap:
+            return None
+        events = [(seq, frame) for seq, frame in log.events if seq > since]
+        if since >= log.events_after:
+            return Replay(events, [], stored)
+        if since < log.messages_after:
+            return None
+        messages = [(seq, message_id) for seq, message_id in log.messages if since < seq <= log.events_after]
+        return Replay(events, messages, stored)
+
+class MemoryHub:
+    """Shared state for MemoryBrokers living in the same process."""
+
+    def __init__(self):
+        self.subscribers: Dict[int, Set["MemoryBroker"]] = {}
+        self.presence = PresenceRegistry()
+        self.log = ReplayLog()
+
+class MemoryBroker(Broker):
+    def __init__(self, hub: MemoryHub = None):
+        self.hub = hub or MemoryHub()
+        self.deliver: DeliverCallback = None
+
+    async def start(self, deliver: DeliverCallback):
+        self.deliver = deliver
+
+    def subscribe(self, channel_id: int):
+        self.hub.subscribers.setdefault(channel_id, set()).add(self)
+
+    def unsubscribe(self, channel_id: int):
+        subscribers = self.hub.subscribers.get(channel_id)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.hub.subscribers[channel_id]
+
+    def publish(
+        self,
+        channel_id: int,
+        frame: Frame,
+        exclude: str = None,
+        target_user_id: int = None,
+        message_id: int = None
+    ):
+        seq = None
+        if target_user_id is None:
+            seq, frame = self.hub.log.append(channel_id, frame, message_id)
+        for broker in list(self.hub.subscribers.get(channel_id, ())):
+            broker.deliver(channel_id, frame, exclude, target_user_id, seq, message_id)
+
+    async def replay(self, channel_id: int, since: int) -> Optional[Replay]:
+        return self.hub.log.replay(channel_id, since)
+
+    async def presence_update(self, channel_id: int, added: List[dict], removed: List[int]) -> PresenceDiff:
+        return self.hub.presence.update(channel_id, added, removed, self)
+
+    async def presence_users(self, channel_id: int) -> List[dict]:
+        return self.hub.presence.get(channel_id)
+
+# Wire format shared by SocketBroker and BrokerServer: a 4-byte big-endian
+# length, then a JSON header line, then the raw event payload (if any).
+# Replay replies carry several events back to back, split by header["sizes"].
+_LENGTH = struct.Struct(">I")
+
+def _pack(header: dict, payload: bytes = b"") -> bytes:
+    body = dumps(header) + b"\n" + payload
+    return _LENGTH.pack(len(body)) + body
+
+async def _read(reader: asyncio.StreamReader):
+    (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    body = await reader.readexactly(length)
+    header, _, payload = body.partition(b"\n")
+    return loads(header), payload
+
+async def _open(url: str):
+    parsed = urlparse(url)
+    if parsed.scheme == "unix":
+        return await asyncio.open_unix_connection(parsed.path)
+    if parsed.scheme == "tcp":
+        return await asyncio.open_connection(parsed.hostname, parsed.port)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+class SocketBroker(Broker):
+    """Client for a BrokerServer reachable at a unix:// or tcp:// URL."""
+
+    def __init__(
+        self,
+        url: str,
+        reconnect_delay: float = 1.0,
+        max_buffer: int = BROKER_MAX_BUFFER,
+        request_timeout_ms: float = BROKER_REQUEST_TIMEOUT_MS
+    ):
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_buffer = max_buffer
+        self.request_timeout = request_timeout_ms / 1000
+        self.deliver: DeliverCallback = None
+        self.channels: Set[int] = set()
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.reader_task: asyncio.Task = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        # Users this worker reported present, by channel
+        self.presence: Dict[int, Dict[int, dict]] = {}
+        self.next_request_id = 0
+        self.connected: asyncio.Event = None
+        self.stats = {
+            "dropped": 0,
+            "timeouts": 0,
+        }
+
+    async def start(self, deliver: DeliverCallback):
+        self.deliver = deliver
+        self.connected = asyncio.Event()
+        await self._connect()
+        self.reader_task = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+            self.reader_task = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    async def _connect(self):
+        self.reader, self.writer = await _open(self.url)
+        # Re-announce local subscriptions and presence after a reconnect
+        for channel_id in self.channels:
+            self._send({"op": "sub", "channel": channel_id})
+        for channel_id, present in self.presence.items():
+            self._send({"op": "presence", "channel": channel_id, "added": list(present.values()), "removed": []})
+        self.connected.set()
+
+    async def _read_loop(self):
+        while True:
+            try:
+                header, payload = await _read(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError) as exc:
+                logger.warning("Lost connection to broker %s: %s", self.url, exc)
+                self.connected.clear()
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Broker connection lost"))
+                self.pending.clear()
+                await self._reconnect()
+                continue
+
+            if header["op"] == "event":
+                self.deliver(
+                    header["channel"], Frame(payload), header.get("exclude"), header.get("target"),
+                    header.get("seq"), header.get("message_id")
+                )
+            elif header["op"] == "reply":
+                future = self.pending.pop(header["id"], None)
+                if future and not future.done():
+                    future.set_result((header, payload))
+
+    async def _reconnect(self):
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._connect()
+                return
+            except OSError as exc:
+                logger.warning("Broker %s unavailable: %s", self.url, exc)
+
+    def _send(self, header: dict, payload: bytes = b""):
+        if self.writer is None or self.writer.is_closing():
+            logger.warning("Dropping %s for channel %s: broker not connected", header["op"], header.get("channel"))
+            return
+        # A broker that stopped reading does not get to grow this worker's memory; drain()
+        # holds publishers back well before this
+        buffered = self.writer.transport.get_write_buffer_size()
+        if buffered > self.max_buffer:
+            logger.warning("Dropping %s for channel %s: %d bytes unsent to broker", header["op"], header.get("channel"), buffered)
+            self.stats["dropped"] += 1
+            return
+        self.writer.write(_pack(header, payload))
+
+    async def drain(self):
+        writer = self.writer
+        if writer is None or writer.is_closing():
+            return
+        try:
+            await asyncio.wait_for(writer.drain(), self.request_timeout)
+        except asyncio.TimeoutError:
+            # The broker is stuck: drop the connection, so it is made again and local
+            # clients resume or resync
+            logger.warning("Broker %s is not reading; reconnecting", self.url)
+            self.stats["timeouts"] += 1
+            writer.transport.abort()
+        except ConnectionError:
+            # The read loop sees the same and reconnects
+            pass
+
+    async def _request(self, header: dict) -> Tuple[dict, bytes]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_timeout
+        self.next_request_id += 1
+        header["id"] = self.next_request_id
+        future = loop.create_future()
+        try:
+            await asyncio.wait_for(self.connected.wait(), self.request_timeout)
+            self.pending[header["id"]] = future
+            self._send(header)
+            await self.drain()
+            return await asyncio.wait_for(future, max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise ConnectionError(f"Broker did not answer {header['op']} in time")
+        finally:
+            self.pending.pop(header["id"], None)
+
+    def subscribe(self, channel_id: int):
+        self.channels.add(channel_id)
+        self._send({"op": "sub", "channel": channel_id})
+
+    def unsubscribe(self, channel_id: int):
+        self.channels.discard(channel_id)
+        self._send({"op": "unsub", "channel": channel_id})
+
+    def publish(
+        self,
+        channel_id: int,
+        frame: Frame,
+        exclude: str = None,
+        target_user_id: int = None,
+        message_id: int = None
+    ):
+        self._send({
+            "op": "pub",
+            "channel": channel_id,
+            "exclude": exclude,
+            "target": target_user_id,
+            "message_id": message_id
+        }, frame.data)
+
+    async def replay(self, channel_id: int, since: int) -> Optional[Replay]:
+        header, payload = await self._request({"op": "replay", "channel": channel_id, "since": since})
+        if header.get("resync"):
+            return None
+        events = []
+        offset = 0
+        for seq, size in zip(header["seqs"], header["sizes"]):
+            events.append((seq, Frame(payload[offset:offset + size])))
+            offset += size
+        stored = tuple(header["stored"]) if header.get("stored") else None
+        return Replay(events, [tuple(message) for message in header["messages"]], stored)
+
+    async def presence_update(self, channel_id: int, added: List[dict], removed: List[int]) -> PresenceDiff:
+        # Remember what this worker reported, to announce it again after a reconnect
+        present = self.presence.setdefault(channel_id, {})
+        present.update((user_info["id"], user_info) for user_info in added)
+        for user_id in removed:
+            present.pop(user_id, None)
+        if not present:
+            del self.presence[channel_id]
+
+        header, _ = await self._request({"op": "presence", "channel": channel_id, "added": added, "removed": removed})
+        return PresenceDiff(header["added"], header["removed"], header["count"])
+
+    async def presence_users(self, channel_id: int) -> List[dict]:
+        header, _ = await self._request({"op": "presence_users", "channel": channel_id})
+        return header["users"]
+
+class BrokerServer:
+    """Standalone broker process that SocketBrokers connect to."""
+
+    def __init__(self, url: str, max_buffer: int = BROKER_MAX_BUFFER):
+        self.url = url
+        self.subscribers: Dict[int, Set[asyncio.StreamWriter]] = {}
+        self.clients: Set[asyncio.StreamWriter] = set()
+        self.presence = PresenceRegistry()
+        self.log = ReplayLog()
+        self.server: asyncio.AbstractServer = None
+        self.max_buffer = max_buffer
+        self.stats = {
+            "slow_disconnects": 0,
+        }
+
+    async def start(self):
+        parsed = urlparse(self.url)
+        if parsed.scheme == "unix":
+            if os.path.exists(parsed.path):
+                os.unlink(parsed.path)
+            self.server = await asyncio.start_unix_server(self._handle, parsed.path)
+        elif parsed.scheme == "tcp":
+            self.server = await asyncio.start_server(self._handle, parsed.hostname, parsed.port)
+        else:
+            raise ValueError(f"Unsupported broker URL: {self.url}")
+
+    async def serve_forever(self):
+        await self.start()
+        logger.info("Broker listening on %s", self.url)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            for writer in list(self.clients):
+                writer.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        try:
+            while True:
+                header, payload = await _read(reader)
+                self._dispatch(writer, header, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            for subscribers in self.subscribers.values():
+                subscribers.discard(writer)
+            # Tell the channels that the vanished worker's users are gone
+            for channel_id, diff in self.presence.drop_owner(writer).items():
+                self._publish(channel_id, presence_frame(channel_id, diff).with_field("channel_id", channel_id).data)
+            writer.close()
+
+    def _dispatch(self, writer: asyncio.StreamWriter, header: dict, payload: bytes):
+        op = header["op"]
+        channel_id = header.get("channel")
+
+        if op == "sub":
+            self.subscribers.setdefault(channel_id, set()).add(writer)
+        elif op == "unsub":
+            subscribers = self.subscribers.get(channel_id)
+            if subscribers is not None:
+                subscribers.discard(writer)
+                if not subscribers:
+                    del self.subscribers[channel_id]
+        elif op == "pub":
+            self._publish(channel_id, payload, header.get("exclude"), header.get("target"), header.get("message_id"))
+        elif op == "replay":
+            replay = self.log.replay(channel_id, header["since"])
+            if replay is None:
+                self._send(writer, _pack({"op": "reply", "id": header["id"], "resync": True}))
+            else:
+                self._send(writer, _pack({
+                    "op": "reply",
+                    "id": header["id"],
+                    "seqs": [seq for seq, _ in replay.events],
+                    "sizes": [len(frame) for _, frame in replay.events],
+                    "messages": replay.messages,
+                    "stored": replay.stored
+                }, b"".join(frame.data for _, frame in replay.events)))
+        elif op == "presence":
+            diff = self.presence.update(channel_id, header["added"], header["removed"], writer)
+            if "id" in header:
+                self._send(writer, _pack({
+                    "op": "reply",
+                    "id": header["id"],
+                    "added": diff.added,
+                    "removed": diff.removed,
+                    "count": diff.count
+                }))
+            elif diff.added or diff.removed:
+                # Presence re-announced after a reconnect: nobody else will broadcast it
+                self._publish(channel_id, presence_frame(channel_id, diff).with_field("channel_id", channel_id).data)
+        elif op == "presence_users":
+            self._send(writer, _pack({"op": "reply", "id": header["id"], "users": self.presence.get(channel_id)}))
+
+    def _send(self, writer: asyncio.StreamWriter, data: bytes):
+        if writer.is_closing():
+            return
+        writer.write(data)
+        # Nothing waits for these writes to drain: a worker that stops reading gets the slow
+        # consumer treatment instead of growing the broker's memory. It reconnects, and its
+        # clients resume or resync
+        buffered = writer.transport.get_write_buffer_size()
+        if buffered > self.max_buffer:
+            logger.warning("Dropping a broker client with %d bytes unsent", buffered)
+            self.stats["slow_disconnects"] += 1
+            # abort() discards the buffer; _handle() cleans up once the read side sees the close
+            writer.transport.abort()
+
+    def _publish(self, channel_id: int, payload: bytes, exclude: str = None, target: int = None, message_id: int = None):
+        seq = None
+        if target is None:
+            seq, frame = self.log.append(channel_id, Frame(payload), message_id)
+            payload = frame.data
+        event = _pack({
+            "op": "event",
+            "channel": channel_id,
+            "exclude": exclude,
+            "target": target,
+            "seq": seq,
+            "message_id": message_id
+        }, payload)
+        for subscriber in list(self.subscribers.get(channel_id, ())):
+            self._send(subscriber, event)
+
+def create_broker(url: str = BROKER_URL) -> Broker:
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryBroker()
+    if scheme in ("unix", "tcp"):
+        return SocketBroker(url)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    url = sys.argv[1] if len(sys.argv) > 1 else "unix:///tmp/ankachat-broker.sock"
+    asyncio.run(BrokerServer(url).serve_forever())
@@ -1,155 +1,269 @@
-from fastapi import WebSocket, WebSocketDisconnect, HTTPException, Depends
-from typing import Dict, Optional
-from sqlalchemy.orm import Session
-from ..database import get_db
-from ..models import Channel, Server, User, Message
+from fastapi import WebSocket, WebSocketDisconnect
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
+from ..database import AsyncSessionLocal
+from ..models import Channel, Message, User
+from ..schemas.auth import Principal
+from ..utils.history_cache import history_cache
+from ..utils.membership import membership
+from ..utils.tracing import tracer
+from .broker import RESUME_MAX_GAP
 from .connection_manager import manager
+from .frames import Frame
+from .persistence import WriterBusy, message_writer
 from jose import JWTError, jwt
-import json
-from ..utils.auth import SECRET_KEY, ALGORITHM
+from ..utils.auth import SECRET_KEY, ALGORITHM, principal_cache
 import logging
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
-async def get_user_from_token(token: str, db: Session):
+# Fields a client may put in a WebRTC signal; everything else ("from", "seq",
+# "channel_id", ...) is set by the server
+SIGNAL_FIELDS = ("type", "target", "signal", "sdp", "candidate")
+
+async def get_user_from_token(token: str, db: AsyncSession):
+    with tracer.span("auth") as span:
+        principal = principal_cache.get(token)
+        span.set("cached", principal is not None)
+        if principal is None:
+            principal = await _load_principal(token, db)
+        return principal
+
+async def _load_principal(token: str, db: AsyncSession):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             return None
-        user = db.query(User).filter(User.username == username).first()
-        return user
+        result = await db.execute(select(User).where(User.username == username))
+        user = result.scalars().first()
+        if user is None:
+            return None
+        principal = Principal.model_validate(user)
+        principal_cache.set(token, principal, payload.get("exp"))
+        return principal
     except JWTError:
         return None
 
-async def handle_chat_connection(websocket: WebSocket, channel_id: int, token: str, db: Session):
-    # Authenticate user
-    user = await get_user_from_token(token, db)
-    if not user:
-        await websocket.close(code=4001)  # Unauthorized
-        return
-    
+async def check_channel_access(db: AsyncSession, user_id: int, channel_id: int, channel_type: str = None):
+    """Return (channel, None) if the user may use the channel, or (None, close_code)."""
     # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == channel_id).first()
+    channel = await db.get(Channel, channel_id)
     if not channel:
-        await websocket.close(code=4004)  # Not Found
-        return
+        return None, 4004  # Not Found
     
     # Check if user is a member of the server
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if user not in server.members:
-        await websocket.close(code=4003)  # Forbidden
-        return
+    if not await membership.is_member(db, channel.server_id, user_id):
+        return None, 4003  # Forbidden
     
-    # Check if channel is a text channel
-    if channel.type != "text":
-        await websocket.close(code=4000)  # Bad Request
-        return
+    # Check if channel has the expected type
+    if channel_type is not None and channel.type != channel_type:
+        return None, 4000  # Bad Request
     
-    # Accept connection
-    user_info = {
-        "id": user.id,
-        "username": user.username
-    }
-    
-    await manager.connect(websocket, channel_id, user_info)
-    
-    # Notify all channel members that a new user connected
-    join_message = {
-        "type": "user_joined",
+    return channel, None
+
+async def authorize_connection(token: str, channel_id: int, channel_type: str):
+    """Run the connect handshake checks, returning (user, None) or (None, close_code)."""
+    # One short session for the handshake; nothing stays open while the socket lives
+    with tracer.span("ws.connect", channel_id=channel_id, type=channel_type) as span:
+        async with AsyncSessionLocal() as db:
+            # Authenticate user
+            user = await get_user_from_token(token, db)
+            if not user:
+                span.set("close_code", 4001)
+                return None, 4001  # Unauthorized
+            
+            channel, close_code = await check_channel_access(db, user.id, channel_id, channel_type)
+            if close_code:
+                span.set("close_code", close_code)
+                return None, close_code
+            
+            return user, None
+
+def error_event(message: str, **details) -> Frame:
+    return Frame.from_event({
+        "type": "error",
         "data": {
+            "message": message,
+            **details
+        }
+    })
+
+def invalid_message_event(websocket: WebSocket) -> Frame:
+    return error_event(f"Invalid {manager.codec_name(websocket)} format")
+
+def chat_message_event(message_id: int, content: str, user_id: int, username: str, channel_id: int, created_at: datetime):
+    return {
+        "type": "chat_message",
+        "data": {
+            "id": message_id,
+            "content": content,
+            "user_id": user_id,
+            "username": username,
             "channel_id": channel_id,
-            "user": user_info,
-            "timestamp": datetime.now().isoformat()
+            "created_at": created_at.isoformat()
         }
     }
-    await manager.broadcast(json.dumps(join_message), channel_id)
+
+async def load_missed_messages(missed):
+    """Rebuild chat_message events for (seq, message_id) pairs that fell out of the replay log."""
+    message_ids = [message_id for _, message_id in missed]
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(Message, User.username).join(User, Message.user_id == User.id).where(Message.id.in_(message_ids))
+        )
+        found = {message.id: (message, username) for message, username in result.all()}
+    
+    frames = []
+    for seq, message_id in missed:
+        # Messages deleted since then are skipped
+        if message_id in found:
+            message, username = found[message_id]
+            event = chat_message_event(message.id, message.content, message.user_id, username, message.channel_id, message.created_at)
+            frames.append((seq, Frame.from_event(event).with_field("channel_id", message.channel_id).with_seq(seq)))
+    return frames
+
+async def load_stored_messages(channel_id: int, after: int, through: Optional[int]):
+    """Rebuild chat_message events for messages with a stored seq in (after, through].
+
+    Returns None when more than RESUME_MAX_GAP messages were missed.
+    """
+    query = select(Message, User.username).join(User, Message.user_id == User.id).where(
+        Message.channel_id == channel_id,
+        Message.seq > after
+    )
+    if through is not None:
+        query = query.where(Message.seq <= through)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(query.order_by(Message.seq).limit(RESUME_MAX_GAP + 1))
+        rows = result.all()
+    if len(rows) > RESUME_MAX_GAP:
+        return None
     
+    frames = []
+    for message, username in rows:
+        event = chat_message_event(message.id, message.content, message.user_id, username, message.channel_id, message.created_at)
+        frames.append((message.seq, Frame.from_event(event).with_field("channel_id", message.channel_id).with_seq(message.seq)))
+    return frames
+
+def valid_sequence(value) -> bool:
+    # A sequence number a client sent back: a non-negative int (JSON true/false are not numbers here)
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def chat_content(message: dict) -> Optional[str]:
+    """The stripped content of a chat_message from a client, or None when it is malformed."""
+    data = message.get("data", {})
+    if not isinstance(data, dict):
+        return None
+    content = data.get("content", "")
+    if not isinstance(content, str):
+        return None
+    return content.strip()
+
+async def resume_connection(websocket: WebSocket, channel_id: int, since: int):
     try:
-        while True:
-            # Receive message from websocket
-            data = await websocket.receive_text()
-            
-            try:
-                message_data = json.loads(data)
-                
-                # Handle message type
-                if message_data.get("type") == "chat_message":
-                    content = message_data.get("data", {}).get("content", "").strip()
-                    
-                    if content:
-                        # Save message to database
-                        db_message = Message(
-                            content=content,
-                            user_id=user.id,
-                            channel_id=channel_id
-                        )
-                        db.add(db_message)
-                        db.commit()
-                        db.refresh(db_message)
-                        
-                        # Broadcast message to all channel members
-                        chat_message = {
-                            "type": "chat_message",
-                            "data": {
-                                "id": db_message.id,
-                                "content": content,
-                                "user_id": user.id,
-                                "username": user.username,
-                                "channel_id": channel_id,
-                                "created_at": db_message.created_at.isoformat()
-                            }
-                        }
-                        await manager.broadcast(json.dumps(chat_message), channel_id)
-                        
-            except json.JSONDecodeError:
-                # Send error message back to the user
-                error_message = {
-                    "type": "error",
-                    "data": {
-                        "message": "Invalid JSON format"
-                    }
-                }
-                await manager.send_personal_message(json.dumps(error_message), websocket)
+        await replay_missed(websocket, channel_id, since)
+    except BaseException:
+        # Live events held back for the replay must not pile up behind a resume that failed
+        manager.end_resume(websocket, channel_id)
+        raise
+
+async def replay_missed(websocket: WebSocket, channel_id: int, since: int):
+    # Replay what the client missed since the last sequence number it saw
+    replay = await manager.replay(channel_id, since) if valid_sequence(since) else None
+    if replay is not None and (replay.messages or replay.stored):
+        try:
+            stored = await load_stored_messages(channel_id, *replay.stored) if replay.stored else []
+            if stored is None:
+                replay = None
+            else:
+                logged = await load_missed_messages(replay.messages) if replay.messages else []
+                missed = stored + logged + replay.events
+        except SQLAlchemyError:
+            logger.exception("Could not load missed messages for channel %s", channel_id)
+            replay = None
+    elif replay is not None:
+        missed = replay.events
     
-    except WebSocketDisconnect:
-        # Clean up on disconnect
-        manager.disconnect(websocket, channel_id)
-        
-        # Notify all channel members that a user disconnected
-        leave_message = {
-            "type": "user_left",
+    if replay is None:
+        # The gap is too large or too old: the client has to reload history over REST
+        resync_message = {
+            "type": "resync_required",
             "data": {
                 "channel_id": channel_id,
-                "user": user_info,
-                "timestamp": datetime.now().isoformat()
+                "since": since
             }
         }
-        await manager.broadcast(json.dumps(leave_message), channel_id)
+        resync_frame = Frame.from_event(resync_message).with_field("channel_id", channel_id)
+        await manager.resume(websocket, channel_id, [(None, resync_frame)], None)
+    else:
+        await manager.resume(websocket, channel_id, missed, since)
 
-async def handle_voice_connection(websocket: WebSocket, channel_id: int, token: str, db: Session):
-    # Authenticate user
-    user = await get_user_from_token(token, db)
-    if not user:
-        await websocket.close(code=4001)  # Unauthorized
+async def post_chat_message(websocket: WebSocket, user: Principal, channel_id: int, content: str):
+    # Save message to database (batched with other messages, off the event loop)
+    try:
+        db_message = await message_writer.save(content, user.id, channel_id)
+    except SQLAlchemyError:
+        await manager.send_personal_message(error_event("Message could not be saved"), websocket)
         return
-    
-    # Check if channel exists
-    channel = db.query(Channel).filter(Channel.id == channel_id).first()
-    if not channel:
-        await websocket.close(code=4004)  # Not Found
+    except WriterBusy:
+        await manager.send_personal_message(error_event("Server is busy, message not saved"), websocket)
         return
     
-    # Check if user is a member of the server
-    server = db.query(Server).filter(Server.id == channel.server_id).first()
-    if user not in server.members:
-        await websocket.close(code=4003)  # Forbidden
+    # Broadcast message to all channel members
+    chat_message = chat_message_event(
+        db_message.id, content, user.id, user.username, channel_id, db_message.created_at
+    )
+    history_cache.add(channel_id, {**chat_message["data"], "created_at": db_message.created_at})
+    await manager.broadcast(Frame.from_event(chat_message), channel_id, message_id=db_message.id)
+
+async def relay_signal(websocket: WebSocket, user_info: dict, channel_id: int, signal_data: dict):
+    # Check if the target is a user ID; anything else cannot be looked up
+    target_user_id = signal_data.get("target")
+    if target_user_id is not None and (not isinstance(target_user_id, int) or isinstance(target_user_id, bool)):
+        await manager.send_personal_message(error_event("Invalid signal target", code=4000), websocket)
         return
     
-    # Check if channel is a voice channel
-    if channel.type != "voice":
-        await websocket.close(code=4000)  # Bad Request
+    # Relay only the signalling fields and add the sender information; the channel
+    # and sequence number go in as top-level fields on delivery
+    event = {key: signal_data[key] for key in SIGNAL_FIELDS if key in signal_data}
+    event["from"] = user_info
+    signal_frame = Frame.from_event(event)
+    
+    # If there's a specific target user, send only to them
+    if target_user_id:
+        await manager.send_to_user(signal_frame, channel_id, target_user_id)
+    else:
+        # Broadcast to all other users in the channel
+        await manager.broadcast(signal_frame, channel_id, exclude=websocket)
+
+async def enter_presence(websocket: WebSocket, channel_id: int, user_info: dict):
+    # Count the user as present (announced on the next presence tick) and send the
+    # newcomer who is there already. Callers pair it with presence.offline() only once
+    # it has returned: it counts the user either way or not at all
+    manager.presence.online(channel_id, user_info)
+    try:
+        snapshot = await manager.presence.snapshot(channel_id)
+    except BaseException:
+        manager.presence.offline(channel_id, user_info["id"])
+        raise
+    await manager.send_personal_message(snapshot, websocket)
+
+async def handle_chat_connection(
+    websocket: WebSocket,
+    channel_id: int,
+    token: str,
+    binary: bool = False,
+    since: int = None,
+    coalesce_ms: int = 0
+):
+    # Authenticate user and check access to the text channel
+    user, close_code = await authorize_connection(token, channel_id, "text")
+    if close_code:
+        await websocket.close(code=close_code)
         return
     
     # Accept connection
@@ -158,71 +272,88 @@ async def handle_voice_connection(websocket: WebSocket, channel_id: int, token:
         "username": user.username
     }
     
-    await manager.connect(websocket, channel_id, user_info)
+    await manager.connect(websocket, channel_id, user_info, binary, resume=since is not None, coalesce_ms=coalesce_ms)
+    entered = False
     
-    # Add user to voice channel participants
-    voice_users = manager.join_voice_channel(channel_id, user_info)
+    try:
+        if since is not None:
+            await resume_connection(websocket, channel_id, since)
+        
+        # Notify all channel members that a new user connected
+        await enter_presence(websocket, channel_id, user_info)
+        entered = True
+        
+        while True:
+            # Receive message from websocket, in the encoding the client negotiated
+            try:
+                message_data = await manager.receive(websocket)
+            except ValueError:
+                # Send error message back to the user
+                await manager.send_personal_message(invalid_message_event(websocket), websocket)
+                continue
+            
+            # Handle message type
+            if isinstance(message_data, dict) and message_data.get("type") == "chat_message":
+                content = chat_content(message_data)
+                
+                if content is None:
+                    await manager.send_personal_message(error_event("Invalid chat message", code=4000), websocket)
+                elif content:
+                    with tracer.span("ws.chat_message", channel_id=channel_id, user_id=user.id):
+                        await post_chat_message(websocket, user, channel_id, content)
     
-    # Notify all channel members of the updated voice participants
-    voice_update = {
-        "type": "voice_users_update",
-        "data": {
-            "channel_id": channel_id,
-            "users": voice_users,
-            "timestamp": datetime.now().isoformat()
-        }
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Clean up on disconnect, or when the handler failed
+        manager.disconnect(websocket)
+        
+        # Notify all channel members that a user disconnected; a socket that never got as far
+        # as entering must not take the count of the user's other sockets
+        if entered:
+            manager.presence.offline(channel_id, user.id)
+
+async def handle_voice_connection(websocket: WebSocket, channel_id: int, token: str, binary: bool = False, coalesce_ms: int = 0):
+    # Authenticate user and check access to the voice channel
+    user, close_code = await authorize_connection(token, channel_id, "voice")
+    if close_code:
+        await websocket.close(code=close_code)
+        return
+    
+    # Accept connection
+    user_info = {
+        "id": user.id,
+        "username": user.username
     }
-    await manager.broadcast(json.dumps(voice_update), channel_id)
+    
+    await manager.connect(websocket, channel_id, user_info, binary, coalesce_ms=coalesce_ms, kind="voice")
+    entered = False
     
     try:
+        # Add user to voice channel participants and notify all channel members
+        await enter_presence(websocket, channel_id, user_info)
+        entered = True
+        
         while True:
             # Receive WebRTC signaling data
-            data = await websocket.receive_text()
-            
             try:
-                signal_data = json.loads(data)
-                
-                # Handle signaling message types
-                if signal_data.get("type") in ["offer", "answer", "ice-candidate"]:
-                    # Add the sender information
-                    signal_data["from"] = user_info
-                    
-                    # If there's a specific target user, send only to them
-                    target_user_id = signal_data.get("target")
-                    if target_user_id:
-                        # Find the connection for the target user
-                        for conn, conn_user in manager.connection_user.items():
-                            if conn_user.get("id") == target_user_id and conn in manager.active_connections.get(channel_id, []):
-                                await manager.send_personal_message(json.dumps(signal_data), conn)
-                                break
-                    else:
-                        # Broadcast to all other users in the channel
-                        await manager.broadcast(json.dumps(signal_data), channel_id, exclude=websocket)
-            
-            except json.JSONDecodeError:
+                signal_data = await manager.receive(websocket)
+            except ValueError:
                 # Send error message back to the user
-                error_message = {
-                    "type": "error",
-                    "data": {
-                        "message": "Invalid JSON format"
-                    }
-                }
-                await manager.send_personal_message(json.dumps(error_message), websocket)
+                await manager.send_personal_message(invalid_message_event(websocket), websocket)
+                continue
+            
+            # Handle signaling message types
+            if isinstance(signal_data, dict) and signal_data.get("type") in ["offer", "answer", "ice-candidate"]:
+                with tracer.span("ws.signal", channel_id=channel_id, type=signal_data["type"]):
+                    await relay_signal(websocket, user_info, channel_id, signal_data)
     
     except WebSocketDisconnect:
-        # Clean up on disconnect
-        manager.disconnect(websocket, channel_id)
+        pass
+    finally:
+        # Clean up on disconnect, or when the handler failed
+        manager.disconnect(websocket)
         
         # Remove user from voice channel participants
-        voice_users = manager.leave_voice_channel(channel_id, user_info)
-        
-        # Notify all channel members of the updated voice participants
-        voice_update = {
-            "type": "voice_users_update",
-            "data": {
-                "channel_id": channel_id,
-                "users": voice_users,
-                "timestamp": datetime.now().isoformat()
-            }
-        }
-        await manager.broadcast(json.dumps(voice_update), channel_id)
+        if entered:
+            manager.presence.offline(channel_id, user.id)
@@ -0,0 +1,81 @@
+"""Wire encodings for WebSocket clients, negotiated per socket.
+
+Frames are built once as JSON (see frames.py). JSON clients get them as text
+messages, or as binary ones with ?binary=true. Clients that offer the
+"ankachat.msgpack" subprotocol get MessagePack in binary messages and send
+MessagePack themselves; each frame is converted once and the result shared
+by every MessagePack recipient. Coalesced batches are a JSON array or a
+MessagePack array either way.
+
+A client lists the encodings it accepts in Sec-WebSocket-Protocol, in order
+of preference; the server picks the first it supports and echoes it back.
+"""
+from typing import List, Optional, Union
+import struct
+from ..utils.codecs import loads
+from .frames import Frame
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_SUBPROTOCOL = "ankachat.json"
+MSGPACK_SUBPROTOCOL = "ankachat.msgpack"
+
+class JSONCodec:
+    name = "JSON"
+
+    def __init__(self, binary: bool = False, subprotocol: Optional[str] = None):
+        self.binary = binary
+        self.subprotocol = subprotocol
+
+    def encode(self, frame: Frame) -> Union[str, bytes]:
+        return frame.data if self.binary else frame.text
+
+    def encode_batch(self, frames: List[Frame]) -> Union[str, bytes]:
+        data = b"[" + b",".join(frame.data for frame in frames) + b"]"
+        return data if self.binary else data.decode("utf-8")
+
+    def decode(self, data: Union[str, bytes]):
+        return loads(data)
+
+def _array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 0x10000:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+class MsgpackCodec:
+    name = "MessagePack"
+    binary = True
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, frame: Frame) -> bytes:
+        if frame.packed is None:
+            frame.packed = msgpack.packb(loads(frame.data))
+        return frame.packed
+
+    def encode_batch(self, frames: List[Frame]) -> bytes:
+        # An array is its header followed by the packed items: no re-encoding
+        return _array_header(len(frames)) + b"".join(self.encode(frame) for frame in frames)
+
+    def decode(self, data: Union[str, bytes]):
+        if isinstance(data, str):
+            # Text messages are JSON even on a MessagePack socket
+            return loads(data)
+        try:
+            return msgpack.unpackb(data)
+        except Exception as exc:
+            # Malformed input surfaces as a ValueError, like a JSON decode error
+            raise ValueError(f"Invalid MessagePack: {exc}") from exc
+
+def negotiate(offered: List[str], binary: bool = False) -> Union[JSONCodec, MsgpackCodec]:
+    # The first offered subprotocol we support; plain JSON if there is none
+    for protocol in offered:
+        if protocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+            return MsgpackCodec()
+        if protocol == JSON_SUBPROTOCOL:
+            return JSONCodec(binary, JSON_SUBPROTOCOL)
+    return JSONCodec(binary)
@@ -1,64 +1,541 @@
-from fastapi import WebSocket
-from typing import Dict, List, Set
-import json
+from fastapi import WebSocket, WebSocketDisconnect
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from dotenv import load_dotenv
+from datetime import datetime
+import asyncio
+import logging
+import os
+import time
+import uuid
+from ..utils.codecs import loads
+from ..utils.history_cache import history_cache
+from ..utils.metrics import FANOUT_BUCKETS, metrics
+from ..utils.tracing import tracer
+from .broker import Broker, Replay, create_broker
+from .codecs import JSONCodec, MsgpackCodec, negotiate
+from .frames import Frame, as_frame
+from .persistence import message_writer
+from .presence import PresenceEngine
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Outbound queue settings for each connection
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do when a client's queue is full: "drop_oldest" or "disconnect"
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# Number of overflows tolerated before a slow client is disconnected
+MAX_OVERFLOWS = int(os.getenv("WS_MAX_OVERFLOWS", "3"))
+
+# Longest coalescing window a client may ask for, in milliseconds
+COALESCE_MAX_MS = int(os.getenv("WS_COALESCE_MAX_MS", "50"))
+# Largest coalesced frame; a batch is flushed early once this much is queued
+COALESCE_MAX_BYTES = int(os.getenv("WS_COALESCE_MAX_BYTES", "65536"))
+
+# Close code sent to clients that cannot keep up (RFC 6455 "Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# How a chat_message event starts its type field in a frame (see frames.py)
+CHAT_MESSAGE_MARKER = b'"type":"chat_message"'
+
+# Messages published by this worker still waiting for their sequence number; the oldest
+# are forgotten past this (their events were lost with a broker connection)
+UNSEQUENCED_MAX = 10000
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+class ClientConnection:
+    """Outbound side of a WebSocket: a bounded queue drained by a dedicated writer task.
+
+    With a coalescing window, the writer waits up to that long after the first
+    queued event (or until coalesce_bytes are queued) and sends everything
+    collected as one array frame instead of one frame per event.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        queue_size: int = SEND_QUEUE_SIZE,
+        codec: Union[JSONCodec, MsgpackCodec] = None,
+        coalesce_ms: int = 0,
+        coalesce_bytes: int = COALESCE_MAX_BYTES,
+        kind: str = "chat"
+    ):
+        self.websocket = websocket
+        # Which endpoint the socket came in on: "chat", "voice" or "gateway"
+        self.kind = kind
+        # Channels this connection receives events for (one, or many for gateway sockets)
+        self.channels: Set[int] = set()
+        # Identifies the connection in events relayed through the broker
+        self.id = uuid.uuid4().hex
+        # Wire encoding negotiated at connect time (see codecs.py)
+        self.codec = codec or JSONCodec()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.overflows = 0
+        self.closed = False
+        self.writer: asyncio.Task = None
+        # Live (seq, frame) pairs held back, by channel, while missed events are replayed
+        self.pending: Dict[int, List[Tuple[Optional[int], Frame]]] = {}
+
+        self.coalesce_window = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        # Bytes waiting in the queue, and a frame that did not fit in the last batch
+        self.queued_bytes = 0
+        self.carry: Frame = None
+        # Resolved by the window timer, or early once coalesce_bytes are queued
+        self.flush: asyncio.Future = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    async def _next(self) -> Frame:
+        if self.carry is not None:
+            frame, self.carry = self.carry, None
+            return frame
+        frame = await self.queue.get()
+        self.queued_bytes -= len(frame)
+        return frame
+
+    async def _coalesce(self, first: Frame) -> List[Frame]:
+        batch = [first]
+        size = len(first)
+        if size + self.queued_bytes < self.coalesce_bytes:
+            # Give more events a chance to arrive, unless enough are queued already.
+            # A bare future and timer: much cheaper per batch than wait_for()
+            loop = asyncio.get_running_loop()
+            self.flush = loop.create_future()
+            timer = loop.call_later(self.coalesce_window, _resolve, self.flush)
+            try:
+                await self.flush
+            finally:
+                timer.cancel()
+                self.flush = None
+        while not self.queue.empty():
+            frame = self.queue.get_nowait()
+            self.queued_bytes -= len(frame)
+            if size + len(frame) > self.coalesce_bytes:
+                self.carry = frame
+                break
+            batch.append(frame)
+            size += len(frame) + 1
+        return batch
+
+    def _queued(self, frame: Frame):
+        self.queued_bytes += len(frame)
+        if self.flush is not None and self.queued_bytes >= self.coalesce_bytes:
+            _resolve(self.flush)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                frame = await self._next()
+                if self.coalesce_window:
+                    payload = self.codec.encode_batch(await self._coalesce(frame))
+                else:
+                    payload = self.codec.encode(frame)
+                if self.codec.binary:
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            # A failing socket only stops its own writer
+            logger.debug("Writer for %r stopped: %s", self.websocket, exc)
+            self.closed = True
+
+    def enqueue(self, frame: Frame) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            return False
+        self._queued(frame)
+        return True
+
+    async def put(self, frame: Frame) -> bool:
+        # Wait for room instead of dropping: replays must arrive complete
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.queue.put(frame), 1.0)
+                self._queued(frame)
+                return True
+            except asyncio.TimeoutError:
+                continue
+        return False
+
+    def drop_oldest(self):
+        try:
+            self.queued_bytes -= len(self.queue.get_nowait())
+        except asyncio.QueueEmpty:
+            pass
+
+    def stop(self):
+        self.closed = True
+        if self.writer and not self.writer.done():
+            self.writer.cancel()
+        # Frames nobody will send any more: release them now rather than with the last reference to the socket
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queued_bytes = 0
+        self.carry = None
+        self.pending.clear()
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        queue_size: int = SEND_QUEUE_SIZE,
+        slow_consumer_policy: str = SLOW_CONSUMER_POLICY,
+        max_overflows: int = MAX_OVERFLOWS,
+        broker: Broker = None
+    ):
+        if slow_consumer_policy not in ("drop_oldest", "disconnect"):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+
         # Dictionary to store active connections by channel ID
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        # Connections by channel ID and user ID, for targeted sends
+        self.user_connections: Dict[int, Dict[int, Set[WebSocket]]] = {}
         # Dictionary to store user information by connection
         self.connection_user: Dict[WebSocket, dict] = {}
-        # Set to track users in voice channels
-        self.voice_users: Dict[int, Set[dict]] = {}
-    
-    async def connect(self, websocket: WebSocket, channel_id: int, user_info: dict):
-        await websocket.accept()
-        if channel_id not in self.active_connections:
-            self.active_connections[channel_id] = []
-        self.active_connections[channel_id].append(websocket)
+        # Outbound queue and writer task by connection
+        self.outbound: Dict[WebSocket, ClientConnection] = {}
+        # Channel events and presence are shared with other workers through the broker
+        self.broker = broker or create_broker()
+        self.broker_loop: asyncio.AbstractEventLoop = None
+        # Online users of text channels and participants of voice channels
+        self.presence = PresenceEngine(self)
+        # Ids of chat messages published here whose sequence number is still to be stored
+        self.unsequenced: OrderedDict = OrderedDict()
+
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_overflows = max_overflows
+        # How often each slow consumer policy kicked in
+        self.stats = {
+            "dropped_messages": 0,
+            "overflows": 0,
+            "slow_disconnects": 0,
+        }
+        # Recipients and enqueueing time of each event delivered to this worker's sockets
+        self.fanout = metrics.histogram(
+            "ankachat_broadcast_fanout", "Local sockets an event was delivered to", buckets=FANOUT_BUCKETS
+        )
+        self.delivery_seconds = metrics.histogram(
+            "ankachat_broadcast_delivery_seconds", "Time to hand an event to every local recipient's queue"
+        )
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.broker_loop is not loop:
+            self.broker_loop = loop
+            await self.broker.start(self._deliver)
+            self.presence.start()
+
+    async def stop(self):
+        if self.broker_loop is not None:
+            await self.presence.stop()
+            await self.broker.stop()
+            self.broker_loop = None
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        channel_id: int,
+        user_info: dict,
+        binary: bool = False,
+        resume: bool = False,
+        coalesce_ms: int = 0,
+        kind: str = "chat"
+    ):
+        # A socket bound to a single channel
+        await self.connect_gateway(websocket, user_info, binary, coalesce_ms, kind)
+        self.subscribe(websocket, channel_id, resume)
+
+    async def connect_gateway(
+        self,
+        websocket: WebSocket,
+        user_info: dict,
+        binary: bool = False,
+        coalesce_ms: int = 0,
+        kind: str = "gateway"
+    ):
+        # A socket that subscribes to channels later on
+        await self.start()
+        # The client picks its encoding through the WebSocket subprotocol
+        codec = negotiate(websocket.scope.get("subprotocols", []), binary)
+        await websocket.accept(subprotocol=codec.subprotocol)
         self.connection_user[websocket] = user_info
-    
-    def disconnect(self, websocket: WebSocket, channel_id: int):
+
+        # The client picks its coalescing window at connect time, within the server's bound
+        coalesce_ms = max(0, min(coalesce_ms, COALESCE_MAX_MS))
+        client = ClientConnection(websocket, self.queue_size, codec, coalesce_ms, kind=kind)
+        client.start()
+        self.outbound[websocket] = client
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        """The next message from a client, decoded with its codec.
+
+        Raises WebSocketDisconnect when the client goes away and ValueError
+        for a message that does not decode.
+        """
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        client = self.outbound.get(websocket)
+        codec = client.codec if client is not None else JSONCodec()
+        data = message.get("text")
+        return codec.decode(data if data is not None else message.get("bytes"))
+
+    def codec_name(self, websocket: WebSocket) -> str:
+        client = self.outbound.get(websocket)
+        return client.codec.name if client is not None else JSONCodec.name
+
+    def subscribe(self, websocket: WebSocket, channel_id: int, resume: bool = False):
+        client = self.outbound.get(websocket)
+        if client is None:
+            return
+        if channel_id not in self.active_connections:
+            self.active_connections[channel_id] = set()
+            self.user_connections[channel_id] = {}
+            # Only receive events for channels that have local sockets
+            self.broker.subscribe(channel_id)
+        self.active_connections[channel_id].add(websocket)
+        self.user_connections[channel_id].setdefault(self.connection_user[websocket].get("id"), set()).add(websocket)
+        client.channels.add(channel_id)
+        if resume:
+            # Hold live events until resume() has sent the missed ones
+            client.pending[channel_id] = []
+
+    def unsubscribe(self, websocket: WebSocket, channel_id: int):
+        client = self.outbound.get(websocket)
+        if client is not None:
+            client.channels.discard(channel_id)
+            client.pending.pop(channel_id, None)
+
         if channel_id in self.active_connections:
-            if websocket in self.active_connections[channel_id]:
-                self.active_connections[channel_id].remove(websocket)
+            self.active_connections[channel_id].discard(websocket)
+            user_info = self.connection_user.get(websocket)
+            if user_info is not None:
+                users = self.user_connections[channel_id]
+                user_sockets = users.get(user_info.get("id"))
+                if user_sockets is not None:
+                    user_sockets.discard(websocket)
+                    if not user_sockets:
+                        del users[user_info.get("id")]
             # Clean up empty channels
             if not self.active_connections[channel_id]:
                 del self.active_connections[channel_id]
-        
-        if websocket in self.connection_user:
-            del self.connection_user[websocket]
-    
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-    
-    async def broadcast(self, message: str, channel_id: int, exclude: WebSocket = None):
-        if channel_id in self.active_connections:
-            for connection in self.active_connections[channel_id]:
-                if connection != exclude:
-                    await connection.send_text(message)
-    
-    # Voice channel management
-    def join_voice_channel(self, channel_id: int, user_info: dict):
-        if channel_id not in self.voice_users:
-            self.voice_users[channel_id] = set()
-        self.voice_users[channel_id].add(json.dumps(user_info))
-        return self.get_voice_users(channel_id)
-    
-    def leave_voice_channel(self, channel_id: int, user_info: dict):
-        if channel_id in self.voice_users:
-            user_json = json.dumps(user_info)
-            if user_json in self.voice_users[channel_id]:
-                self.voice_users[channel_id].remove(user_json)
-            # Clean up empty channels
-            if not self.voice_users[channel_id]:
-                del self.voice_users[channel_id]
-        return self.get_voice_users(channel_id)
-    
-    def get_voice_users(self, channel_id: int):
-        if channel_id not in self.voice_users:
-            return []
-        return [json.loads(user_json) for user_json in self.voice_users[channel_id]]
+                del self.user_connections[channel_id]
+                self.broker.unsubscribe(channel_id)
+
+    def subscriptions(self, websocket: WebSocket) -> Set[int]:
+        client = self.outbound.get(websocket)
+        return set(client.channels) if client is not None else set()
+
+    def disconnect(self, websocket: WebSocket):
+        client = self.outbound.get(websocket)
+        if client is not None:
+            for channel_id in list(client.channels):
+                self.unsubscribe(websocket, channel_id)
+            del self.outbound[websocket]
+            client.stop()
+        self.connection_user.pop(websocket, None)
+
+    def _enqueue(self, websocket: WebSocket, frame: Frame):
+        client = self.outbound.get(websocket)
+        if client is None or client.closed:
+            return
+
+        if client.enqueue(frame):
+            return
+
+        # The client's queue is full: apply the slow consumer policy
+        if self.slow_consumer_policy == "drop_oldest":
+            client.drop_oldest()
+            client.enqueue(frame)
+            self.stats["dropped_messages"] += 1
+            return
+
+        client.overflows += 1
+        self.stats["overflows"] += 1
+        self.stats["dropped_messages"] += 1
+        if client.overflows >= self.max_overflows:
+            self.stats["slow_disconnects"] += 1
+            self._drop_slow_consumer(client)
+
+    def _hold(self, client: ClientConnection, pending: list, seq: Optional[int], frame: Frame):
+        if len(pending) < self.queue_size:
+            pending.append((seq, frame))
+            return
+
+        # A resume that cannot keep up holds no more than a send queue's worth: same slow consumer policy
+        if self.slow_consumer_policy == "drop_oldest":
+            pending.pop(0)
+            pending.append((seq, frame))
+            self.stats["dropped_messages"] += 1
+            return
+
+        client.overflows += 1
+        self.stats["overflows"] += 1
+        self.stats["dropped_messages"] += 1
+        if client.overflows >= self.max_overflows:
+            self.stats["slow_disconnects"] += 1
+            self._drop_slow_consumer(client)
+
+    def _drop_slow_consumer(self, client: ClientConnection):
+        client.stop()
+        self.disconnect(client.websocket)
+        asyncio.create_task(self._close(client.websocket))
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+    async def send_personal_message(self, message: Union[Frame, str], websocket: WebSocket):
+        self._enqueue(websocket, as_frame(message))
+
+    async def broadcast(
+        self,
+        message: Union[Frame, str],
+        channel_id: int,
+        exclude: WebSocket = None,
+        message_id: int = None
+    ):
+        # Serialize once; the broker numbers the event and hands the same frame to every
+        # worker with sockets in the channel, including this one. Delivery only enqueues,
+        # each connection's writer task does the actual send
+        exclude_id = self.outbound[exclude].id if exclude in self.outbound else None
+        with tracer.span("broadcast", channel_id=channel_id):
+            frame = as_frame(message).with_field("channel_id", channel_id)
+            if message_id is not None:
+                self.unsequenced[message_id] = channel_id
+                while len(self.unsequenced) > UNSEQUENCED_MAX:
+                    self.unsequenced.popitem(last=False)
+            self.broker.publish(channel_id, frame, exclude_id, message_id=message_id)
+            await self.broker.drain()
+
+    async def send_to_user(self, message: Union[Frame, str], channel_id: int, user_id: int):
+        # Reaches the user's sockets in the channel on whichever worker holds them
+        with tracer.span("broadcast", channel_id=channel_id, target_user_id=user_id):
+            frame = as_frame(message).with_field("channel_id", channel_id)
+            self.broker.publish(channel_id, frame, target_user_id=user_id)
+            await self.broker.drain()
+
+    def _deliver(
+        self,
+        channel_id: int,
+        frame: Frame,
+        exclude: Optional[str],
+        target_user_id: Optional[int],
+        seq: Optional[int] = None,
+        message_id: Optional[int] = None
+    ):
+        if target_user_id is None:
+            self._remember(channel_id, frame)
+        if message_id is not None and self.unsequenced.pop(message_id, None) is not None:
+            # Every worker sees the message id; the one that published the message stores the seq
+            message_writer.sequence(message_id, seq)
+        if target_user_id is not None:
+            # Only the target's own sockets in the channel, found without scanning
+            connections = self.user_connections.get(channel_id, {}).get(target_user_id, ())
+        else:
+            connections = self.active_connections.get(channel_id, ())
+
+        start = time.perf_counter()
+        recipients = 0
+        for connection in list(connections):
+            client = self.outbound.get(connection)
+            if client is None or client.id == exclude:
+                continue
+            recipients += 1
+            pending = client.pending.get(channel_id)
+            if pending is not None:
+                self._hold(client, pending, seq, frame)
+                continue
+            self._enqueue(connection, frame)
+        self.delivery_seconds.observe(time.perf_counter() - start)
+        self.fanout.observe(recipients)
+        # The broadcast span, when delivery happens on this worker while publishing
+        tracer.current().set("recipients", recipients)
+
+    def _remember(self, channel_id: int, frame: Frame):
+        # Messages posted on other workers reach this one's history cache through the broker
+        # too (this worker's own are already there). Compact JSON: the marker cannot occur
+        # inside a string value, where quotes are escaped
+        if CHAT_MESSAGE_MARKER not in frame.data:
+            return
+        try:
+            message = dict(loads(frame.data)["data"])
+            message["created_at"] = datetime.fromisoformat(message["created_at"])
+        except (ValueError, KeyError, TypeError):
+            logger.debug("Unreadable chat_message frame for channel %s", channel_id)
+            history_cache.drop(channel_id)
+            return
+        history_cache.add(channel_id, message)
+
+    async def replay(self, channel_id: int, since: int) -> Optional[Replay]:
+        return await self.broker.replay(channel_id, since)
+
+    async def resume(
+        self,
+        websocket: WebSocket,
+        channel_id: int,
+        missed: List[Tuple[int, Frame]],
+        last_seq: Optional[int]
+    ):
+        # Send the channel's missed events, then the live ones held back meanwhile, skipping
+        # any already covered by the replay. Without last_seq every held event is sent
+        client = self.outbound.get(websocket)
+        if client is None:
+            return
+        try:
+            for seq, frame in missed:
+                if not await client.put(frame):
+                    return
+                last_seq = seq
+            pending = client.pending.get(channel_id)
+            while pending:
+                seq, frame = pending.pop(0)
+                if seq is None or last_seq is None or seq > last_seq:
+                    if not await client.put(frame):
+                        return
+        finally:
+            # Live events go straight to the queue again, also when the replay stopped short
+            client.pending.pop(channel_id, None)
+
+    def end_resume(self, websocket: WebSocket, channel_id: int):
+        # Give up on a resume that failed before resume() ran: stop holding live events back
+        client = self.outbound.get(websocket)
+        if client is not None:
+            client.pending.pop(channel_id, None)
+
+    def queue_depths(self) -> Dict[WebSocket, int]:
+        return {websocket: client.queue.qsize() for websocket, client in self.outbound.items()}
+
+    def connection_counts(self) -> Dict[Tuple[str, str], int]:
+        # Open sockets by (kind, encoding)
+        counts = {}
+        for client in list(self.outbound.values()):
+            key = (client.kind, client.codec.name)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def queue_totals(self) -> dict:
+        # Outbound queues across all sockets: frames and bytes waiting, and the deepest queue
+        depths = [(client.queue.qsize(), client.queued_bytes) for client in list(self.outbound.values())]
+        return {
+            "frames": sum(depth for depth, _ in depths),
+            "bytes": sum(size for _, size in depths),
+            "max": max((depth for depth, _ in depths), default=0),
+        }
 
 
 # Create a global connection manager instance
@@ -0,0 +1,56 @@
+from typing import Union
+from ..utils.codecs import dumps
+from ..utils.tracing import tracer
+
+class Frame:
+    """An outbound event serialized once and shared unchanged by every recipient.
+
+    The payload is kept as UTF-8 JSON bytes. Text-mode sockets get the decoded
+    string and MessagePack sockets a conversion of it (see codecs.py), each built
+    at most once per frame; binary-mode sockets get the bytes as-is, so a large
+    channel pays the encoding cost once instead of once per recipient.
+    """
+
+    __slots__ = ("data", "_text", "packed")
+
+    def __init__(self, data: bytes, text: str = None):
+        self.data = data
+        self._text = text
+        # MessagePack encoding, filled in by the first MessagePack socket that sends the frame
+        self.packed: bytes = None
+
+    @classmethod
+    def from_event(cls, event: dict) -> "Frame":
+        with tracer.span("encode", event=event.get("type")):
+            return cls(dumps(event))
+
+    @classmethod
+    def from_text(cls, text: str) -> "Frame":
+        return cls(text.encode("utf-8"), text)
+
+    def with_field(self, name: str, value) -> "Frame":
+        # Splice a top-level key in first, without re-encoding the event
+        if not self.data.startswith(b"{"):
+            return self
+        separator = b"," if self.data[1:2] != b"}" else b""
+        field = dumps({name: value})[:-1]
+        return Frame(field + separator + self.data[1:])
+
+    def with_seq(self, seq: int) -> "Frame":
+        return self.with_field("seq", seq)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.data.decode("utf-8")
+        return self._text
+
+    def __len__(self):
+        return len(self.data)
+
+def as_frame(message: Union[Frame, str, dict]) -> Frame:
+    if isinstance(message, Frame):
+        return message
+    if isinstance(message, str):
+        return Frame.from_text(message)
+    return Frame.from_event(message)
@@ -0,0 +1,231 @@
+"""One WebSocket per client, multiplexing any number of channels.
+
+The client authenticates once when connecting to /ws/gateway, then sends:
+
+    {"type": "subscribe", "channel_id": 3, "since": 1234}   # since is optional
+    {"type": "subscribe", "server_id": 1}                   # every channel of the server
+    {"type": "unsubscribe", "channel_id": 3}                # or "server_id"
+    {"type": "chat_message", "channel_id": 3, "data": {"content": "hi"}}
+    {"type": "voice_join", "channel_id": 4}
+    {"type": "voice_leave", "channel_id": 4}
+    {"type": "offer" | "answer" | "ice-candidate", "channel_id": 4, ...}
+
+Connecting with ?coalesce_ms=N batches outbound events into arrays, and
+offering the "ankachat.msgpack" subprotocol switches the socket to
+MessagePack (see codecs.py), as on the per-channel sockets.
+
+Every event delivered to the socket carries a top-level "channel_id" so the
+client can route it. Subscribing to a text channel or joining a voice
+channel sends a presence_snapshot; presence_update diffs follow. Subscriptions are answered with "subscribed" /
+"unsubscribed" events, and failures with "error" events carrying the same
+codes the per-channel sockets close with.
+"""
+from fastapi import WebSocket, WebSocketDisconnect
+from sqlalchemy import select
+from typing import Dict, List, Set, Tuple
+from ..database import AsyncSessionLocal
+from ..models import Channel
+from ..schemas.auth import Principal
+from ..utils.membership import membership
+from .chat import (
+    chat_content, check_channel_access, enter_presence, error_event, get_user_from_token, invalid_message_event,
+    post_chat_message, relay_signal, resume_connection, valid_sequence
+)
+from .connection_manager import manager
+from .frames import Frame
+
+SIGNAL_TYPES = ("offer", "answer", "ice-candidate")
+
+class GatewaySession:
+    """Per-socket state of a gateway connection."""
+
+    def __init__(self, websocket: WebSocket, user: Principal):
+        self.websocket = websocket
+        self.user = user
+        self.user_info = {
+            "id": user.id,
+            "username": user.username
+        }
+        # Subscribed channel ID -> channel type
+        self.channels: Dict[int, str] = {}
+        # Voice channels the user is taking part in
+        self.voice_channels: Set[int] = set()
+        # Text channels the user was counted present in; only these are left on the way out
+        self.present: Set[int] = set()
+
+    async def send(self, frame: Frame):
+        await manager.send_personal_message(frame, self.websocket)
+
+    async def _lookup(self, message: dict) -> List[Tuple[int, str]]:
+        # Resolve a subscribe/unsubscribe target to (channel_id, type) pairs the user may see
+        async with AsyncSessionLocal() as db:
+            server_id = message.get("server_id")
+            if server_id is not None:
+                if not isinstance(server_id, int):
+                    await self.send(error_event("Invalid server_id", code=4000))
+                    return []
+                if not await membership.is_member(db, server_id, self.user.id):
+                    await self.send(error_event("Cannot subscribe to server", code=4003, server_id=server_id))
+                    return []
+                result = await db.execute(select(Channel.id, Channel.type).where(Channel.server_id == server_id))
+                return [(channel_id, channel_type) for channel_id, channel_type in result.all()]
+
+            channel_id = message.get("channel_id")
+            if not isinstance(channel_id, int):
+                await self.send(error_event("Invalid channel_id", code=4000))
+                return []
+            channel, code = await check_channel_access(db, self.user.id, channel_id)
+            if code:
+                await self.send(error_event("Cannot subscribe to channel", code=code, channel_id=channel_id))
+                return []
+            return [(channel.id, channel.type)]
+
+    async def subscribe(self, message: dict):
+        # Resuming only makes sense for a single channel
+        since = message.get("since") if "channel_id" in message else None
+        if since is not None and not valid_sequence(since):
+            await self.send(error_event("Invalid since", code=4000))
+            return
+
+        channels = await self._lookup(message)
+        if not channels:
+            return
+
+        added = [(channel_id, channel_type) for channel_id, channel_type in channels if channel_id not in self.channels]
+        for channel_id, channel_type in added:
+            manager.subscribe(self.websocket, channel_id, resume=since is not None)
+            self.channels[channel_id] = channel_type
+
+        await self.send(Frame.from_event({
+            "type": "subscribed",
+            "data": {
+                "channels": [{"id": channel_id, "type": channel_type} for channel_id, channel_type in channels]
+            }
+        }))
+
+        for channel_id, channel_type in added:
+            if since is not None:
+                await resume_connection(self.websocket, channel_id, since)
+            if channel_type == "text":
+                # Notify all channel members that a new user connected
+                await enter_presence(self.websocket, channel_id, self.user_info)
+                self.present.add(channel_id)
+
+    async def unsubscribe(self, message: dict):
+        if message.get("server_id") is not None:
+            channel_ids = [channel_id for channel_id, _ in await self._lookup(message)]
+        else:
+            channel_ids = [message.get("channel_id")]
+
+        removed = [channel_id for channel_id in channel_ids if channel_id in self.channels]
+        for channel_id in removed:
+            await self._leave(channel_id)
+
+        await self.send(Frame.from_event({
+            "type": "unsubscribed",
+            "data": {
+                "channel_ids": removed
+            }
+        }))
+
+    async def _leave(self, channel_id: int):
+        channel_type = self.channels.pop(channel_id)
+        manager.unsubscribe(self.websocket, channel_id)
+        if channel_id in self.voice_channels:
+            await self.voice_leave(channel_id)
+        if channel_id in self.present:
+            # Notify all channel members that the user left
+            self.present.discard(channel_id)
+            manager.presence.offline(channel_id, self.user.id)
+
+    async def voice_join(self, channel_id: int):
+        if self.channels.get(channel_id) != "voice":
+            await self.send(error_event("Not subscribed to this voice channel", code=4000, channel_id=channel_id))
+            return
+        if channel_id in self.voice_channels:
+            return
+        await enter_presence(self.websocket, channel_id, self.user_info)
+        self.voice_channels.add(channel_id)
+
+    async def voice_leave(self, channel_id: int):
+        if channel_id not in self.voice_channels:
+            return
+        self.voice_channels.discard(channel_id)
+        manager.presence.offline(channel_id, self.user.id)
+
+    async def handle(self, message: dict):
+        message_type = message.get("type")
+        channel_id = message.get("channel_id")
+        # Check if the channel ID can be looked up at all; unhashable values would raise
+        if channel_id is not None and not isinstance(channel_id, int):
+            await self.send(error_event("Invalid channel_id", code=4000))
+            return
+
+        if message_type == "subscribe":
+            await self.subscribe(message)
+        elif message_type == "unsubscribe":
+            await self.unsubscribe(message)
+        elif message_type == "chat_message":
+            if self.channels.get(channel_id) != "text":
+                await self.send(error_event("Not subscribed to this text channel", code=4000, channel_id=channel_id))
+                return
+            content = chat_content(message)
+            if content is None:
+                await self.send(error_event("Invalid chat message", code=4000, channel_id=channel_id))
+            elif content:
+                await post_chat_message(self.websocket, self.user, channel_id, content)
+        elif message_type == "voice_join":
+            await self.voice_join(channel_id)
+        elif message_type == "voice_leave":
+            await self.voice_leave(channel_id)
+        elif message_type in SIGNAL_TYPES:
+            if channel_id not in self.voice_channels:
+                await self.send(error_event("Not in this voice channel", code=4000, channel_id=channel_id))
+                return
+            await relay_signal(self.websocket, self.user_info, channel_id, message)
+
+    async def close(self):
+        # Clean up on disconnect
+        manager.disconnect(self.websocket)
+        for channel_id in list(self.voice_channels):
+            await self.voice_leave(channel_id)
+        for channel_id in self.present:
+            manager.presence.offline(channel_id, self.user.id)
+        self.present.clear()
+        self.channels.clear()
+
+async def handle_gateway_connection(websocket: WebSocket, token: str, binary: bool = False, coalesce_ms: int = 0):
+    # Authenticate once for every channel the socket will carry
+    async with AsyncSessionLocal() as db:
+        user = await get_user_from_token(token, db)
+    if not user:
+        await websocket.close(code=4001)  # Unauthorized
+        return
+
+    session = GatewaySession(websocket, user)
+    await manager.connect_gateway(websocket, session.user_info, binary, coalesce_ms)
+
+    try:
+        await session.send(Frame.from_event({
+            "type": "ready",
+            "data": {
+                "user": session.user_info
+            }
+        }))
+
+        while True:
+            try:
+                message = await manager.receive(websocket)
+            except ValueError:
+                # Send error message back to the user
+                await session.send(invalid_message_event(websocket))
+                continue
+
+            if isinstance(message, dict):
+                await session.handle(message)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # However the session ended: its subscriptions, writer task and presence must not outlive it
+        await session.close()
@@ -0,0 +1,259 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+from sqlalchemy import bindparam, update
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import time
+from ..database import SessionLocal
+from ..models import Message
+from ..utils.metrics import metrics
+from ..utils.search import search_index
+from ..utils.tracing import tracer
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# A batch is written when it reaches this many messages...
+WRITE_BATCH_SIZE = int(os.getenv("WS_WRITE_BATCH_SIZE", "64"))
+# ...or when its oldest message has waited this long
+WRITE_BATCH_DELAY_MS = float(os.getenv("WS_WRITE_BATCH_DELAY_MS", "5"))
+# Messages that may wait for the writer; senders wait this long for room before the
+# message is refused
+WRITE_QUEUE_SIZE = int(os.getenv("WS_WRITE_QUEUE_SIZE", "1024"))
+WRITE_QUEUE_TIMEOUT_MS = float(os.getenv("WS_WRITE_QUEUE_TIMEOUT_MS", "1000"))
+
+class WriterBusy(Exception):
+    """The write queue stayed full; the message was not saved."""
+
+class MessageWriter:
+    """Write-behind persistence stage for chat messages.
+
+    Messages from every channel are queued and written in batches, one
+    transaction per batch, on a dedicated thread so the event loop never
+    waits on a commit. Each caller awaits its own future, which resolves to
+    the saved Message once its batch is committed. A batch that fails is
+    written again one message at a time, so only the messages that cannot
+    be saved fail. The queue is bounded: a sender waits for room, and gets
+    WriterBusy if the writer does not catch up in time.
+
+    Once a message is published, the broker's sequence number for it is
+    stored on the row as well (see sequence()), on the same thread.
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        batch_size: int = WRITE_BATCH_SIZE,
+        batch_delay_ms: float = WRITE_BATCH_DELAY_MS,
+        queue_size: int = WRITE_QUEUE_SIZE,
+        queue_timeout_ms: float = WRITE_QUEUE_TIMEOUT_MS
+    ):
+        self.session_factory = session_factory
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = max(0.0, batch_delay_ms) / 1000
+        self.queue_size = max(1, queue_size)
+        self.queue_timeout = max(0.0, queue_timeout_ms) / 1000
+        self.queue: asyncio.Queue = None
+        self.task: asyncio.Task = None
+        self.loop: asyncio.AbstractEventLoop = None
+        # Sequence numbers waiting to be stored, as update parameters
+        self.sequenced: List[Dict[str, int]] = []
+        self.sequenced_ready: asyncio.Event = None
+        self.sequence_task: asyncio.Task = None
+        # A single writer thread keeps batches in order and suits SQLite's single writer
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-writer")
+        self.stats = {
+            "batches": 0,
+            "messages": 0,
+            "errors": 0,
+            "retried": 0,
+            "failed": 0,
+            "rejected": 0,
+        }
+        self.batch_seconds = metrics.histogram(
+            "ankachat_persist_batch_seconds", "Time to write and commit one batch of chat messages"
+        )
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.sequenced_ready = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+            self.sequence_task = asyncio.create_task(self._run_sequences())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        # Flush whatever is still queued before shutting down
+        await self.queue.join()
+        for task in (self.task, self.sequence_task):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Also waits for sequence numbers already being written: the thread runs jobs in order
+        await self._write_sequenced(wait=True)
+        self.task = None
+        self.sequence_task = None
+
+    async def save(self, content: str, user_id: int, channel_id: int) -> Message:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        message = Message(
+            content=content,
+            user_id=user_id,
+            channel_id=channel_id,
+            # Set here rather than by the server default, to avoid a refresh per row
+            created_at=datetime.utcnow()
+        )
+        try:
+            # Backpressure: the sender's socket stops being read while it waits for room
+            await asyncio.wait_for(self.queue.put((message, future)), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            raise WriterBusy()
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[Message, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_delay
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            messages = [message for message, _ in batch]
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(self.executor, self._write_batch, messages)
+            except Exception:
+                logger.exception("Failed to persist a batch of %d messages", len(batch))
+                self.stats["errors"] += 1
+                await self._write_one_by_one(batch)
+                continue
+
+            self.batch_seconds.observe(time.perf_counter() - start)
+            self.stats["batches"] += 1
+            self.stats["messages"] += len(batch)
+            for message, future in batch:
+                if not future.done():
+                    future.set_result(message)
+                self.queue.task_done()
+
+    async def _write_one_by_one(self, batch: List[Tuple[Message, asyncio.Future]]):
+        # Find the messages that broke the batch; the rest are saved after all
+        loop = asyncio.get_running_loop()
+        for message, future in batch:
+            # A fresh row: the rolled-back one may still carry the id it was flushed with
+            retry = Message(
+                content=message.content,
+                user_id=message.user_id,
+                channel_id=message.channel_id,
+                created_at=message.created_at
+            )
+            self.stats["retried"] += 1
+            try:
+                await loop.run_in_executor(self.executor, self._write_batch, [retry])
+            except Exception as exc:
+                logger.warning("Failed to persist a message for channel %s: %s", message.channel_id, exc)
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                self.stats["messages"] += 1
+                if not future.done():
+                    future.set_result(retry)
+            self.queue.task_done()
+
+    def sequence(self, message_id: int, seq: int):
+        # Called for messages this worker published, once the broker has numbered them
+        self.sequenced.append({"message_id": message_id, "seq": seq})
+        if self.sequenced_ready is not None:
+            self.sequenced_ready.set()
+
+    async def _run_sequences(self):
+        while True:
+            await self.sequenced_ready.wait()
+            self.sequenced_ready.clear()
+            await self._write_sequenced()
+
+    async def _write_sequenced(self, wait: bool = False):
+        rows, self.sequenced = self.sequenced, []
+        if not rows and not wait:
+            return
+        try:
+            # Shielded: stop() cancels the task, which must not cancel a write not started yet
+            await asyncio.shield(asyncio.get_running_loop().run_in_executor(self.executor, self._write_sequences, rows))
+        except Exception:
+            # Those messages are not replayed to clients resuming across a broker restart
+            logger.exception("Failed to store sequence numbers for %d messages", len(rows))
+            self.stats["errors"] += 1
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def _write_batch(self, messages: List[Message]):
+        # Keep ids and timestamps readable after the commit, without a refresh per row
+        db = self.session_factory(expire_on_commit=False)
+        try:
+            with tracer.span("persist.batch", messages=len(messages)):
+                db.add_all(messages)
+                db.flush()
+                search_index.add_sync(db, messages)
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _write_sequences(self, rows: List[Dict[str, int]]):
+        if not rows:
+            return
+        messages = Message.__table__
+        db = self.session_factory()
+        try:
+            with tracer.span("persist.sequences", messages=len(rows)):
+                # Keeps updated_at as it is: the message was not edited
+                db.execute(
+                    update(messages)
+                    .where(messages.c.id == bindparam("message_id"))
+                    .values(seq=bindparam("seq"), updated_at=messages.c.updated_at),
+                    rows
+                )
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+# Create a global message writer instance
+message_writer = MessageWriter()
@@ -0,0 +1,226 @@
+"""Channel presence: who is online in a text channel, who is in a voice channel.
+
+Connections report presence to the worker's PresenceEngine, which keeps a
+reference count per (channel, user). Every PRESENCE_TICK_MS it sends the
+net changes since the last tick to the broker, which merges the reports of
+all workers, and broadcasts one diff per channel with the users that came
+online and the ids of those that went offline. A user whose last
+connection closes is only reported gone after PRESENCE_LEAVE_GRACE_MS, so
+a disconnect followed by a quick reconnect never reaches the channel.
+
+Channels with more than PRESENCE_FULL_LIMIT users only get the count.
+"""
+from typing import Dict, List, NamedTuple, Set
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import time
+from .frames import Frame
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How often batched presence changes are sent out
+PRESENCE_TICK_MS = int(os.getenv("PRESENCE_TICK_MS", "250"))
+# How long a user may be gone before the channel hears about it
+PRESENCE_LEAVE_GRACE_MS = int(os.getenv("PRESENCE_LEAVE_GRACE_MS", "3000"))
+# Above this many users, channels get counts instead of user lists
+PRESENCE_FULL_LIMIT = int(os.getenv("PRESENCE_FULL_LIMIT", "100"))
+
+class PresenceDiff(NamedTuple):
+    added: List[dict]
+    removed: List[int]
+    count: int
+
+def presence_frame(channel_id: int, diff: PresenceDiff, full_limit: int = PRESENCE_FULL_LIMIT) -> Frame:
+    if diff.count > full_limit:
+        return Frame.from_event({
+            "type": "presence_count",
+            "data": {
+                "channel_id": channel_id,
+                "count": diff.count
+            }
+        })
+    return Frame.from_event({
+        "type": "presence_update",
+        "data": {
+            "channel_id": channel_id,
+            "added": diff.added,
+            "removed": diff.removed,
+            "count": diff.count
+        }
+    })
+
+def snapshot_frame(channel_id: int, users: List[dict], full_limit: int = PRESENCE_FULL_LIMIT) -> Frame:
+    data = {
+        "channel_id": channel_id,
+        "count": len(users)
+    }
+    if len(users) <= full_limit:
+        data["users"] = users
+    return Frame.from_event({
+        "type": "presence_snapshot",
+        "data": data
+    })
+
+class PresenceRegistry:
+    """Users present per channel across workers, remembering which subscriber reported each one."""
+
+    def __init__(self):
+        self.users: Dict[int, Dict[int, dict]] = {}
+        self.owners: Dict[int, Dict[int, set]] = {}
+
+    def update(self, channel_id: int, added: List[dict], removed: List[int], owner) -> PresenceDiff:
+        users = self.users.setdefault(channel_id, {})
+        owners = self.owners.setdefault(channel_id, {})
+        came, went = [], []
+        for user_info in added:
+            user_owners = owners.setdefault(user_info["id"], set())
+            if not user_owners:
+                users[user_info["id"]] = user_info
+                came.append(user_info)
+            user_owners.add(owner)
+        for user_id in removed:
+            user_owners = owners.get(user_id)
+            if user_owners is None:
+                continue
+            user_owners.discard(owner)
+            if not user_owners:
+                del owners[user_id]
+                del users[user_id]
+                went.append(user_id)
+        count = len(users)
+        # Clean up empty channels
+        if not users:
+            del self.users[channel_id]
+            del self.owners[channel_id]
+        return PresenceDiff(came, went, count)
+
+    def get(self, channel_id: int) -> List[dict]:
+        return list(self.users.get(channel_id, {}).values())
+
+    def drop_owner(self, owner) -> Dict[int, PresenceDiff]:
+        # Forget everything a vanished subscriber had reported
+        changed = {}
+        for channel_id, owners in list(self.owners.items()):
+            gone = [user_id for user_id, user_owners in owners.items() if owner in user_owners]
+            if gone:
+                diff = self.update(channel_id, [], gone, owner)
+                if diff.removed:
+                    changed[channel_id] = diff
+        return changed
+
+class _Local:
+    __slots__ = ("user_info", "connections", "left_at")
+
+    def __init__(self, user_info: dict):
+        self.user_info = user_info
+        self.connections = 0
+        self.left_at = 0.0
+
+class PresenceEngine:
+    """Per-worker presence tracking with debounced, batched diffs."""
+
+    def __init__(
+        self,
+        manager,
+        tick_ms: int = PRESENCE_TICK_MS,
+        leave_grace_ms: int = PRESENCE_LEAVE_GRACE_MS,
+        full_limit: int = PRESENCE_FULL_LIMIT
+    ):
+        self.manager = manager
+        self.tick = tick_ms / 1000
+        self.leave_grace = leave_grace_ms / 1000
+        self.full_limit = full_limit
+        # Local connections by channel and user
+        self.local: Dict[int, Dict[int, _Local]] = {}
+        # Users this worker has reported to the broker, by channel
+        self.reported: Dict[int, Set[int]] = {}
+        # Channels with changes not sent out yet
+        self.dirty: Set[int] = set()
+        self.task: asyncio.Task = None
+        self.stats = {
+            "diffs": 0,
+            "suppressed_flaps": 0,
+        }
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def online(self, channel_id: int, user_info: dict):
+        users = self.local.setdefault(channel_id, {})
+        entry = users.get(user_info["id"])
+        if entry is None:
+            entry = users[user_info["id"]] = _Local(user_info)
+        elif entry.connections == 0:
+            # Back within the grace period: the channel never sees the user leave
+            self.stats["suppressed_flaps"] += 1
+        entry.connections += 1
+        self.dirty.add(channel_id)
+
+    def offline(self, channel_id: int, user_id: int):
+        entry = self.local.get(channel_id, {}).get(user_id)
+        if entry is None:
+            return
+        entry.connections -= 1
+        if entry.connections <= 0:
+            entry.connections = 0
+            entry.left_at = time.monotonic()
+            self.dirty.add(channel_id)
+
+    async def snapshot(self, channel_id: int) -> Frame:
+        users = await self.manager.broker.presence_users(channel_id)
+        # Sent directly rather than broadcast, so the routing field is added here
+        return snapshot_frame(channel_id, users, self.full_limit).with_field("channel_id", channel_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+
+    async def flush(self):
+        now = time.monotonic()
+        for channel_id in list(self.dirty):
+            users = self.local.get(channel_id, {})
+            reported = self.reported.setdefault(channel_id, set())
+            added, removed = [], []
+            waiting = False
+            for user_id, entry in list(users.items()):
+                if entry.connections > 0:
+                    if user_id not in reported:
+                        added.append(entry.user_info)
+                elif now - entry.left_at < self.leave_grace:
+                    # Still within the grace period: decide on a later tick
+                    waiting = True
+                else:
+                    del users[user_id]
+                    if user_id in reported:
+                        removed.append(user_id)
+                    else:
+                        self.stats["suppressed_flaps"] += 1
+
+            if not waiting:
+                self.dirty.discard(channel_id)
+            reported.update(user_info["id"] for user_info in added)
+            reported.difference_update(removed)
+            if not users:
+                self.local.pop(channel_id, None)
+            if not reported:
+                del self.reported[channel_id]
+
+            if added or removed:
+                diff = await self.manager.broker.presence_update(channel_id, added, removed)
+                if diff.added or diff.removed:
+                    self.stats["diffs"] += 1
+                    await self.manager.broadcast(presence_frame(channel_id, diff, self.full_limit), channel_id)
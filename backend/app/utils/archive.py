@@ -0,0 +1,717 @@
+"""Cold message storage.
+
+Messages older than ARCHIVE_AFTER_DAYS are moved out of the messages table
+into append-only segment files, one per channel, by a background archiver.
+Every message at or below the archive's watermark id lives in the archive,
+everything above it in the messages table, so history reads take what they
+can from the table and continue in the archive past the watermark.
+
+Layout of ARCHIVE_DIR:
+
+    manifest.json        {"watermark": <id>, "previous": <id>}, replaced atomically after each step
+    ids.map              (message id, channel id) records in id order
+    channels/<id>.seg    zlib-compressed JSON blocks of up to ARCHIVE_BLOCK_SIZE messages
+    channels/<id>.idx    one record per block: id range, time range, offset, length
+
+Segments are never rewritten; edits and deletions of archived messages are
+kept in the message_overlays table and applied when they are read. Archived
+messages keep their entries in the search index (search.py).
+"""
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+import heapq
+from sqlalchemy import delete, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from ..database import SessionLocal
+from ..models import Message, MessageOverlay, User
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Directory for the files the server keeps besides its database; relative paths below are resolved against it
+DATA_DIR = os.path.abspath(os.getenv("DATA_DIR", os.path.join(os.path.dirname(__file__), "..", "..", "data")))
+# Where segment files are kept
+ARCHIVE_DIR = os.path.join(DATA_DIR, os.getenv("ARCHIVE_DIR", "archive"))
+# Messages older than this are archived; 0 turns the archiver off
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# How often the archiver looks for messages to move, in seconds
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+# Messages moved per step (one transaction), and per compressed block
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "50000"))
+ARCHIVE_BLOCK_SIZE = int(os.getenv("ARCHIVE_BLOCK_SIZE", "256"))
+# Decompressed blocks kept in memory
+ARCHIVE_BLOCK_CACHE = int(os.getenv("ARCHIVE_BLOCK_CACHE", "512"))
+# Channels whose overlays are kept in memory, and for how long (edits made by other worker processes)
+ARCHIVE_OVERLAY_CACHE = int(os.getenv("ARCHIVE_OVERLAY_CACHE", "1000"))
+ARCHIVE_OVERLAY_TTL = float(os.getenv("ARCHIVE_OVERLAY_TTL", "30"))
+
+# Block index record: first id, last id, first and last created_at (epoch seconds), offset, length, count
+_BLOCK = struct.Struct("<qqddQII")
+# Id map record: message id, channel id
+_ID = struct.Struct("<qq")
+
+class ArchivedMessage:
+    """An archived message with its overlay applied, shaped like Message for the routes."""
+
+    __slots__ = ("id", "content", "user_id", "channel_id", "created_at")
+
+    def __init__(self, id: int, content: Optional[str], user_id: int, channel_id: int, created_at: datetime):
+        self.id = id
+        self.content = content
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.created_at = created_at
+
+class _Blocks:
+    """Block index of one channel's segment, as far as the watermark."""
+
+    def __init__(self, records: list):
+        self.records = records
+        self.first_ids = [record[0] for record in records]
+        self.last_ids = [record[1] for record in records]
+
+def _timestamp(value: datetime) -> float:
+    return value.timestamp() if value is not None else 0.0
+
+class MessageArchive:
+    """Append-only per-channel segment storage for old messages."""
+
+    def __init__(
+        self,
+        path: str = ARCHIVE_DIR,
+        after_days: float = ARCHIVE_AFTER_DAYS,
+        interval: float = ARCHIVE_INTERVAL,
+        batch_size: int = ARCHIVE_BATCH_SIZE,
+        block_size: int = ARCHIVE_BLOCK_SIZE,
+        block_cache: int = ARCHIVE_BLOCK_CACHE,
+        overlay_cache: int = ARCHIVE_OVERLAY_CACHE,
+        overlay_ttl: float = ARCHIVE_OVERLAY_TTL,
+        session_factory=SessionLocal
+    ):
+        self.path = path
+        self.channels_path = os.path.join(path, "channels")
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.ids_path = os.path.join(path, "ids.map")
+        self.after_days = after_days
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.block_size = max(1, block_size)
+        self.block_cache_size = block_cache
+        self.session_factory = session_factory
+        # Highest archived message id, as of the manifest last read
+        self.watermark = 0
+        self.manifest_mtime = None
+        self.indexes: Dict[int, _Blocks] = {}
+        self.blocks: OrderedDict = OrderedDict()
+        # channel_id -> (expires_at, {message_id: (content, deleted)}), least recently read first
+        self.overlays: OrderedDict = OrderedDict()
+        self.overlay_cache_size = overlay_cache
+        self.overlay_ttl = overlay_ttl
+        # Bumped by every overlay change, so a lookup racing one is not cached
+        self.overlay_generation = 0
+        self.lock = threading.Lock()
+        self.lock_file = None
+        # Whether the messages table can hand out an id again, looked up by the first step
+        self.reuses_ids: Optional[bool] = None
+        self.task: asyncio.Task = None
+        # One archiver thread: steps must run in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-archiver")
+        self.stats = {
+            "archived": 0,
+            "steps": 0,
+            "blocks_written": 0,
+            "block_hits": 0,
+            "block_misses": 0,
+            "overlay_hits": 0,
+            "overlay_misses": 0,
+            "errors": 0,
+        }
+
+    # Reading
+    def current_watermark(self) -> int:
+        """Highest archived id; messages above it are still in the messages table."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+        if mtime != self.manifest_mtime:
+            with open(self.manifest_path) as manifest:
+                watermark = json.load(manifest)["watermark"]
+            with self.lock:
+                # The archive grew: block indexes are re-read on next use
+                self.watermark = watermark
+                self.manifest_mtime = mtime
+                self.indexes.clear()
+                # Archiving adds overlays for rows edited or deleted while they moved
+                self.overlays.clear()
+                self.overlay_generation += 1
+        return self.watermark
+
+    def _segment(self, channel_id: int, suffix: str) -> str:
+        return os.path.join(self.channels_path, f"{channel_id}.{suffix}")
+
+    def _index(self, channel_id: int) -> Optional[_Blocks]:
+        index = self.indexes.get(channel_id)
+        if index is not None:
+            return index
+        watermark = self.watermark
+        try:
+            with open(self._segment(channel_id, "idx"), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        records = []
+        # Blocks past the watermark belong to a step that has not finished
+        for offset in range(0, len(data) - _BLOCK.size + 1, _BLOCK.size):
+            record = _BLOCK.unpack_from(data, offset)
+            if record[0] > watermark:
+                break
+            records.append(record)
+        index = _Blocks(records)
+        with self.lock:
+            # Not cached if the watermark moved while the file was read
+            if self.watermark == watermark:
+                self.indexes[channel_id] = index
+        return index
+
+    def _block(self, channel_id: int, record, cache: bool = True) -> list:
+        key = (channel_id, record[4])
+        with self.lock:
+            messages = self.blocks.get(key)
+            if messages is not None:
+                self.blocks.move_to_end(key)
+                self.stats["block_hits"] += 1
+                return messages
+        self.stats["block_misses"] += 1
+        with open(self._segment(channel_id, "seg"), "rb") as file:
+            file.seek(record[4])
+            data = file.read(record[5])
+        messages = [
+            (message_id, user_id, datetime.fromisoformat(created_at) if created_at else None, content)
+            for message_id, user_id, created_at, content in json.loads(zlib.decompress(data))
+        ]
+        if cache:
+            with self.lock:
+                self.blocks[key] = messages
+                while len(self.blocks) > self.block_cache_size:
+                    self.blocks.popitem(last=False)
+        return messages
+
+    def _newest_first(self, channel_id: int, index: _Blocks, before_id: Optional[int]):
+        position = len(index.records) if before_id is None else bisect_left(index.first_ids, before_id)
+        for record in reversed(index.records[:position]):
+            for message in reversed(self._block(channel_id, record)):
+                if before_id is None or message[0] < before_id:
+                    yield message
+
+    def _oldest_first(self, channel_id: int, index: _Blocks, after_id: int, cache: bool = True):
+        position = bisect_right(index.last_ids, after_id)
+        for record in index.records[position:]:
+            for message in self._block(channel_id, record, cache):
+                if message[0] > after_id:
+                    yield message
+
+    def _channel_for(self, message_id: int) -> Optional[int]:
+        # Binary search of the id map, which is sorted by message id
+        try:
+            with open(self.ids_path, "rb") as file:
+                size = os.fstat(file.fileno()).st_size
+                low, high = 0, size // _ID.size
+                while low < high:
+                    middle = (low + high) // 2
+                    file.seek(middle * _ID.size)
+                    record_id, channel_id = _ID.unpack(file.read(_ID.size))
+                    if record_id == message_id:
+                        return channel_id
+                    if record_id < message_id:
+                        low = middle + 1
+                    else:
+                        high = middle
+        except FileNotFoundError:
+            pass
+        return None
+
+    async def _overlays(self, db: AsyncSession, channel_id: int) -> Dict[int, Tuple[Optional[str], bool]]:
+        # A channel's overlays as {message_id: (content, deleted)}, cached between history pages
+        with self.lock:
+            cached = self.overlays.get(channel_id)
+            if cached is not None and cached[0] > time.monotonic():
+                self.overlays.move_to_end(channel_id)
+                self.stats["overlay_hits"] += 1
+                return cached[1]
+            generation = self.overlay_generation
+        self.stats["overlay_misses"] += 1
+        rows = (await db.execute(
+            select(MessageOverlay.message_id, MessageOverlay.content, MessageOverlay.deleted)
+            .where(MessageOverlay.channel_id == channel_id)
+        )).all()
+        overlays = {message_id: (content, deleted) for message_id, content, deleted in rows}
+        with self.lock:
+            # Not cached if an overlay changed while the query ran
+            if self.overlay_generation == generation:
+                self.overlays[channel_id] = (time.monotonic() + self.overlay_ttl, overlays)
+                self.overlays.move_to_end(channel_id)
+                while len(self.overlays) > self.overlay_cache_size:
+                    self.overlays.popitem(last=False)
+        return overlays
+
+    def overlays_changed(self, channel_id: Optional[int] = None):
+        """Forget the cached overlays of a channel, or of all of them.
+
+        Called when overlays are written and again once they are committed,
+        so a page read in between does not keep the old ones.
+        """
+        with self.lock:
+            self.overlay_generation += 1
+            if channel_id is None:
+                self.overlays.clear()
+            else:
+                self.overlays.pop(channel_id, None)
+
+    @staticmethod
+    def _tagged(channel_id: int, messages):
+        for message in messages:
+            yield message + (channel_id,)
+
+    def scan(self, channel_ids: List[int], after_id: int, through_id: int) -> Iterator[tuple]:
+        """Archived messages of several channels with after_id < id <= through_id, oldest first.
+
+        Yields (id, user_id, created_at, content, channel_id) as archived,
+        before overlays. Blocks are read one at a time and not kept in the
+        block cache, so a long scan neither holds the channels in memory
+        nor evicts the blocks interactive readers are using.
+        """
+        self.current_watermark()
+        channels = []
+        for channel_id in channel_ids:
+            index = self._index(channel_id)
+            if index is not None and index.records:
+                channels.append(self._tagged(channel_id, self._oldest_first(channel_id, index, after_id, cache=False)))
+        # Every channel's segment is in id order: merge them, reading one block per channel at a time
+        for message in heapq.merge(*channels):
+            if message[0] > through_id:
+                return
+            yield message
+
+    async def overlays_between(
+        self, db: AsyncSession, channel_ids: List[int], first_id: int, last_id: int
+    ) -> Dict[int, MessageOverlay]:
+        # Overlays for one batch of a scan()
+        overlays = (await db.execute(
+            select(MessageOverlay).where(
+                MessageOverlay.message_id >= first_id,
+                MessageOverlay.message_id <= last_id,
+                MessageOverlay.channel_id.in_(channel_ids)
+            )
+        )).scalars()
+        return {overlay.message_id: overlay for overlay in overlays}
+
+    async def page(
+        self,
+        db: AsyncSession,
+        channel_id: int,
+        limit: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        offset: int = 0
+    ) -> List[dict]:
+        """A page of archived history, newest first, in the shape of message_to_dict.
+
+        With only after_id it is the page just after that id (walking
+        forward); otherwise the newest messages below before_id, stopping at
+        after_id, skipping offset of them.
+        """
+        if limit <= 0 or not self.current_watermark():
+            return []
+        # Segment reads and decompression run off the event loop
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, self._index, channel_id)
+        if index is None or not index.records:
+            return []
+        overlays = await self._overlays(db, channel_id)
+        found = await loop.run_in_executor(
+            None, self._collect, channel_id, index, overlays, limit, before_id, after_id, offset
+        )
+
+        user_ids = {message[1] for message in found}
+        usernames = dict((await db.execute(select(User.id, User.username).where(User.id.in_(user_ids)))).all()) \
+            if user_ids else {}
+        result = []
+        for message_id, user_id, created_at, content in found:
+            overlay = overlays.get(message_id)
+            result.append({
+                "id": message_id,
+                "content": overlay[0] if overlay is not None else content,
+                "user_id": user_id,
+                "channel_id": channel_id,
+                "created_at": created_at,
+                "username": usernames.get(user_id)
+            })
+        return result
+
+    def _collect(
+        self,
+        channel_id: int,
+        index: _Blocks,
+        overlays: Dict[int, Tuple[Optional[str], bool]],
+        limit: int,
+        before_id: Optional[int],
+        after_id: Optional[int],
+        offset: int
+    ) -> list:
+        # The archived rows of a page(), deleted ones left out
+        found = []
+        if after_id is not None and before_id is None:
+            messages = self._oldest_first(channel_id, index, after_id)
+        else:
+            messages = self._newest_first(channel_id, index, before_id)
+        for message in messages:
+            if after_id is not None and before_id is not None and message[0] <= after_id:
+                break
+            overlay = overlays.get(message[0])
+            if overlay is not None and overlay[1]:
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            found.append(message)
+            if len(found) == limit:
+                break
+        if after_id is not None and before_id is None:
+            found.reverse()
+        return found
+
+    def _find(self, message_id: int) -> Optional[ArchivedMessage]:
+        # As archived, before overlays
+        channel_id = self._channel_for(message_id)
+        index = self._index(channel_id) if channel_id is not None else None
+        if not index or not index.records:
+            return None
+        position = bisect_right(index.first_ids, message_id) - 1
+        if position < 0 or index.records[position][1] < message_id:
+            return None
+        for found_id, user_id, created_at, content in self._block(channel_id, index.records[position]):
+            if found_id == message_id:
+                return ArchivedMessage(message_id, content, user_id, channel_id, created_at)
+        return None
+
+    def _find_many(self, message_ids: List[int], watermark: int) -> Dict[int, ArchivedMessage]:
+        messages = {}
+        for message_id in message_ids:
+            message = self._find(message_id) if message_id <= watermark else None
+            if message is not None:
+                messages[message_id] = message
+        return messages
+
+    async def get(self, db: AsyncSession, message_id: int) -> Optional[ArchivedMessage]:
+        if message_id > self.current_watermark():
+            return None
+        loop = asyncio.get_running_loop()
+        message = await loop.run_in_executor(None, self._find, message_id)
+        if message is not None:
+            overlay = await db.get(MessageOverlay, message_id)
+            if overlay is not None:
+                if overlay.deleted:
+                    return None
+                message.content = overlay.content
+        return message
+
+    async def get_many(self, db: AsyncSession, message_ids: List[int]) -> Dict[int, ArchivedMessage]:
+        # Like get() for several ids, with a single overlay query
+        watermark = self.current_watermark()
+        if not message_ids or not watermark:
+            return {}
+        loop = asyncio.get_running_loop()
+        messages = await loop.run_in_executor(None, self._find_many, message_ids, watermark)
+        if messages:
+            overlays = (await db.execute(
+                select(MessageOverlay).where(MessageOverlay.message_id.in_(list(messages)))
+            )).scalars()
+            for overlay in overlays:
+                if overlay.deleted:
+                    del messages[overlay.message_id]
+                else:
+                    messages[overlay.message_id].content = overlay.content
+        return messages
+
+    # Changes to archived messages, committed by the caller
+    async def edit(self, db: AsyncSession, message: ArchivedMessage):
+        overlay = await db.get(MessageOverlay, message.id)
+        if overlay is None:
+            overlay = MessageOverlay(message_id=message.id, channel_id=message.channel_id)
+            db.add(overlay)
+        overlay.content = message.content
+        self.overlays_changed(message.channel_id)
+
+    async def delete(self, db: AsyncSession, message: ArchivedMessage):
+        overlay = await db.get(MessageOverlay, message.id)
+        if overlay is None:
+            overlay = MessageOverlay(message_id=message.id, channel_id=message.channel_id)
+            db.add(overlay)
+        overlay.content = None
+        overlay.deleted = True
+        self.overlays_changed(message.channel_id)
+
+    def drop_channels(self, channel_ids: List[int]):
+        # Called after the channels' rows (and overlays) are deleted
+        for channel_id in channel_ids:
+            for suffix in ("idx", "seg"):
+                try:
+                    os.remove(self._segment(channel_id, suffix))
+                except FileNotFoundError:
+                    pass
+            with self.lock:
+                self.indexes.pop(channel_id, None)
+                self.overlays.pop(channel_id, None)
+                for key in [key for key in self.blocks if key[0] == channel_id]:
+                    del self.blocks[key]
+
+    # Archiving
+    def start(self):
+        if self.after_days > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _acquire(self) -> bool:
+        # Only one worker process archives; the others just read
+        if self.lock_file is None:
+            os.makedirs(self.channels_path, exist_ok=True)
+            lock_file = open(os.path.join(self.path, "archiver.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self.lock_file = lock_file
+            self._repair()
+        return True
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if await loop.run_in_executor(self.executor, self._acquire):
+                    await self.run_once()
+            except Exception:
+                logger.exception("Message archiving failed")
+                self.stats["errors"] += 1
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        """Archive everything that is old enough; returns how many messages moved."""
+        loop = asyncio.get_running_loop()
+        threshold = datetime.utcnow() - timedelta(days=self.after_days)
+        moved = 0
+        while True:
+            count = await loop.run_in_executor(self.executor, self.archive_step, threshold)
+            moved += count
+            if count < self.batch_size:
+                return moved
+
+    def _repair(self):
+        """Undo the file appends of a step that did not reach its manifest update."""
+        watermark = self.current_watermark()
+        for name in os.listdir(self.channels_path):
+            if not name.endswith(".idx"):
+                continue
+            path = os.path.join(self.channels_path, name)
+            with open(path, "rb") as file:
+                data = file.read()
+            keep = 0
+            segment_end = 0
+            for offset in range(0, len(data) - _BLOCK.size + 1, _BLOCK.size):
+                record = _BLOCK.unpack_from(data, offset)
+                if record[0] > watermark:
+                    break
+                keep = offset + _BLOCK.size
+                segment_end = record[4] + record[5]
+            if keep != len(data):
+                os.truncate(path, keep)
+                os.truncate(path[:-len(".idx")] + ".seg", segment_end)
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "rb") as file:
+                data = file.read()
+            keep = len(data) - len(data) % _ID.size
+            while keep and _ID.unpack_from(data, keep - _ID.size)[0] > watermark:
+                keep -= _ID.size
+            if keep != len(data):
+                os.truncate(self.ids_path, keep)
+        # Rows a crashed step archived but did not get to delete, with the edits and deletes
+        # made to them since it read them
+        db = self.session_factory()
+        try:
+            previous = self._previous_watermark()
+            current = {}
+            if previous is not None and previous < watermark:
+                current = dict(db.execute(
+                    select(Message.id, Message.content).where(Message.id > previous, Message.id <= watermark)
+                ).all())
+            if current:
+                # The last step did not get to its delete: what it moved and is gone since was deleted
+                overlaid = set(db.execute(
+                    select(MessageOverlay.message_id)
+                    .where(MessageOverlay.message_id > previous, MessageOverlay.message_id <= watermark)
+                ).scalars())
+                for message_id, channel_id in self._archived_ids(previous, watermark):
+                    if message_id in overlaid:
+                        continue
+                    if message_id not in current:
+                        db.add(MessageOverlay(message_id=message_id, channel_id=channel_id, content=None, deleted=True))
+                        continue
+                    archived = self._find(message_id)
+                    if archived is not None and archived.content != current[message_id]:
+                        db.add(MessageOverlay(message_id=message_id, channel_id=channel_id, content=current[message_id]))
+            db.execute(delete(Message).where(Message.id <= watermark))
+            db.commit()
+        finally:
+            db.close()
+        self.overlays_changed()
+
+    def _previous_watermark(self) -> Optional[int]:
+        # The watermark before the last step; manifests written before it was recorded lack it
+        try:
+            with open(self.manifest_path) as manifest:
+                return json.load(manifest).get("previous")
+        except FileNotFoundError:
+            return None
+
+    def _archived_ids(self, after_id: int, through_id: int) -> List[Tuple[int, int]]:
+        # (message id, channel id) of the id map records in the range
+        try:
+            with open(self.ids_path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return []
+        records = (_ID.unpack_from(data, offset) for offset in range(0, len(data) - _ID.size + 1, _ID.size))
+        return [(message_id, channel_id) for message_id, channel_id in records if after_id < message_id <= through_id]
+
+    def _append_blocks(self, channel_id: int, messages: list):
+        with open(self._segment(channel_id, "seg"), "ab") as segment, \
+                open(self._segment(channel_id, "idx"), "ab") as index:
+            offset = segment.tell()
+            records = []
+            for start in range(0, len(messages), self.block_size):
+                chunk = messages[start:start + self.block_size]
+                data = zlib.compress(json.dumps([
+                    [row.id, row.user_id, row.created_at.isoformat() if row.created_at else None, row.content]
+                    for row in chunk
+                ], separators=(",", ":")).encode("utf-8"))
+                segment.write(data)
+                records.append(_BLOCK.pack(
+                    chunk[0].id, chunk[-1].id,
+                    _timestamp(chunk[0].created_at), _timestamp(chunk[-1].created_at),
+                    offset, len(data), len(chunk)
+                ))
+                offset += len(data)
+            # Blocks reach the disk before the index entries that point at them
+            segment.flush()
+            os.fsync(segment.fileno())
+            index.write(b"".join(records))
+            index.flush()
+            os.fsync(index.fileno())
+        self.stats["blocks_written"] += len(records)
+
+    def _reuses_ids(self, db: Session) -> bool:
+        # SQLite tables made before messages had AUTOINCREMENT hand out max(id) + 1, which would
+        # give archived ids to new messages once the table is empty
+        if self.reuses_ids is None:
+            sql = db.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'")).scalar() \
+                if db.get_bind().dialect.name == "sqlite" else None
+            self.reuses_ids = sql is not None and "AUTOINCREMENT" not in sql.upper()
+        return self.reuses_ids
+
+    def _write_manifest(self, watermark: int, previous: int):
+        temporary = self.manifest_path + ".tmp"
+        with open(temporary, "w") as manifest:
+            json.dump({"watermark": watermark, "previous": previous}, manifest)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        os.replace(temporary, self.manifest_path)
+
+    def archive_step(self, threshold: datetime) -> int:
+        """Move up to batch_size of the oldest messages created before threshold."""
+        os.makedirs(self.channels_path, exist_ok=True)
+        watermark = self.current_watermark()
+        db: Session = self.session_factory()
+        try:
+            rows = db.execute(
+                select(
+                    Message.id, Message.channel_id, Message.user_id, Message.created_at, Message.content,
+                    (Message.created_at < threshold).label("old")
+                ).where(Message.id > watermark).order_by(Message.id).limit(self.batch_size)
+            ).all()
+            # Archive in id order only, so everything up to the new watermark moves
+            batch = []
+            for row in rows:
+                if not row.old:
+                    break
+                batch.append(row)
+            if len(batch) == len(rows) < self.batch_size and self._reuses_ids(db):
+                # The newest message stays: it keeps max(id) above the archived ids
+                batch = batch[:-1]
+            if not batch:
+                return 0
+
+            by_channel = {}
+            for row in batch:
+                by_channel.setdefault(row.channel_id, []).append(row)
+            for channel_id, messages in by_channel.items():
+                self._append_blocks(channel_id, messages)
+            with open(self.ids_path, "ab") as ids:
+                ids.write(b"".join(_ID.pack(row.id, row.channel_id) for row in batch))
+                ids.flush()
+                os.fsync(ids.fileno())
+
+            # From here on readers look for these messages in the archive
+            new_watermark = batch[-1].id
+            self._write_manifest(new_watermark, watermark)
+            self.current_watermark()
+
+            # Edits and deletes that landed since the rows were read become overlays
+            removed = dict(db.execute(
+                delete(Message).where(Message.id > watermark, Message.id <= new_watermark)
+                .returning(Message.id, Message.content)
+            ).all())
+            for row in batch:
+                if row.id not in removed:
+                    db.add(MessageOverlay(message_id=row.id, channel_id=row.channel_id, content=None, deleted=True))
+                elif removed[row.id] != row.content:
+                    db.add(MessageOverlay(message_id=row.id, channel_id=row.channel_id, content=removed[row.id]))
+            db.commit()
+            self.overlays_changed()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        self.stats["steps"] += 1
+        self.stats["archived"] += len(batch)
+        return len(batch)
+
+
+# Create a global message archive instance
+message_archive = MessageArchive()
@@ -1,35 +1,108 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from ..database import get_db
 from ..models import User
+from ..schemas.auth import Principal
+from .passwords import password_hasher
+from .tracing import tracer
 from dotenv import load_dotenv
 import os
+import threading
+import time
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+# Verified tokens remembered, and for how long at most (never beyond the token's exp)
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+class PrincipalCache:
+    """Bounded TTL/LRU cache of verified token -> Principal.
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+    Saves the JWT decode and the user query on every request and socket
+    connect. Entries expire at the token's exp or after AUTH_CACHE_TTL,
+    whichever is sooner, and are dropped when the user is updated.
+    """
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(User).filter(User.username == username).first()
+    def __init__(self, max_size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.tokens_by_user: Dict[int, Set[str]] = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    def get(self, token: str) -> Optional[Principal]:
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None and entry[1] > time.time():
+                self.entries.move_to_end(token)
+                self.stats["hits"] += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(token)
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, token: str, principal: Principal, exp: float = None):
+        expires_at = time.time() + self.ttl
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+        with self.lock:
+            self.entries[token] = (principal, expires_at)
+            self.entries.move_to_end(token)
+            self.tokens_by_user.setdefault(principal.id, set()).add(token)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_user(self, user_id: int):
+        with self.lock:
+            for token in list(self.tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        principal, _ = self.entries.pop(token)
+        tokens = self.tokens_by_user.get(principal.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[principal.id]
+
+principal_cache = PrincipalCache()
+
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    with tracer.span("auth.password"):
+        verified, new_hash = await password_hasher.verify(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        # The stored hash uses an outdated cost: upgrade it while we have the password
+        user.hashed_password = new_hash
+        await db.commit()
+        password_hasher.stats["rehashes"] += 1
     return user
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -43,6 +116,14 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return encoded_jwt
 
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    with tracer.span("auth") as span:
+        principal = principal_cache.get(token)
+        span.set("cached", principal is not None)
+        if principal is None:
+            principal = _load_principal(token, db)
+        return principal
+
+def _load_principal(token: str, db: Session) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -58,9 +139,11 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal.model_validate(user)
+    principal_cache.set(token, principal, payload.get("exp"))
+    return principal
 
-def get_current_active_user(current_user: User = Depends(get_current_user)):
+def get_current_active_user(current_user: Principal = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
@@ -0,0 +1,37 @@
+from fastapi import HTTPException, Query, status
+from typing import List
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+# Most ids one batch lookup accepts (they travel in the query string)
+BATCH_MAX_IDS = int(os.getenv("BATCH_MAX_IDS", "500"))
+# Most users one request can add to a server
+BATCH_MAX_MEMBERS = int(os.getenv("BATCH_MAX_MEMBERS", "10000"))
+
+def unique_ids(ids: List[int], max_ids: int) -> List[int]:
+    # Duplicates dropped, first occurrence kept so results follow the request's order
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No ids given"
+        )
+    if len(ids) > max_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {max_ids} ids per request"
+        )
+    return ids
+
+def id_list(ids: str = Query(..., description="Comma-separated ids")) -> List[int]:
+    """Dependency parsing ?ids=1,2,3 for the batch lookup routes."""
+    try:
+        parsed = [int(value) for value in ids.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ids must be a comma-separated list of integers"
+        )
+    return unique_ids(parsed, BATCH_MAX_IDS)
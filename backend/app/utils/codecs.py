@@ -0,0 +1,49 @@
+"""JSON encoding shared by REST responses and WebSocket frames.
+
+orjson when it is installed, the standard library otherwise. Both produce
+compact UTF-8 JSON, encode datetimes as ISO 8601 and decode to the same
+values, so nothing downstream depends on which one is in use.
+"""
+from datetime import date, datetime
+from typing import Any, Union
+from fastapi.responses import JSONResponse
+import json
+from .tracing import tracer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Raised by loads() for malformed input whichever encoder is in use (orjson's subclasses it)
+JSONDecodeError = json.JSONDecodeError
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+if orjson is not None:
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+else:
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=_default).encode("utf-8")
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with dumps().
+
+    The app's default response class. Routes that build plain dicts from
+    trusted rows can also return one directly, which skips FastAPI's
+    response_model validation and jsonable_encoder pass.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with tracer.span("encode"):
+            return dumps(content)
@@ -0,0 +1,213 @@
+"""Streaming NDJSON exports of channel and server history.
+
+An export is every message of a set of channels, oldest first, one JSON
+object per line in the shape of the history routes. It is read in batches
+of EXPORT_BATCH_SIZE: keyset pages of the messages table and block by block
+from the archive, so memory stays at one batch however long the export is,
+and no read transaction stays open while the client is slow to read.
+
+Lines are in id order, so an interrupted export resumes with after_id set
+to the id of the last complete line.
+"""
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import zlib
+from ..database import AsyncSessionLocal
+from ..models import Message, User
+from .archive import MessageArchive, message_archive
+from .codecs import dumps
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Messages read, encoded and sent per step
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# zlib level for ?gzip=true exports
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+
+def utc_naive(value: Optional[datetime]) -> Optional[datetime]:
+    # created_at is stored as naive UTC
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+class ExportFilter:
+    """The id and time range of an export: after_id < id < before_id, since <= created_at < until."""
+
+    def __init__(
+        self,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None
+    ):
+        self.after_id = after_id or 0
+        self.before_id = before_id
+        self.since = utc_naive(since)
+        self.until = utc_naive(until)
+
+    def where(self, query):
+        # The time range; ids are bounded by the caller
+        if self.since is not None:
+            query = query.where(Message.created_at >= self.since)
+        if self.until is not None:
+            query = query.where(Message.created_at < self.until)
+        return query
+
+    def matches(self, created_at: Optional[datetime]) -> bool:
+        if self.since is not None and (created_at is None or created_at < self.since):
+            return False
+        if self.until is not None and (created_at is None or created_at >= self.until):
+            return False
+        return True
+
+def _take(messages, export_filter: ExportFilter, count: int) -> list:
+    # Runs in a thread: reading and decompressing blocks stays off the event loop
+    batch = []
+    for message in messages:
+        if export_filter.matches(message[2]):
+            batch.append(message)
+            if len(batch) == count:
+                break
+    return batch
+
+async def _archived(
+    db: AsyncSession,
+    archive: MessageArchive,
+    channel_ids: List[int],
+    export_filter: ExportFilter,
+    after_id: int,
+    through_id: int,
+    batch_size: int
+) -> AsyncIterator[List[dict]]:
+    loop = asyncio.get_running_loop()
+    messages = archive.scan(channel_ids, after_id, through_id)
+    while True:
+        batch = await loop.run_in_executor(None, _take, messages, export_filter, batch_size)
+        if not batch:
+            return
+        overlays = await archive.overlays_between(db, channel_ids, batch[0][0], batch[-1][0])
+        user_ids = {message[1] for message in batch}
+        usernames = dict((await db.execute(select(User.id, User.username).where(User.id.in_(user_ids)))).all())
+        result = []
+        for message_id, user_id, created_at, content, channel_id in batch:
+            overlay = overlays.get(message_id)
+            if overlay is not None:
+                if overlay.deleted:
+                    continue
+                content = overlay.content
+            result.append({
+                "id": message_id,
+                "content": content,
+                "user_id": user_id,
+                "channel_id": channel_id,
+                "created_at": created_at,
+                "username": usernames.get(user_id)
+            })
+        yield result
+        if len(batch) < batch_size:
+            return
+
+async def export_messages(
+    channel_ids: List[int],
+    export_filter: ExportFilter,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    session_factory=AsyncSessionLocal,
+    archive: MessageArchive = message_archive
+) -> AsyncIterator[List[dict]]:
+    """The channels' messages in id order, a batch at a time, from the archive and the messages table.
+
+    Messages sent after the export starts are not part of it.
+    """
+    if not channel_ids:
+        return
+    # Its own session: the request's is closed once the response has started
+    async with session_factory() as db:
+        end_id = max((await db.execute(select(func.max(Message.id)))).scalar() or 0, archive.current_watermark())
+        if export_filter.before_id is not None:
+            end_id = min(end_id, export_filter.before_id - 1)
+        last_id = export_filter.after_id
+        # Rows of several channels can't be read in id order from one index, so each query is
+        # bounded to an id window, sized to hold about a batch of the channels' messages
+        span = batch_size
+        while last_id < end_id:
+            watermark = archive.current_watermark()
+            if last_id < watermark:
+                # Everything up to the watermark is in the archive
+                through_id = min(watermark, end_id)
+                async for batch in _archived(db, archive, channel_ids, export_filter, last_id, through_id, batch_size):
+                    yield batch
+                last_id = through_id
+                continue
+
+            upper_id = min(last_id + span, end_id)
+            result = await db.execute(
+                export_filter.where(
+                    select(
+                        Message.id, Message.content, Message.user_id, Message.channel_id, Message.created_at,
+                        User.username
+                    )
+                    .outerjoin(User, Message.user_id == User.id)
+                    .where(Message.channel_id.in_(channel_ids), Message.id > last_id, Message.id <= upper_id)
+                )
+                .order_by(Message.id)
+                .limit(batch_size)
+            )
+            columns = list(result.keys())
+            rows = [dict(zip(columns, row)) for row in result]
+            # End the read transaction between batches
+            await db.commit()
+
+            # The archiver moves rows out of the table after updating the watermark: if it moved
+            # while this batch was read, some rows may be missing from it, so read them from the archive
+            if archive.current_watermark() > last_id:
+                continue
+
+            if rows:
+                yield rows
+            if len(rows) == batch_size:
+                last_id = rows[-1]["id"]
+                span = max(batch_size, span // 2)
+            else:
+                last_id = upper_id
+                span *= 2
+
+async def ndjson(batches: AsyncIterator[List[dict]]) -> AsyncIterator[bytes]:
+    async for batch in batches:
+        if batch:
+            yield b"\n".join(dumps(message) for message in batch) + b"\n"
+
+async def gzipped(chunks: AsyncIterator[bytes], level: int = EXPORT_GZIP_LEVEL) -> AsyncIterator[bytes]:
+    # A single gzip member, written as the chunks arrive
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def _logged(chunks: AsyncIterator[bytes], name: str) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in chunks:
+            yield chunk
+    except Exception:
+        # The response is already underway: the client sees a truncated stream and resumes from its last line
+        logger.exception("Export %s failed", name)
+        raise
+
+def export_response(channel_ids: List[int], export_filter: ExportFilter, name: str, gzip: bool = False) -> StreamingResponse:
+    """A streaming NDJSON response of the channels' messages, gzip-encoded if asked."""
+    chunks = ndjson(export_messages(channel_ids, export_filter))
+    headers = {"Content-Disposition": f'attachment; filename="{name}.ndjson"'}
+    if gzip:
+        chunks = gzipped(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(_logged(chunks, name), media_type="application/x-ndjson", headers=headers)
@@ -0,0 +1,156 @@
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+import bisect
+import os
+import time
+
+load_dotenv()
+
+# Most recent messages kept per channel
+HISTORY_CACHE_MESSAGES = int(os.getenv("HISTORY_CACHE_MESSAGES", "100"))
+# Channels kept before the least recently read are evicted
+HISTORY_CACHE_CHANNELS = int(os.getenv("HISTORY_CACHE_CHANNELS", "1000"))
+# Upper bound on staleness for messages written by other worker processes
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "30"))
+
+class ChannelHistory:
+    """Ring buffer of a channel's newest messages, oldest first."""
+
+    def __init__(self, capacity: int, messages: List[dict], ttl: float):
+        self.messages = deque(messages, maxlen=capacity)
+        # True while the buffer holds every message of the channel
+        self.complete = len(messages) < capacity
+        self.expires_at = time.monotonic() + ttl
+
+    def add(self, message: dict):
+        if self.messages and self.messages[-1]["id"] == message["id"]:
+            # Already added by the write path, now coming back through the broker
+            return
+        if len(self.messages) == self.messages.maxlen:
+            self.complete = False
+        if not self.messages or self.messages[-1]["id"] < message["id"]:
+            self.messages.append(message)
+            return
+        # Out-of-order commit: keep the buffer sorted by id
+        ids = [item["id"] for item in self.messages]
+        position = bisect.bisect_left(ids, message["id"])
+        if position < len(ids) and ids[position] == message["id"]:
+            return
+        if position == 0 and len(self.messages) == self.messages.maxlen:
+            # Older than everything kept: it belongs behind the buffer
+            return
+        self.messages.insert(position, message)
+
+    def find(self, message_id: int) -> Optional[dict]:
+        for message in self.messages:
+            if message["id"] == message_id:
+                return message
+        return None
+
+class HistoryCache:
+    """Per-channel ring buffers serving the first page of channel history.
+
+    A channel's buffer is seeded from the database by its first history
+    read, then kept current by the chat write path, by chat messages from
+    other workers arriving through the broker, and by message edits and
+    deletes. Buffers are bounded per channel and evicted LRU across
+    channels.
+    """
+
+    def __init__(
+        self,
+        capacity: int = HISTORY_CACHE_MESSAGES,
+        max_channels: int = HISTORY_CACHE_CHANNELS,
+        ttl: float = HISTORY_CACHE_TTL
+    ):
+        self.capacity = capacity
+        self.max_channels = max_channels
+        self.ttl = ttl
+        self.channels: OrderedDict = OrderedDict()
+        # channel_id -> [writes seen, reads in flight] while a seeding query runs
+        self.seeding: Dict[int, List[int]] = {}
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    def _get(self, channel_id: int) -> Optional[ChannelHistory]:
+        history = self.channels.get(channel_id)
+        if history is not None and history.expires_at < time.monotonic():
+            del self.channels[channel_id]
+            return None
+        return history
+
+    def latest(self, channel_id: int, limit: int) -> Optional[List[dict]]:
+        # Newest first, or None when the buffer cannot answer for this limit
+        history = self._get(channel_id)
+        if history is None or (limit > len(history.messages) and not history.complete):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.channels.move_to_end(channel_id)
+        return list(reversed(history.messages))[:limit]
+
+    def _written(self, channel_id: int):
+        entry = self.seeding.get(channel_id)
+        if entry is not None:
+            entry[0] += 1
+
+    def begin_seed(self, channel_id: int) -> int:
+        # Taken before the seeding query so writes racing it are noticed
+        entry = self.seeding.setdefault(channel_id, [0, 0])
+        entry[1] += 1
+        return entry[0]
+
+    def _end_seed(self, channel_id: int) -> Optional[List[int]]:
+        entry = self.seeding.get(channel_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.seeding[channel_id]
+        return entry
+
+    def abort_seed(self, channel_id: int):
+        # Every begin_seed() is ended by seed() or, when the seeding query failed, by this
+        self._end_seed(channel_id)
+
+    def seed(self, channel_id: int, newest_first: List[dict], token: int):
+        entry = self._end_seed(channel_id)
+        if entry is not None and entry[0] != token:
+            # A message changed while the query ran; the next read seeds again
+            return
+        self.channels[channel_id] = ChannelHistory(self.capacity, list(reversed(newest_first)), self.ttl)
+        self.channels.move_to_end(channel_id)
+        while len(self.channels) > self.max_channels:
+            self.channels.popitem(last=False)
+
+    def add(self, channel_id: int, message: dict):
+        # Only channels already seeded are tracked; others are seeded on their next read
+        self._written(channel_id)
+        history = self._get(channel_id)
+        if history is not None:
+            history.add(message)
+
+    def update(self, channel_id: int, message_id: int, content: str):
+        self._written(channel_id)
+        history = self._get(channel_id)
+        if history is not None:
+            message = history.find(message_id)
+            if message is not None:
+                message["content"] = content
+
+    def remove(self, channel_id: int, message_id: int):
+        self._written(channel_id)
+        history = self._get(channel_id)
+        if history is not None:
+            message = history.find(message_id)
+            if message is not None:
+                history.messages.remove(message)
+
+    def drop(self, channel_id: int):
+        self.channels.pop(channel_id, None)
+
+
+# Create a global history cache instance
+history_cache = HistoryCache()
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+import os
+import threading
+import time
+from ..models import Channel, Server, server_members
+from .tracing import tracer
+
+load_dotenv()
+
+# Entries kept per lookup table before the least recently used are evicted
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+# Upper bound on staleness for changes made by other worker processes
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "60"))
+
+_MISSING = object()
+
+def server_member_exists(server_id: int, user_id: int):
+    return select(
+        exists().where(
+            server_members.c.server_id == server_id,
+            server_members.c.user_id == user_id
+        )
+    )
+
+class _LRU:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return _MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key, (value, _) in self.entries.items() if predicate(key, value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class MembershipIndex:
+    """In-memory membership and permission index.
+
+    Caches (server_id, user_id) -> is member, channel_id -> server_id and
+    server_id -> owner_id. A miss is answered with a single indexed query;
+    the write routes invalidate the affected entries after committing.
+    """
+
+    def __init__(self, max_size: int = MEMBERSHIP_CACHE_SIZE, ttl: float = MEMBERSHIP_CACHE_TTL):
+        self.members = _LRU(max_size, ttl)
+        self.channel_servers = _LRU(max_size, ttl)
+        self.server_owners = _LRU(max_size, ttl)
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    def _cached(self, cache: _LRU, key):
+        value = cache.get(key)
+        if value is _MISSING:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+        return value
+
+    # Lookups for async sessions
+    async def is_member(self, db: AsyncSession, server_id: int, user_id: int) -> bool:
+        with tracer.span("permission", check="is_member", server_id=server_id) as span:
+            value = self._cached(self.members, (server_id, user_id))
+            span.set("cached", value is not _MISSING)
+            if value is _MISSING:
+                value = bool((await db.execute(server_member_exists(server_id, user_id))).scalar())
+                self.members.set((server_id, user_id), value)
+            return value
+
+    async def channel_server(self, db: AsyncSession, channel_id: int) -> Optional[int]:
+        with tracer.span("permission", check="channel_server", channel_id=channel_id) as span:
+            value = self._cached(self.channel_servers, channel_id)
+            span.set("cached", value is not _MISSING)
+            if value is _MISSING:
+                value = (await db.execute(select(Channel.server_id).where(Channel.id == channel_id))).scalar()
+                if value is not None:
+                    self.channel_servers.set(channel_id, value)
+            return value
+
+    async def server_owner(self, db: AsyncSession, server_id: int) -> Optional[int]:
+        with tracer.span("permission", check="server_owner", server_id=server_id) as span:
+            value = self._cached(self.server_owners, server_id)
+            span.set("cached", value is not _MISSING)
+            if value is _MISSING:
+                value = (await db.execute(select(Server.owner_id).where(Server.id == server_id))).scalar()
+                if value is not None:
+                    self.server_owners.set(server_id, value)
+            return value
+
+    # Lookups for sync sessions
+    def is_member_sync(self, db: Session, server_id: int, user_id: int) -> bool:
+        with tracer.span("permission", check="is_member", server_id=server_id) as span:
+            value = self._cached(self.members, (server_id, user_id))
+            span.set("cached", value is not _MISSING)
+            if value is _MISSING:
+                value = bool(db.execute(server_member_exists(server_id, user_id)).scalar())
+                self.members.set((server_id, user_id), value)
+            return value
+
+    # Invalidation, called by the write routes after commit
+    def member_added(self, server_id: int, user_id: int):
+        self.members.set((server_id, user_id), True)
+
+    def member_removed(self, server_id: int, user_id: int):
+        self.members.set((server_id, user_id), False)
+
+    def server_created(self, server_id: int, owner_id: int):
+        self.server_owners.set(server_id, owner_id)
+        self.members.set((server_id, owner_id), True)
+
+    def server_deleted(self, server_id: int):
+        self.server_owners.pop(server_id)
+        self.members.discard_where(lambda key, value: key[0] == server_id)
+        self.channel_servers.discard_where(lambda key, value: value == server_id)
+
+    def channel_deleted(self, channel_id: int):
+        self.channel_servers.pop(channel_id)
+
+    def clear(self):
+        self.members.clear()
+        self.channel_servers.clear()
+        self.server_owners.clear()
+
+
+# Create a global membership index instance
+membership = MembershipIndex()
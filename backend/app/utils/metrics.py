@@ -0,0 +1,307 @@
+"""In-process metrics, exposed in the Prometheus text format at /metrics.
+
+Hot paths record into counters and histograms that cost an integer add or
+a bisect per observation. Everything the components already count in their
+stats dicts is read only when /metrics is scraped, through metrics
+registered with a function. With nobody scraping, the registry does
+nothing beyond the observations themselves.
+
+Values are per worker process.
+"""
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+import asyncio
+import math
+import os
+import threading
+import time
+
+load_dotenv()
+
+# How often the event loop lag is sampled, in seconds
+METRICS_LAG_INTERVAL = float(os.getenv("METRICS_LAG_INTERVAL", "0.5"))
+# Time every SQL statement and commit by route; having any engine event listeners costs SQLAlchemy a few us per statement
+METRICS_DB_TIMING = os.getenv("METRICS_DB_TIMING", "true").lower() in ("1", "true", "yes")
+
+# Seconds, from a fast indexed query to a slow request
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Recipients of one event
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+LabelValues = Tuple[str, ...]
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # One slot per bucket plus +Inf; made cumulative when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # No lock: observations also come from worker threads (sync routes, the writer thread), and under
+        # the GIL a race loses one of them at worst. A lock would double the cost of every observation
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Metric:
+    """A metric family: one value per combination of label values.
+
+    With a function, the values are not recorded but read from it at
+    scrape time; it returns a number, or a dict of label values -> number.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Callable[[], object] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.children: Dict[LabelValues, object] = {}
+        self.lock = threading.Lock()
+        # Metrics without labels record straight into their only child
+        self.default = self.labels() if not self.labelnames else None
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _values(self) -> Iterable[Tuple[LabelValues, object]]:
+        if self.function is None:
+            return list(self.children.items())
+        values = self.function()
+        if isinstance(values, dict):
+            return [(key if isinstance(key, tuple) else (key,), value) for key, value in values.items()]
+        return [((), values)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in self._values():
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_format_value(getattr(value, 'value', value))}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1):
+        self.default.inc(amount)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float):
+        self.default.set(value)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.default.observe(value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, child in self._values():
+            counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (_format_value(bound),))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Named metrics of the process, rendered together for /metrics.
+
+    Registering a name twice returns the metric registered first, so
+    components created more than once (as in the benchmarks) share it.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (), function=None) -> Counter:
+        return self._register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), function=None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Create a global metrics registry instance
+metrics = MetricsRegistry()
+
+# The route handling the current request or socket, for per-route database timings
+_current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+
+def current_route() -> str:
+    scope = _current_scope.get()
+    if scope is None:
+        return "background"
+    # Filled in by the router once the request is matched
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+class RouteContextMiddleware:
+    """Makes the request's scope visible to code that runs on its behalf, such as database events."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        token = _current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_scope.reset(token)
+
+db_query_seconds = metrics.histogram(
+    "ankachat_db_query_seconds", "Time spent executing SQL statements, by route", ["route"]
+)
+db_commit_seconds = metrics.histogram(
+    "ankachat_db_commit_seconds", "Time spent committing sessions (flush and commit), by route", ["route"]
+)
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    db_query_seconds.labels(current_route()).observe(time.perf_counter() - context.metrics_started)
+
+def _before_commit(session):
+    session.info["commit_started"] = time.perf_counter()
+
+def _after_commit(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        db_commit_seconds.labels(current_route()).observe(time.perf_counter() - started)
+
+def instrument_database(*engines: Engine):
+    """Time every statement run on the engines, and every session commit."""
+    for engine in engines:
+        if not event.contains(engine, "before_cursor_execute", _before_execute):
+            event.listen(engine, "before_cursor_execute", _before_execute)
+            event.listen(engine, "after_cursor_execute", _after_execute)
+    if not event.contains(Session, "before_commit", _before_commit):
+        # Async sessions commit through a Session too
+        event.listen(Session, "before_commit", _before_commit)
+        event.listen(Session, "after_commit", _after_commit)
+
+class LoopMonitor:
+    """Samples event loop lag: how late a timer fires compared to when it was due."""
+
+    def __init__(self, interval: float = METRICS_LAG_INTERVAL):
+        self.interval = interval
+        self.task: asyncio.Task = None
+        self.lag = metrics.histogram(
+            "ankachat_event_loop_lag_seconds", "How late the event loop ran a timer, sampled periodically"
+        )
+        self.last = metrics.gauge("ankachat_event_loop_lag_last_seconds", "Event loop lag at the latest sample")
+
+    def start(self):
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - due)
+            self.lag.observe(lag)
+            self.last.set(lag)
+
+
+# Create a global event loop monitor instance
+loop_monitor = LoopMonitor()
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from fastapi import Request, Response
+from pydantic_core import to_json
+from dotenv import load_dotenv
+import hashlib
+import os
+import threading
+import time
+
+load_dotenv()
+
+# Serialized responses kept before the least recently used are evicted
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+# Upper bound on staleness for changes made by other worker processes
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+
+Key = Tuple[str, int]
+
+class CachedBody:
+    """A serialized response body and its ETag, valid while its resource stays at version."""
+
+    __slots__ = ("version", "body", "etag", "expires_at")
+
+    def __init__(self, version: int, body: bytes, ttl: float):
+        self.version = version
+        self.body = body
+        # Derived from the body, so every worker hands out the same ETag for the same content
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.expires_at = time.monotonic() + ttl
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 asks for If-None-Match
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+class ResponseCache:
+    """Version counters and serialized bodies for read-mostly resources.
+
+    Resources are ("server", id) for server details, ("channels", server_id)
+    for a server's channel list and ("user", id) for profiles. The write
+    routes bump a resource's version after committing, which retires its
+    cached body; GET routes answer If-None-Match with 304 when the body's
+    ETag still matches.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.versions: Dict[Key, int] = {}
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "not_modified": 0,
+            "invalidations": 0,
+        }
+
+    def version(self, kind: str, resource_id: int) -> int:
+        # Read before loading the resource, then passed to put()
+        return self.versions.get((kind, resource_id), 0)
+
+    def get(self, kind: str, resource_id: int) -> Optional[CachedBody]:
+        key = (kind, resource_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.version == self.versions.get(key, 0) and entry.expires_at >= time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, kind: str, resource_id: int, version: int, content: Any) -> CachedBody:
+        # content is a response schema instance, or a list of them
+        key = (kind, resource_id)
+        entry = CachedBody(version, to_json(content), self.ttl)
+        with self.lock:
+            # A bump while the resource was loading makes this body stale: hand it out once, don't keep it
+            if version == self.versions.get(key, 0):
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return entry
+
+    def respond(self, request: Request, entry: CachedBody) -> Response:
+        headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+        if _matches(request.headers.get("if-none-match"), entry.etag):
+            self.stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+    # Invalidation, called by the write routes after commit
+    def bump(self, kind: str, resource_id: int):
+        key = (kind, resource_id)
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            self.entries.pop(key, None)
+            self.stats["invalidations"] += 1
+
+    def server_changed(self, server_id: int):
+        self.bump("server", server_id)
+
+    def channels_changed(self, server_id: int):
+        self.bump("channels", server_id)
+
+    def user_changed(self, user_id: int):
+        self.bump("user", user_id)
+
+    def metrics(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "hit_ratio": self.stats["hits"] / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Create a global response cache instance
+response_cache = ResponseCache()
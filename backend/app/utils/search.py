@@ -0,0 +1,279 @@
+"""Full-text message search.
+
+SQLite keeps an FTS5 table of message contents, PostgreSQL a table of
+tsvectors with a GIN index. Either way the index lives in its own table,
+keyed by message id, and is kept current by explicit calls from every path
+that writes messages (the REST routes, the WebSocket message writer and
+channel/server deletion), inside the same transaction as the change itself.
+
+Each entry also records the message's channel and server, so a search
+limited to a quiet channel does not have to walk every newer match of a
+common word elsewhere before finding one that belongs to it.
+
+Entries outlive the move of old messages into the archive (archive.py):
+edits and deletes of archived messages are applied to them like any other,
+and search results whose row has left the messages table are filled in
+from the archive by the caller.
+"""
+from typing import Dict, List, Optional
+from html import escape
+from sqlalchemy import Integer, column, func, literal, literal_column, select, table, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+import logging
+import os
+import re
+from ..database import engine
+from ..models import Message, User
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Words of context around the match in a result snippet
+SEARCH_SNIPPET_WORDS = int(os.getenv("SEARCH_SNIPPET_WORDS", "12"))
+
+# Private-use characters around matches, swapped for <mark> once the snippet is escaped
+_START, _END = "\ue000", "\ue001"
+
+def render_snippet(snippet: str) -> str:
+    # Message text is user input: escape it, then add the highlight markup
+    return escape(snippet).replace(_START, "<mark>").replace(_END, "</mark>")
+
+def _ids(values: List[int]) -> str:
+    # Integer ids only, so they can be inlined safely
+    return ", ".join(str(int(value)) for value in values)
+
+class _FTS5:
+    name = "fts5"
+    index = table("messages_fts", column("rowid", Integer), column("content"))
+
+    # scope holds a "c<channel id>" and an "s<server id>" token for each message
+    create = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "content, scope, tokenize = 'unicode61 remove_diacritics 2')"
+    ]
+    backfill = (
+        "INSERT INTO messages_fts (rowid, content, scope) "
+        "SELECT messages.id, messages.content, 'c' || channels.id || ' s' || channels.server_id "
+        "FROM messages JOIN channels ON channels.id = messages.channel_id WHERE messages.content IS NOT NULL"
+    )
+    # A scalar subquery rather than INSERT ... SELECT, which is several times slower into FTS5
+    insert = (
+        "INSERT INTO messages_fts (rowid, content, scope) VALUES (:id, :content, "
+        "(SELECT 'c' || id || ' s' || server_id FROM channels WHERE id = :channel_id))"
+    )
+    update = "UPDATE messages_fts SET content = :content WHERE rowid = :id"
+    delete = "DELETE FROM messages_fts WHERE rowid IN ({ids})"
+
+    @property
+    def key(self):
+        return self.index.c.rowid
+
+    def parse(self, query: str) -> Optional[str]:
+        # Every word must match; quoting keeps FTS5 operators in user input literal
+        words = re.findall(r"\w+", query)
+        return " ".join(f'"{word}"' for word in words) or None
+
+    def _scope(self, channel_ids: Optional[List[int]], server_ids: Optional[List[int]]) -> str:
+        tokens = [f"c{int(channel_id)}" for channel_id in channel_ids or ()]
+        tokens += [f"s{int(server_id)}" for server_id in server_ids or ()]
+        return "scope : (" + " OR ".join(tokens) + ")"
+
+    def where(self, parsed: str, channel_ids: Optional[List[int]], server_ids: Optional[List[int]]):
+        expression = f"content : ({parsed}) AND {self._scope(channel_ids, server_ids)}"
+        return [text("messages_fts MATCH :query").bindparams(query=expression)]
+
+    def delete_channels(self, channel_ids: List[int]):
+        return text("DELETE FROM messages_fts WHERE messages_fts MATCH :query") \
+            .bindparams(query=self._scope(channel_ids, None))
+
+    def snippet(self, parsed: str, content=None):
+        # From the index's own copy of the content, archived messages included
+        return func.snippet(literal_column("messages_fts"), 0, _START, _END, "…", SEARCH_SNIPPET_WORDS)
+
+class _Tsvector:
+    name = "tsvector"
+    index = table(
+        "message_search",
+        column("message_id", Integer),
+        column("channel_id", Integer),
+        column("server_id", Integer),
+        column("document")
+    )
+
+    create = [
+        "CREATE TABLE IF NOT EXISTS message_search ("
+        "message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, server_id INTEGER NOT NULL, "
+        "document TSVECTOR NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_message_search_document ON message_search USING GIN (document)",
+        "CREATE INDEX IF NOT EXISTS ix_message_search_channel_id ON message_search (channel_id, message_id)",
+        "CREATE INDEX IF NOT EXISTS ix_message_search_server_id ON message_search (server_id, message_id)"
+    ]
+    backfill = (
+        "INSERT INTO message_search (message_id, channel_id, server_id, document) "
+        "SELECT messages.id, channels.id, channels.server_id, to_tsvector('simple', messages.content) "
+        "FROM messages JOIN channels ON channels.id = messages.channel_id WHERE messages.content IS NOT NULL"
+    )
+    insert = (
+        "INSERT INTO message_search (message_id, channel_id, server_id, document) VALUES (:id, :channel_id, "
+        "(SELECT server_id FROM channels WHERE id = :channel_id), to_tsvector('simple', :content))"
+    )
+    update = "UPDATE message_search SET document = to_tsvector('simple', :content) WHERE message_id = :id"
+    delete = "DELETE FROM message_search WHERE message_id IN ({ids})"
+
+    @property
+    def key(self):
+        return self.index.c.message_id
+
+    def parse(self, query: str) -> Optional[str]:
+        # websearch_to_tsquery accepts any user input, so only blank queries are refused
+        return query.strip() or None
+
+    def _tsquery(self, parsed: str):
+        return func.websearch_to_tsquery("simple", parsed)
+
+    def where(self, parsed: str, channel_ids: Optional[List[int]], server_ids: Optional[List[int]]):
+        clauses = [self.index.c.document.op("@@")(self._tsquery(parsed))]
+        if channel_ids:
+            clauses.append(self.index.c.channel_id.in_(channel_ids))
+        if server_ids:
+            clauses.append(self.index.c.server_id.in_(server_ids))
+        return clauses
+
+    def delete_channels(self, channel_ids: List[int]):
+        return text(f"DELETE FROM message_search WHERE channel_id IN ({_ids(channel_ids)})")
+
+    def snippet(self, parsed: str, content=Message.content):
+        # NULL for archived messages, which have no row to join; see SearchIndex.snippets()
+        options = f"StartSel={_START}, StopSel={_END}, MaxWords={SEARCH_SNIPPET_WORDS}, MinWords=1, MaxFragments=1"
+        return func.ts_headline("simple", content, self._tsquery(parsed), options)
+
+class SearchIndex:
+    """Full-text index over message contents.
+
+    create() makes the index table when it is missing and fills it from
+    the messages already stored. Until it has run, the write hooks do
+    nothing and the search route reports search as unavailable.
+    """
+
+    def __init__(self, dialect: str = engine.dialect.name):
+        self.backend = _Tsvector() if dialect == "postgresql" else _FTS5()
+        self.ready = False
+        self.stats = {
+            "searches": 0,
+            "indexed": 0,
+            "removed": 0,
+        }
+
+    def create(self, bind):
+        try:
+            with bind.begin() as conn:
+                for statement in self.backend.create:
+                    conn.execute(text(statement))
+                # A new index table next to existing messages: fill it once
+                empty = conn.execute(select(self.backend.key).select_from(self.backend.index).limit(1)).first() is None
+                if empty and conn.execute(select(Message.id).limit(1)).first() is not None:
+                    logger.info("Building the %s message search index", self.backend.name)
+                    conn.execute(text(self.backend.backfill))
+        except OperationalError:
+            logger.exception("Message search is unavailable (no %s support)", self.backend.name)
+            return
+        self.ready = True
+
+    def _rows(self, messages: List[Message]) -> List[dict]:
+        return [
+            {"id": message.id, "content": message.content, "channel_id": message.channel_id}
+            for message in messages if message.content is not None
+        ]
+
+    # Hooks for async sessions, called before the commit
+    async def add(self, db: AsyncSession, messages: List[Message]):
+        rows = self._rows(messages)
+        if self.ready and rows:
+            await db.execute(text(self.backend.insert), rows)
+            self.stats["indexed"] += len(rows)
+
+    async def update(self, db: AsyncSession, message: Message):
+        if self.ready:
+            await db.execute(text(self.backend.update), {"id": message.id, "content": message.content or ""})
+            self.stats["indexed"] += 1
+
+    async def remove(self, db: AsyncSession, message_ids: List[int]):
+        if self.ready and message_ids:
+            await db.execute(text(self.backend.delete.format(ids=_ids(message_ids))))
+            self.stats["removed"] += len(message_ids)
+
+    async def remove_channels(self, db: AsyncSession, channel_ids: List[int]):
+        if self.ready and channel_ids:
+            await db.execute(self.backend.delete_channels(channel_ids))
+
+    # Hooks for sync sessions
+    def add_sync(self, db: Session, messages: List[Message]):
+        rows = self._rows(messages)
+        if self.ready and rows:
+            db.execute(text(self.backend.insert), rows)
+            self.stats["indexed"] += len(rows)
+
+    def remove_channels_sync(self, db: Session, channel_ids: List[int]):
+        if self.ready and channel_ids:
+            db.execute(self.backend.delete_channels(channel_ids))
+
+    def parse(self, query: str) -> Optional[str]:
+        return self.backend.parse(query)
+
+    def query(
+        self,
+        parsed: str,
+        channel_ids: Optional[List[int]] = None,
+        server_ids: Optional[List[int]] = None,
+        before_id: Optional[int] = None,
+        limit: int = 25
+    ):
+        """Newest matches first as (id, Message, username, snippet) rows.
+
+        Matches are limited to the given channels and servers, which the
+        caller has checked the user may read; before_id continues from the
+        last result of a previous page. Message and username are None for
+        archived messages.
+        """
+        backend = self.backend
+        query = select(backend.key.label("id"), Message, User.username, backend.snippet(parsed).label("snippet")) \
+            .select_from(backend.index) \
+            .outerjoin(Message, Message.id == backend.key) \
+            .outerjoin(User, Message.user_id == User.id) \
+            .where(*backend.where(parsed, channel_ids, server_ids))
+        if before_id is not None:
+            query = query.where(backend.key < before_id)
+        return query.order_by(backend.key.desc()).limit(limit)
+
+    async def search(
+        self,
+        db: AsyncSession,
+        parsed: str,
+        channel_ids: Optional[List[int]] = None,
+        server_ids: Optional[List[int]] = None,
+        before_id: Optional[int] = None,
+        limit: int = 25
+    ):
+        if not channel_ids and not server_ids:
+            return []
+        self.stats["searches"] += 1
+        return (await db.execute(self.query(parsed, channel_ids, server_ids, before_id, limit))).all()
+
+    async def snippets(self, db: AsyncSession, parsed: str, contents: Dict[int, str]) -> Dict[int, str]:
+        # Snippets of archived messages whose index entry cannot make one by itself, in one query
+        if not contents:
+            return {}
+        ids = list(contents)
+        row = (await db.execute(select(*(
+            self.backend.snippet(parsed, literal(contents[message_id])).label(f"s{message_id}")
+            for message_id in ids
+        )))).one()
+        return dict(zip(ids, row))
+
+
+# Create a global search index instance
+search_index = SearchIndex()
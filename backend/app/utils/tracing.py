@@ -0,0 +1,420 @@
+"""Spans around the phases of requests and socket messages.
+
+A span times one phase: auth, a permission check, a SQL statement, a
+commit, encoding, a broadcast. Spans opened while another is current
+become its children, so every HTTP request (see TracingMiddleware) and
+every chat message or voice signal handled on a socket is a trace of its
+phases. Spans opened with nothing current, as in background tasks, start
+a trace of their own.
+
+Finished spans go to the exporters named in TRACING_EXPORTERS:
+
+- log: one log line per span;
+- memory: a ring of the latest spans, served by GET /admin/traces;
+- otlp: OTLP/JSON trace requests appended to a file, one per line, the
+  format of the OpenTelemetry Collector's file exporter.
+
+Other exporters are objects with export(span) and shutdown(), added with
+tracer.add_exporter(). With no exporter, which is the default, span()
+returns a shared no-op span and nothing is recorded.
+"""
+from collections import deque
+from contextvars import ContextVar
+from typing import List, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated exporters for finished spans: log, memory, otlp; tracing is off when empty
+TRACING_EXPORTERS = os.getenv("TRACING_EXPORTERS", "")
+# Share of traces recorded, decided when a trace starts; its spans follow
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+# Spans kept by the memory exporter
+TRACING_RING_SIZE = int(os.getenv("TRACING_RING_SIZE", "2048"))
+# Spans shorter than this are not logged by the log exporter, in milliseconds
+TRACING_LOG_MIN_MS = float(os.getenv("TRACING_LOG_MIN_MS", "0"))
+# File the otlp exporter appends to, and how often it writes, in seconds
+TRACING_OTLP_FILE = os.getenv("TRACING_OTLP_FILE", "./traces.jsonl")
+TRACING_OTLP_INTERVAL = float(os.getenv("TRACING_OTLP_INTERVAL", "1.0"))
+# service.name of the exported spans
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "ankachat")
+
+# SQL statements are cut to this length in span attributes
+STATEMENT_MAX_LENGTH = 300
+
+class _NoopSpan:
+    """Stands in for a span when nothing is recorded."""
+
+    recording = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key: str, value):
+        pass
+
+    def update_name(self, name: str):
+        pass
+
+    def end(self):
+        pass
+
+_NOOP = _NoopSpan()
+
+class _UnsampledSpan(_NoopSpan):
+    """The root of a trace left out by sampling: current while it runs, so its children are left out too."""
+
+    __slots__ = ("token",)
+
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self.token)
+        return False
+
+class Span:
+    __slots__ = (
+        "tracer", "name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error", "token"
+    )
+
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else random.getrandbits(128)
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.error = None
+        self.token = None
+        self.end_ns = None
+        self.start_ns = time.time_ns()
+
+    def __enter__(self):
+        # Current while it runs, so spans opened inside become its children
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        _current_span.reset(self.token)
+        self.end()
+        return False
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def update_name(self, name: str):
+        self.name = name
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer._export(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": f"{self.trace_id:032x}",
+            "span_id": f"{self.span_id:016x}",
+            "parent_id": f"{self.parent_id:016x}" if self.parent_id is not None else None,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+_current_span: ContextVar[Optional[object]] = ContextVar("current_span", default=None)
+
+class Tracer:
+    def __init__(self, exporters: List[object] = (), sample_rate: float = TRACING_SAMPLE_RATE):
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.stats = {
+            "spans": 0,
+            "export_errors": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def exporter(self, kind: type):
+        """The first exporter of the given class, or None."""
+        for exporter in self.exporters:
+            if isinstance(exporter, kind):
+                return exporter
+        return None
+
+    def span(self, name: str, **attributes):
+        """A span starting now, child of the current one; use it as a context manager, or call end()."""
+        if not self.exporters:
+            return _NOOP
+        parent = _current_span.get()
+        if parent is None:
+            if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+                return _UnsampledSpan()
+        elif not parent.recording:
+            return _NOOP
+        return Span(self, name, parent, attributes)
+
+    def current(self):
+        """The current span, or a no-op one outside any trace."""
+        span = _current_span.get()
+        return span if span is not None else _NOOP
+
+    def _export(self, span: Span):
+        self.stats["spans"] += 1
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                # A broken exporter must not fail the request it is tracing
+                self.stats["export_errors"] += 1
+                logger.exception("Span exporter %s failed", type(exporter).__name__)
+
+    def shutdown(self):
+        for exporter in self.exporters:
+            exporter.shutdown()
+
+class LogExporter:
+    """Logs every finished span at INFO, or those that took at least min_ms."""
+
+    def __init__(self, min_ms: float = TRACING_LOG_MIN_MS, log: logging.Logger = logger):
+        self.min_ms = min_ms
+        self.log = log
+
+    def export(self, span: Span):
+        duration = span.duration_ms
+        if duration < self.min_ms:
+            return
+        self.log.info(
+            "span %s %.3fms trace=%032x span=%016x parent=%s%s %s",
+            span.name, duration, span.trace_id, span.span_id,
+            f"{span.parent_id:016x}" if span.parent_id is not None else "-",
+            f" error={span.error}" if span.error else "",
+            json.dumps(span.attributes, default=str)
+        )
+
+    def shutdown(self):
+        pass
+
+class MemoryExporter:
+    """Keeps the latest finished spans, for GET /admin/traces."""
+
+    def __init__(self, size: int = TRACING_RING_SIZE):
+        self.spans = deque(maxlen=size)
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def recent(self, limit: int = 100, trace_id: str = None, min_ms: float = 0) -> List[dict]:
+        """The latest spans, newest first; with trace_id, every span kept of that trace."""
+        result = []
+        for span in reversed(list(self.spans)):
+            if trace_id is not None and f"{span.trace_id:032x}" != trace_id:
+                continue
+            if span.duration_ms < min_ms:
+                continue
+            result.append(span.to_dict())
+            if len(result) == limit:
+                break
+        return result
+
+    def shutdown(self):
+        pass
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 is a string in OTLP/JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: dict) -> List[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+class OTLPFileExporter:
+    """Appends OTLP/JSON ExportTraceServiceRequests to a file, one line every interval seconds.
+
+    Spans are buffered in memory and written from a background thread, so
+    exporting costs a list append on the traced path.
+    """
+
+    def __init__(
+        self,
+        path: str = TRACING_OTLP_FILE,
+        interval: float = TRACING_OTLP_INTERVAL,
+        service_name: str = TRACING_SERVICE_NAME
+    ):
+        self.path = path
+        self.interval = interval
+        self.resource = {"attributes": _otlp_attributes({"service.name": service_name})}
+        self.buffer: List[Span] = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def export(self, span: Span):
+        with self.lock:
+            self.buffer.append(span)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="otlp-file-exporter", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def _span(self, span: Span) -> dict:
+        result = {
+            "traceId": f"{span.trace_id:032x}",
+            "spanId": f"{span.span_id:016x}",
+            "name": span.name,
+            # SERVER for the root of a trace, INTERNAL for its phases
+            "kind": 2 if span.parent_id is None else 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": _otlp_attributes(span.attributes),
+            "status": {"code": 2, "message": span.error} if span.error else {},
+        }
+        if span.parent_id is not None:
+            result["parentSpanId"] = f"{span.parent_id:016x}"
+        return result
+
+    def flush(self):
+        with self.lock:
+            spans, self.buffer = self.buffer, []
+        if not spans:
+            return
+        request = {
+            "resourceSpans": [{
+                "resource": self.resource,
+                "scopeSpans": [{"scope": {"name": "ankachat"}, "spans": [self._span(span) for span in spans]}]
+            }]
+        }
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(request, separators=(",", ":")) + "\n")
+        except OSError:
+            logger.exception("Could not write %d spans to %s", len(spans), self.path)
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+EXPORTERS = {
+    "log": LogExporter,
+    "memory": MemoryExporter,
+    "otlp": OTLPFileExporter,
+}
+
+def exporters_from_setting(setting: str) -> List[object]:
+    exporters = []
+    for name in filter(None, (part.strip().lower() for part in setting.split(","))):
+        if name not in EXPORTERS:
+            raise ValueError(f"Unknown span exporter {name!r}, expected one of {', '.join(EXPORTERS)}")
+        exporters.append(EXPORTERS[name]())
+    return exporters
+
+
+# Create a global tracer instance
+tracer = Tracer(exporters_from_setting(TRACING_EXPORTERS))
+
+class TracingMiddleware:
+    """One trace per HTTP request, named after the route that handled it."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        with tracer.span("http.request", **{"http.method": scope["method"]}) as span:
+            async def traced_send(message):
+                if message["type"] == "http.response.start":
+                    span.set("http.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, traced_send)
+            finally:
+                # Filled in by the router once the request is matched
+                route = scope.get("route")
+                span.update_name(f"{scope['method']} {route.path if route is not None else 'unmatched'}")
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context.trace_span = tracer.span("db.query", statement=statement[:STATEMENT_MAX_LENGTH])
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, "trace_span", None)
+    if span is not None:
+        span.end()
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    span = getattr(context, "trace_span", None) if context is not None else None
+    if span is not None and span.recording:
+        span.error = type(exception_context.original_exception).__name__
+        span.end()
+
+def _before_commit(session):
+    session.info["trace_span"] = tracer.span("db.commit")
+
+def _after_commit(session):
+    span = session.info.pop("trace_span", None)
+    if span is not None:
+        span.end()
+
+def _after_soft_rollback(session, previous_transaction):
+    # The commit failed
+    span = session.info.pop("trace_span", None)
+    if span is not None and span.recording:
+        span.error = "rollback"
+        span.end()
+
+def instrument_database(*engines: Engine):
+    """A span for every statement run on the engines, and every session commit."""
+    for engine in engines:
+        if not event.contains(engine, "before_cursor_execute", _before_execute):
+            event.listen(engine, "before_cursor_execute", _before_execute)
+            event.listen(engine, "after_cursor_execute", _after_execute)
+            event.listen(engine, "handle_error", _handle_error)
+    if not event.contains(Session, "before_commit", _before_commit):
+        # Async sessions commit through a Session too
+        event.listen(Session, "before_commit", _before_commit)
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_soft_rollback", _after_soft_rollback)
@@ -0,0 +1,137 @@
+"""Tiered message storage: archiving throughput and archived page latency.
+
+Fills a temporary SQLite database with old synthetic messages spread over
+a few channels, times a 50-message history page at several depths from
+the full messages table, then archives everything with MessageArchive and
+times the same pages served from the segment files (first read of a
+block and cached), including the overlay and username lookups that
+get_messages_by_channel does. Also reports archiving throughput and the
+database size before and after (VACUUMed) next to the archive's size.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_archive --messages 2000000 --depths 0 10000 500000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, desc, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models import Message, User
+from app.utils.archive import MessageArchive
+
+PAGE_SIZE = 50
+CHANNELS = 4
+REPEAT = 5
+
+def fill(engine, count: int):
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": 1, "username": "anka", "email": "anka@example.com", "hashed_password": "x"}])
+        batch = []
+        for i in range(1, count + 1):
+            batch.append({
+                "id": i,
+                "content": f"message {i}: a line of ordinary chat text, about as long as most of them are",
+                "user_id": 1,
+                # Channel 1 gets half of the traffic
+                "channel_id": 1 if i % 2 else i % CHANNELS + 1,
+                "created_at": start + timedelta(seconds=i)
+            })
+            if len(batch) == 50000:
+                conn.execute(insert(Message), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Message), batch)
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+async def best_of(function, repeat: int = REPEAT) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+async def time_pages(session_factory, archive: MessageArchive, cursors):
+    results = {}
+    async with session_factory() as db:
+        for depth, cursor in cursors.items():
+            async def from_table():
+                query = select(Message, User.username).join(User, Message.user_id == User.id) \
+                    .where(Message.channel_id == 1, Message.id < cursor).order_by(desc(Message.id)).limit(PAGE_SIZE)
+                rows = (await db.execute(query)).all()
+                assert len(rows) == PAGE_SIZE
+
+            async def from_archive():
+                page = await archive.page(db, 1, PAGE_SIZE, before_id=cursor)
+                assert len(page) == PAGE_SIZE
+
+            if archive.current_watermark():
+                archive.blocks.clear()
+                results[("archive, first read", depth)] = await best_of(from_archive, 1)
+                results[("archive, cached", depth)] = await best_of(from_archive)
+            else:
+                results[("messages table", depth)] = await best_of(from_table)
+    return results
+
+def main(count: int, depths):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "archive.db")
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+        archive = MessageArchive(
+            path=os.path.join(tmp, "archive"),
+            after_days=1,
+            session_factory=sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        )
+
+        print(f"filling {count} messages...")
+        fill(engine, count)
+        with engine.connect() as conn:
+            cursors = {}
+            for depth in depths:
+                cursors[depth] = conn.execute(
+                    select(Message.id).where(Message.channel_id == 1).order_by(desc(Message.id)).offset(depth).limit(1)
+                ).scalar() + 1
+        database_before = os.path.getsize(path)
+
+        results = asyncio.run(time_pages(session_factory, archive, cursors))
+
+        start = time.perf_counter()
+        threshold = datetime.utcnow() - timedelta(days=1)
+        while archive.archive_step(threshold) == archive.batch_size:
+            pass
+        elapsed = time.perf_counter() - start
+        with engine.connect() as conn:
+            conn.execute(text("VACUUM"))
+            remaining = conn.execute(text("SELECT count(*) FROM messages")).scalar()
+
+        results.update(asyncio.run(time_pages(session_factory, archive, cursors)))
+        asyncio.run(async_engine.dispose())
+
+        print(f"archived {archive.stats['archived']} messages in {elapsed:.1f}s "
+              f"({archive.stats['archived'] / elapsed:,.0f}/s), {remaining} left in the table")
+        print(f"database {database_before / 2**20:.0f} MiB -> {os.path.getsize(path) / 2**20:.1f} MiB, "
+              f"archive {directory_size(archive.path) / 2**20:.0f} MiB")
+        for (name, depth), elapsed in results.items():
+            print(f"{name:20} depth {depth:>9}  {elapsed * 1000:7.2f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 10_000, 500_000])
+    args = parser.parse_args()
+    main(args.messages, args.depths)
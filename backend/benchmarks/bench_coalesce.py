@@ -0,0 +1,130 @@
+"""Outbound coalescing: write syscalls and CPU per delivered event.
+
+Publishes chat events into one channel at a fixed rate for a few seconds
+and delivers them to N connected sockets through ConnectionManager, once
+per coalescing window. Each fake socket writes every frame it is given to
+/dev/null with os.write, i.e. one write syscall per WebSocket frame, the
+way an ASGI server hands each frame to the transport.
+
+Reported per delivered event: socket writes, write syscalls seen by the
+kernel (from /proc/self/io, Linux only) and process CPU time.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_coalesce --sockets 100 --rates 100 1000 10000 --windows 0 5 20
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from app.sockets.connection_manager import ConnectionManager
+from app.sockets.frames import Frame
+
+class DevNullSocket:
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.writes = 0
+
+    # No subprotocols offered: plain JSON, as before
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.writes += 1
+        os.write(self.fd, data.encode("utf-8"))
+
+    async def send_bytes(self, data: bytes):
+        self.writes += 1
+        os.write(self.fd, data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+def write_syscalls():
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def make_frame(i: int) -> Frame:
+    return Frame.from_event({
+        "type": "chat_message",
+        "data": {
+            "id": i,
+            "content": f"message number {i} with a bit of typical chat text",
+            "user_id": 1,
+            "username": "anka",
+            "channel_id": 1,
+            "created_at": datetime(2024, 1, 1).isoformat()
+        }
+    })
+
+async def run(sockets_count: int, rate: int, window_ms: int, duration: float, fd: int):
+    manager = ConnectionManager(queue_size=rate * int(duration + 1) + 16)
+    sockets = [DevNullSocket(fd) for _ in range(sockets_count)]
+    for i, socket in enumerate(sockets):
+        await manager.connect(socket, 1, {"id": i}, coalesce_ms=window_ms)
+    frames = [make_frame(i) for i in range(256)]
+
+    syscalls_before = write_syscalls()
+    cpu_before = time.process_time()
+
+    # Publish in 1 ms ticks, catching up if delivery falls behind
+    events = int(rate * duration)
+    start = time.perf_counter()
+    for i in range(events):
+        await manager.broadcast(frames[i % len(frames)], 1)
+        delay = start + (i + 1) / rate - time.perf_counter()
+        if delay > 0.001:
+            await asyncio.sleep(delay)
+        elif i % 64 == 0:
+            await asyncio.sleep(0)
+
+    # Let every writer drain its queue
+    while any(client.queue.qsize() or client.carry for client in manager.outbound.values()):
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(window_ms / 1000 + 0.01)
+
+    cpu = time.process_time() - cpu_before
+    syscalls_after = write_syscalls()
+    delivered = events * sockets_count
+    writes = sum(socket.writes for socket in sockets)
+    syscalls = syscalls_after - syscalls_before if syscalls_before is not None else None
+
+    for socket in sockets:
+        manager.disconnect(socket)
+    await manager.stop()
+    return delivered, writes, syscalls, cpu, manager.stats["dropped_messages"]
+
+async def main(sockets_count: int, rates, windows, duration: float):
+    fd = os.open(os.devnull, os.O_WRONLY)
+    print(f"{sockets_count} sockets, {duration:.0f}s per run")
+    print(f"{'rate/s':>7} {'window':>7} {'delivered':>10} {'writes/ev':>10} {'syscw/ev':>9} {'cpu us/ev':>10} {'dropped':>8}")
+    try:
+        for rate in rates:
+            for window_ms in windows:
+                delivered, writes, syscalls, cpu, dropped = await run(sockets_count, rate, window_ms, duration, fd)
+                syscalls_per_event = f"{syscalls / delivered:9.3f}" if syscalls is not None else f"{'n/a':>9}"
+                print(
+                    f"{rate:>7} {window_ms:>5}ms {delivered:>10} {writes / delivered:>10.3f} "
+                    f"{syscalls_per_event} {cpu / delivered * 1e6:>10.2f} {dropped:>8}"
+                )
+    finally:
+        os.close(fd)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=100)
+    parser.add_argument("--rates", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--windows", type=int, nargs="+", default=[0, 5, 20])
+    parser.add_argument("--duration", type=float, default=2.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.sockets, args.rates, args.windows, args.duration))
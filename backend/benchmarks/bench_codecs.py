@@ -0,0 +1,121 @@
+"""Encode/decode CPU and wire size per event: stdlib json, orjson and MessagePack.
+
+Socket payloads are a chat message as broadcast (with channel_id and seq
+spliced in), a trickled ICE candidate, an SDP offer and a presence update.
+For each one the benchmark times encoding and decoding with each codec and
+reports the bytes on the wire; "frame -> msgpack" is what a MessagePack
+socket actually costs the server, converting a JSON frame once (shared by
+every MessagePack recipient in the channel).
+
+The REST comparison is a 50-message history page: FastAPI's default path
+(response_model validation, jsonable_encoder, json.dumps) against returning
+FastJSONResponse directly as get_messages_by_channel now does.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_codecs --iterations 20000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from typing import List
+
+import msgpack
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from app.schemas.message import MessageWithUserResponse
+from app.sockets.codecs import MsgpackCodec
+from app.sockets.frames import Frame
+from app.utils.codecs import FastJSONResponse
+
+SDP = "\r\n".join(
+    ["v=0", "o=- 4611731400430051336 2 IN IP4 127.0.0.1", "s=-", "t=0 0", "a=group:BUNDLE 0", "a=msid-semantic: WMS"]
+    + ["m=audio 9 UDP/TLS/RTP/SAVPF 111 63 103 104 9 0 8 106 105 13 110 112 113 126", "c=IN IP4 0.0.0.0"]
+    + [f"a=rtpmap:{pt} opus/48000/2" for pt in range(96, 128)]
+    + [f"a=candidate:{i} 1 udp 2122260223 192.168.1.{i} 5{i:04d} typ host generation 0" for i in range(8)]
+)
+
+def payloads():
+    return {
+        "chat": {
+            "seq": 1792328956441002, "channel_id": 12, "type": "chat_message",
+            "data": {
+                "id": 48211, "content": "Yarın akşam sekizde buluşuyoruz, herkes gelebiliyor mu?", "user_id": 7,
+                "username": "ayse", "channel_id": 12, "created_at": "2026-10-18T13:09:16.443175"
+            }
+        },
+        "ice-candidate": {
+            "channel_id": 4, "type": "ice-candidate", "target": 9,
+            "signal": {
+                "candidate": "candidate:842163049 1 udp 1677729535 203.0.113.7 61004 typ srflx raddr 0.0.0.0 rport 0 "
+                             "generation 0 ufrag 8hhy network-cost 999",
+                "sdpMid": "0", "sdpMLineIndex": 0
+            },
+            "from": {"id": 7, "username": "ayse"}
+        },
+        "offer": {
+            "channel_id": 4, "type": "offer", "target": 9, "signal": {"type": "offer", "sdp": SDP},
+            "from": {"id": 7, "username": "ayse"}
+        },
+        "presence": {
+            "channel_id": 12, "type": "presence_update",
+            "data": {"channel_id": 12, "count": 31, "joined": [{"id": 7, "username": "ayse"}], "left": [3, 18]}
+        },
+    }
+
+def per_call(function, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+def socket_payloads(iterations: int):
+    codec = MsgpackCodec()
+    print(f"{'payload':14} {'codec':16} {'encode':>9} {'decode':>9} {'bytes':>7}")
+    for name, event in payloads().items():
+        stdlib = json.dumps(event, separators=(",", ":"))
+        fast = orjson.dumps(event)
+        packed = msgpack.packb(event)
+        rows = [
+            ("json (stdlib)", lambda: json.dumps(event, separators=(",", ":")), lambda: json.loads(stdlib), len(stdlib.encode())),
+            ("orjson", lambda: orjson.dumps(event), lambda: orjson.loads(fast), len(fast)),
+            ("msgpack", lambda: msgpack.packb(event), lambda: msgpack.unpackb(packed), len(packed)),
+            ("frame -> msgpack", lambda: codec.encode(Frame(fast)), None, len(packed)),
+        ]
+        for label, encode, decode, size in rows:
+            encode_us = per_call(encode, iterations) * 1e6
+            decode_us = f"{per_call(decode, iterations) * 1e6:7.2f}us" if decode else f"{'-':>9}"
+            print(f"{name:14} {label:16} {encode_us:7.2f}us {decode_us} {size:7}")
+
+def rest_page(iterations: int):
+    page = [
+        {
+            "id": 50000 - i, "content": f"message {i}: a line of ordinary chat text, about as long as most of them are",
+            "user_id": i % 20, "channel_id": 12, "created_at": datetime(2026, 10, 18, 13, 9, 16, i), "username": f"user{i % 20}"
+        }
+        for i in range(50)
+    ]
+    adapter = TypeAdapter(List[MessageWithUserResponse])
+
+    def default_path():
+        # What FastAPI does with a response_model and the default JSONResponse
+        return JSONResponse(jsonable_encoder(adapter.validate_python(page))).body
+
+    def direct():
+        return FastJSONResponse(page).body
+
+    assert json.loads(default_path()) == json.loads(direct())
+    iterations = max(1, iterations // 10)
+    print(f"\n50-message history page: validated + json {per_call(default_path, iterations) * 1e6:8.1f}us, "
+          f"FastJSONResponse {per_call(direct, iterations) * 1e6:6.1f}us, {len(direct())} bytes")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20_000)
+    args = parser.parse_args()
+    socket_payloads(args.iterations)
+    rest_page(args.iterations)
@@ -0,0 +1,133 @@
+"""History export: streaming NDJSON against paging the history route with offsets.
+
+Fills a temporary SQLite database with synthetic messages over a few
+channels, then:
+
+- pages through channel 1 the way exports used to, 50 messages at a time
+  with limit/offset (the query get_messages_by_channel runs), and reports
+  the total and the time of the last page, which grows with the offset;
+- archives the older half of the messages and streams the whole server
+  (every channel, archive and messages table) through export_messages and
+  the NDJSON encoder, plain and gzipped, reporting messages/s and bytes;
+- repeats the plain export under tracemalloc for its peak memory, which
+  should stay at about one batch whatever the number of messages.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_export --messages 1000000 --paged 100000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, desc, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models import Message, User
+from app.utils.archive import MessageArchive
+from app.utils.export import EXPORT_BATCH_SIZE, ExportFilter, export_messages, gzipped, ndjson
+
+PAGE_SIZE = 50
+CHANNELS = 4
+
+def fill(engine, count: int):
+    # The older half is more than a day old and gets archived
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": 1, "username": "anka", "email": "anka@example.com", "hashed_password": "x"}])
+        batch = []
+        for i in range(1, count + 1):
+            batch.append({
+                "id": i,
+                "content": f"message {i}: a line of ordinary chat text, about as long as most of them are",
+                "user_id": 1,
+                "channel_id": i % CHANNELS + 1,
+                "created_at": now - timedelta(days=2 if i <= count // 2 else 0)
+            })
+            if len(batch) == 50000:
+                conn.execute(insert(Message), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Message), batch)
+
+async def offset_pages(session_factory, count: int):
+    async with session_factory() as db:
+        pages, last_page = 0, 0.0
+        start = time.perf_counter()
+        for offset in range(0, count, PAGE_SIZE):
+            page_start = time.perf_counter()
+            rows = (await db.execute(
+                select(Message, User.username).join(User, Message.user_id == User.id)
+                .where(Message.channel_id == 1).order_by(desc(Message.id)).limit(PAGE_SIZE).offset(offset)
+            )).all()
+            last_page = time.perf_counter() - page_start
+            pages += 1
+            if len(rows) < PAGE_SIZE:
+                break
+        return pages, time.perf_counter() - start, last_page
+
+async def export(session_factory, archive: MessageArchive, compress: bool, batch_size: int):
+    chunks = ndjson(export_messages(
+        list(range(1, CHANNELS + 1)), ExportFilter(), batch_size, session_factory=session_factory, archive=archive
+    ))
+    if compress:
+        chunks = gzipped(chunks)
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+    return size
+
+def main(count: int, paged: int, batch_size: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.db")
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+        archive = MessageArchive(
+            path=os.path.join(tmp, "archive"),
+            after_days=1,
+            session_factory=sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        )
+
+        print(f"filling {count} messages...")
+        fill(engine, count)
+
+        # Offset paging before anything is archived, so it all comes from the messages table
+        pages, elapsed, last_page = asyncio.run(offset_pages(session_factory, paged))
+        print(f"offset paging   {pages * PAGE_SIZE:>10} messages {elapsed:7.2f}s "
+              f"({pages * PAGE_SIZE / elapsed:>9,.0f}/s), last page {last_page * 1000:.2f} ms")
+
+        threshold = datetime.utcnow() - timedelta(days=1)
+        while archive.archive_step(threshold) == archive.batch_size:
+            pass
+        print(f"archived through id {archive.current_watermark()}")
+
+        for compress in (False, True):
+            start = time.perf_counter()
+            size = asyncio.run(export(session_factory, archive, compress, batch_size))
+            elapsed = time.perf_counter() - start
+            label = "export, gzip" if compress else "export"
+            print(f"{label:15} {count:>10} messages {elapsed:7.2f}s ({count / elapsed:>9,.0f}/s), "
+                  f"{size / 2**20:.1f} MiB")
+
+        tracemalloc.start()
+        asyncio.run(export(session_factory, archive, False, batch_size))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"peak traced memory during export: {peak / 2**20:.1f} MiB (batch size {batch_size})")
+        asyncio.run(async_engine.dispose())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--paged", type=int, default=100_000, help="messages of channel 1 to page through with offsets")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+    main(args.messages, args.paged, args.batch_size)
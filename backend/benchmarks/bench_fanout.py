@@ -0,0 +1,121 @@
+"""Fan-out micro-benchmark: one event delivered to N sockets.
+
+Compares the old path (json.dumps per event, or per target for voice
+signaling, and a str sent to every socket) with serialize-once frames in
+text and binary mode. Sockets are in-memory fakes that do the same
+str -> bytes work an ASGI server does for a text frame.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_fanout --sockets 1000 --events 200
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from app.sockets.connection_manager import ConnectionManager
+from app.sockets.frames import Frame
+
+class FakeSocket:
+    def __init__(self):
+        self.bytes_sent = 0
+
+    # No subprotocols offered: plain JSON, as before
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        # What the server does before writing a text frame
+        self.bytes_sent += len(data.encode("utf-8"))
+
+    async def send_bytes(self, data: bytes):
+        self.bytes_sent += len(data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+def make_event(i: int) -> dict:
+    return {
+        "type": "chat_message",
+        "data": {
+            "id": i,
+            "content": "Merhaba dünya! " * 8,
+            "user_id": 42,
+            "username": "anka",
+            "channel_id": 1,
+            "created_at": datetime.now().isoformat()
+        }
+    }
+
+async def bench_legacy(sockets, events: int) -> float:
+    # Pre-change behaviour: serialize per event, send a str to each socket in turn
+    start = time.perf_counter()
+    for i in range(events):
+        message = json.dumps(make_event(i))
+        for socket in sockets:
+            await socket.send_text(message)
+    return time.perf_counter() - start
+
+async def bench_legacy_signaling(sockets, events: int) -> float:
+    # Pre-change voice signaling: json.dumps inside the per-target loop
+    start = time.perf_counter()
+    for i in range(events):
+        signal = make_event(i)
+        for socket in sockets:
+            await socket.send_text(json.dumps(signal))
+    return time.perf_counter() - start
+
+async def bench_frames(sockets, events: int, binary: bool) -> float:
+    # Serialize-once frames on the bare send path, without queueing
+    start = time.perf_counter()
+    for i in range(events):
+        frame = Frame.from_event(make_event(i))
+        for socket in sockets:
+            if binary:
+                await socket.send_bytes(frame.data)
+            else:
+                await socket.send_text(frame.text)
+    return time.perf_counter() - start
+
+async def bench_manager(sockets, events: int, binary: bool) -> float:
+    manager = ConnectionManager(queue_size=events + 1)
+    for socket in sockets:
+        await manager.connect(socket, 1, {"id": id(socket)}, binary)
+
+    start = time.perf_counter()
+    for i in range(events):
+        await manager.broadcast(Frame.from_event(make_event(i)), 1)
+    # Let every writer drain its queue
+    while any(client.queue.qsize() for client in manager.outbound.values()):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    for socket in sockets:
+        manager.disconnect(socket)
+    return elapsed
+
+async def main(socket_count: int, events: int):
+    results = {}
+    results["legacy_text"] = await bench_legacy([FakeSocket() for _ in range(socket_count)], events)
+    results["legacy_signaling"] = await bench_legacy_signaling([FakeSocket() for _ in range(socket_count)], events)
+    results["frame_text"] = await bench_frames([FakeSocket() for _ in range(socket_count)], events, binary=False)
+    results["frame_binary"] = await bench_frames([FakeSocket() for _ in range(socket_count)], events, binary=True)
+    # Full path through the per-connection queues and writer tasks
+    results["manager_text"] = await bench_manager([FakeSocket() for _ in range(socket_count)], events, binary=False)
+    results["manager_binary"] = await bench_manager([FakeSocket() for _ in range(socket_count)], events, binary=True)
+
+    deliveries = socket_count * events
+    print(f"{events} events x {socket_count} sockets")
+    for name, elapsed in results.items():
+        print(f"{name:18} {elapsed * 1000:9.1f} ms  {elapsed / deliveries * 1e9:8.0f} ns/delivery")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.sockets, args.events))
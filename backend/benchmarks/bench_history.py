@@ -0,0 +1,99 @@
+"""Channel history page latency: OFFSET pagination vs. keyset cursors.
+
+Fills one channel of a temporary SQLite database with synthetic messages,
+then times a 50-message page at several depths using the old query
+(ORDER BY created_at DESC LIMIT/OFFSET, no composite index) and the
+keyset query used by get_messages_by_channel (id < before_id on the
+(channel_id, id) index).
+
+Run from the backend directory (the default builds ~1M rows):
+
+    python -m benchmarks.bench_history --messages 1150000 --offsets 10000 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, desc, insert, select
+
+from app.database import Base
+from app.models import Message, User
+
+PAGE_SIZE = 50
+REPEAT = 5
+
+def fill(engine, count: int):
+    start = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": 1, "username": "anka", "email": "anka@example.com", "hashed_password": "x"}])
+        batch = []
+        for i in range(1, count + 1):
+            batch.append({
+                "id": i,
+                "content": f"message {i}",
+                "user_id": 1,
+                "channel_id": 1 if i % 10 else 2,
+                "created_at": start + timedelta(seconds=i)
+            })
+            if len(batch) == 50000:
+                conn.execute(insert(Message), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Message), batch)
+
+def timed(conn, query) -> float:
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        rows = conn.execute(query).all()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert rows, "page is empty, use more --messages"
+    return best
+
+def base_query():
+    return select(Message, User.username).join(User, Message.user_id == User.id) \
+        .where(Message.channel_id == 1)
+
+def main(count: int, offsets):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'history.db')}")
+        Base.metadata.create_all(bind=engine)
+        index = next(index for index in Message.__table__.indexes if index.name == "ix_messages_channel_id_id")
+        index.drop(bind=engine)
+
+        print(f"filling {count} messages...")
+        fill(engine, count)
+
+        with engine.connect() as conn:
+            # Cursor values for each depth: the id just above the page at that offset
+            cursors = {}
+            for offset in offsets:
+                cursors[offset] = conn.execute(
+                    select(Message.id).where(Message.channel_id == 1).order_by(desc(Message.id)).offset(offset).limit(1)
+                ).scalar()
+
+            results = {}
+            for offset in offsets:
+                query = base_query().order_by(desc(Message.created_at)).limit(PAGE_SIZE).offset(offset)
+                results[("offset, no index", offset)] = timed(conn, query)
+
+        index.create(bind=engine)
+        with engine.connect() as conn:
+            for offset in offsets:
+                query = base_query().order_by(desc(Message.id)).limit(PAGE_SIZE).offset(offset)
+                results[("offset, index", offset)] = timed(conn, query)
+                query = base_query().where(Message.id < cursors[offset] + 1).order_by(desc(Message.id)).limit(PAGE_SIZE)
+                results[("keyset", offset)] = timed(conn, query)
+
+        for (name, offset), elapsed in results.items():
+            print(f"{name:18} depth {offset:>9}  {elapsed * 1000:9.2f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_150_000)
+    parser.add_argument("--offsets", type=int, nargs="+", default=[0, 10_000, 1_000_000])
+    args = parser.parse_args()
+    main(args.messages, args.offsets)
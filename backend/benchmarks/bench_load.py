@@ -0,0 +1,649 @@
+"""End-to-end load test: the real app, real sockets, chat and voice traffic.
+
+The other benchmarks time one component in-process. This one starts the
+app with uvicorn against a temporary SQLite database, the way it runs in
+production, and:
+
+- registers --users synthetic users through /auth, creates --servers
+  servers with a text and a voice channel each and adds every user to
+  one of them (user i joins server i % servers);
+- opens --chat sockets on /ws/chat and --voice sockets on /ws/voice,
+  spread over the users and channels, from --workers client processes;
+- sends chat messages at --rate messages/s in total, and voice signals
+  (ice-candidate to another participant) at --voice-rate, for --duration
+  seconds, then waits --drain seconds for what is still in flight.
+
+Messages carry their send time (time.monotonic, which is system-wide on
+Linux), so every delivery is an end-to-end latency sample: client to
+server, persisted through the message writer, fanned out and received.
+
+Reported: send and delivery rates, delivery latency p50/p99/p999/max,
+deliveries missing at the end, the server's CPU and its memory per open
+socket (RSS from /proc, Linux only), client CPU (a saturated client
+makes the latencies meaningless), and messages persisted per second (from
+/metrics).
+
+Results are written as JSON with --output. --baseline FILE compares the
+run against an earlier one, and --compare A B two saved runs, without
+running anything; either way the exit status is 1 when a figure is worse
+than the baseline by more than --threshold percent. Settings are passed to
+the server with --env, to judge them the same way:
+
+    python -m benchmarks.bench_load --chat 2000 --rate 500 --output before.json
+    python -m benchmarks.bench_load --chat 2000 --rate 500 --env WS_WRITE_BATCH_SIZE=256 --baseline before.json
+    python -m benchmarks.bench_load --compare before.json after.json
+
+Run from the backend directory.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import websockets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from app.utils.codecs import dumps, loads
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "load-test-password"
+MARKER = "load "
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# Figures compared against a baseline, and whether more is better
+COMPARED = [
+    ("chat.sent_per_second", True),
+    ("chat.delivered_per_second", True),
+    ("chat.missing", False),
+    ("chat.latency_ms.p50", False),
+    ("chat.latency_ms.p99", False),
+    ("chat.latency_ms.p999", False),
+    ("voice.delivered_per_second", True),
+    ("voice.missing", False),
+    ("voice.latency_ms.p50", False),
+    ("voice.latency_ms.p99", False),
+    ("voice.latency_ms.p999", False),
+    ("server.cpu_percent", False),
+    ("server.memory_per_connection_kb", False),
+    ("persistence.per_second", True),
+]
+
+# Server side
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def raise_file_limit():
+    # Thousands of sockets on each side; the server inherits the limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+def process_usage(pid: int):
+    """CPU seconds (user + system) and resident memory in bytes of a process."""
+    with open(f"/proc/{pid}/stat") as f:
+        # Fields after the command name, which may contain spaces; utime and stime are fields 14 and 15
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+                break
+    return cpu, rss
+
+def start_server(tmp: str, port: int, env_overrides: dict, log):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'load.db')}",
+        "ASYNC_DATABASE_URL": "",
+        "ARCHIVE_DIR": os.path.join(tmp, "archive"),
+        # Setup registers every user: cheap hashes keep it short, and nothing measured depends on them
+        "BCRYPT_ROUNDS": "4",
+        "SECRET_KEY": env.get("SECRET_KEY") or "load-test-secret",
+        "ALGORITHM": env.get("ALGORITHM") or "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": env.get("ACCESS_TOKEN_EXPIRE_MINUTES") or "600",
+    })
+    env.update(env_overrides)
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--no-access-log",
+    ]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def request(url: str, method: str = "GET", json_body=None, form=None, token: str = None, timeout: float = 120):
+    headers = {}
+    data = None
+    if json_body is not None:
+        data = dumps(json_body)
+        headers["Content-Type"] = "application/json"
+    elif form is not None:
+        data = urllib.parse.urlencode(form).encode("utf-8")
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    with urllib.request.urlopen(urllib.request.Request(url, data, headers, method=method), timeout=timeout) as response:
+        return response.read()
+
+def wait_until_up(process, url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            request(f"{url}/", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+def scrape(url: str) -> dict:
+    """Unlabelled samples from /metrics, by name."""
+    samples = {}
+    for line in request(f"{url}/metrics", timeout=30).decode("utf-8").splitlines():
+        if line and not line.startswith("#") and "{" not in line:
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+def populate(url: str, users: int, servers: int, concurrency: int):
+    """Users with their tokens, and each server's text and voice channel."""
+    def user(i: int):
+        name = f"load{i}"
+        user_id = loads(request(f"{url}/auth/register", "POST", json_body={
+            "username": name, "email": f"{name}@example.org", "password": PASSWORD
+        }))["id"]
+        token = loads(request(f"{url}/auth/token", "POST", form={"username": name, "password": PASSWORD}))
+        return {"id": user_id, "token": token["access_token"]}
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        accounts = list(pool.map(user, range(users)))
+        # The first user owns every server
+        owner = accounts[0]["token"]
+
+        def server(i: int):
+            server_id = loads(request(f"{url}/servers/", "POST", json_body={"name": f"load {i}"}, token=owner))["id"]
+            channels = {}
+            for kind in ("text", "voice"):
+                channels[kind] = loads(request(f"{url}/channels/", "POST", json_body={
+                    "name": f"load {kind}", "type": kind, "server_id": server_id
+                }, token=owner))["id"]
+            members = [account["id"] for index, account in enumerate(accounts) if index % servers == i]
+            request(f"{url}/servers/{server_id}/members", "POST", json_body={"user_ids": members}, token=owner)
+            return channels
+
+        channels = list(pool.map(server, range(servers)))
+    return accounts, channels
+
+def plan_sockets(accounts, channels, chat: int, voice: int, workers: int):
+    """Each worker's sockets, and how many sockets every message sent to a channel or user reaches."""
+    servers = len(channels)
+    sockets = []
+    chat_counts, voice_counts = {}, {}
+    for i in range(chat):
+        account = accounts[i % len(accounts)]
+        channel_id = channels[(i % len(accounts)) % servers]["text"]
+        sockets.append({"kind": "chat", "channel_id": channel_id, "user_id": account["id"], "token": account["token"]})
+        chat_counts[channel_id] = chat_counts.get(channel_id, 0) + 1
+    voice_users = {}
+    for i in range(voice):
+        account = accounts[i % len(accounts)]
+        channel_id = channels[(i % len(accounts)) % servers]["voice"]
+        sockets.append({"kind": "voice", "channel_id": channel_id, "user_id": account["id"], "token": account["token"]})
+        key = f"{channel_id}:{account['id']}"
+        voice_counts[key] = voice_counts.get(key, 0) + 1
+        voice_users.setdefault(channel_id, set()).add(account["id"])
+    for entry in sockets:
+        if entry["kind"] == "voice":
+            # Signals go to another participant of the channel, like an ICE candidate to a peer
+            entry["peers"] = sorted(voice_users[entry["channel_id"]] - {entry["user_id"]})
+    random.Random(0).shuffle(sockets)
+    return [sockets[i::workers] for i in range(workers)], chat_counts, voice_counts
+
+# Client side (one process per worker)
+
+class Client:
+    def __init__(self, entry: dict, options: dict):
+        self.entry = entry
+        self.options = options
+        self.socket = None
+
+    async def connect(self, base: str):
+        entry, options = self.entry, self.options
+        query = f"token={entry['token']}"
+        if options["encoding"] == "binary":
+            query += "&binary=true"
+        if options["coalesce_ms"]:
+            query += f"&coalesce_ms={options['coalesce_ms']}"
+        path = "chat" if entry["kind"] == "chat" else "voice"
+        self.socket = await websockets.connect(
+            f"{base}/ws/{path}/{entry['channel_id']}?{query}",
+            subprotocols=["ankachat.msgpack"] if options["encoding"] == "msgpack" else None,
+            compression="deflate" if options["deflate"] else None,
+            max_size=None, ping_interval=None, open_timeout=120, close_timeout=1
+        )
+
+    def encode(self, event: dict):
+        if self.options["encoding"] == "msgpack":
+            return msgpack.packb(event)
+        return dumps(event).decode("utf-8")
+
+    def decode(self, message):
+        if isinstance(message, bytes) and self.options["encoding"] == "msgpack":
+            return msgpack.unpackb(message)
+        return loads(message)
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {"chat": array("d"), "voice": array("d")}
+        self.closed = 0
+
+    def record(self, event, now: float):
+        if isinstance(event, list):
+            # A coalesced batch
+            for item in event:
+                self.record(item, now)
+            return
+        if not isinstance(event, dict):
+            return
+        kind = event.get("type")
+        if kind == "chat_message":
+            content = (event.get("data") or {}).get("content", "")
+            if content.startswith(MARKER):
+                self.latencies["chat"].append(now - float(content[len(MARKER):].split(" ", 1)[0]))
+        elif kind == "ice-candidate":
+            sent = (event.get("signal") or {}).get("ts")
+            if sent is not None:
+                self.latencies["voice"].append(now - sent)
+
+    async def receive(self, client: Client):
+        try:
+            async for message in client.socket:
+                self.record(client.decode(message), time.monotonic())
+        except websockets.ConnectionClosed:
+            pass
+        self.closed += 1
+
+async def pace(clients, rate: float, start: float, end: float, send):
+    """Calls send on the clients in turn, rate times per second in total, from start until end."""
+    if rate <= 0 or not clients:
+        return 0
+    await asyncio.sleep(max(0.0, start - time.monotonic()))
+    sent = 0
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            return sent
+        due = int((now - start) * rate) - sent
+        for _ in range(due):
+            await send(clients[sent % len(clients)])
+            sent += 1
+        await asyncio.sleep(0.001)
+
+async def run_clients(sockets, options: dict, conn):
+    base = options["url"].replace("http://", "ws://", 1)
+    clients = [Client(entry, options) for entry in sockets]
+    limit = asyncio.Semaphore(options["connect_concurrency"])
+    failed = 0
+
+    async def connect(client: Client):
+        nonlocal failed
+        async with limit:
+            try:
+                await client.connect(base)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                failed += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(connect(client) for client in clients))
+    clients = [client for client in clients if client.socket is not None]
+    recorder = Recorder()
+    receivers = [asyncio.create_task(recorder.receive(client)) for client in clients]
+    conn.send({"connected": len(clients), "failed": failed, "seconds": time.monotonic() - started})
+
+    # The parent sends the common start time once every worker is connected
+    loop = asyncio.get_running_loop()
+    start = await loop.run_in_executor(None, conn.recv)
+    end = start + options["duration"]
+    share = options["workers"]
+    expected = {"chat": 0, "voice": 0}
+    size = options["size"]
+
+    async def send_chat(client: Client):
+        content = f"{MARKER}{time.monotonic():.6f} "
+        content += "x" * max(0, size - len(content))
+        await client.socket.send(client.encode({"type": "chat_message", "data": {"content": content}}))
+        expected["chat"] += options["chat_counts"][client.entry["channel_id"]]
+
+    async def send_voice(client: Client):
+        peers = client.entry["peers"]
+        if not peers:
+            return
+        target = random.choice(peers)
+        await client.socket.send(client.encode({
+            "type": "ice-candidate",
+            "target": target,
+            "signal": {"candidate": "candidate:1 1 udp 2122260223 10.0.0.1 54400 typ host", "ts": time.monotonic()}
+        }))
+        expected["voice"] += options["voice_counts"][f"{client.entry['channel_id']}:{target}"]
+
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    sent_chat, sent_voice = await asyncio.gather(
+        pace([c for c in clients if c.entry["kind"] == "chat"], options["rate"] / share, start, end, send_chat),
+        pace([c for c in clients if c.entry["kind"] == "voice"], options["voice_rate"] / share, start, end, send_voice),
+    )
+    await asyncio.sleep(max(0.0, end + options["drain"] - time.monotonic()))
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    closed = recorder.closed
+
+    for client in clients:
+        await client.socket.close()
+    for receiver in receivers:
+        receiver.cancel()
+    conn.send({
+        "sent": {"chat": sent_chat, "voice": sent_voice},
+        "expected": expected,
+        "latencies": {kind: values.tobytes() for kind, values in recorder.latencies.items()},
+        # Sockets closed before the end, by the server
+        "closed": closed,
+        "cpu_seconds": (cpu_end.ru_utime + cpu_end.ru_stime) - (cpu_start.ru_utime + cpu_start.ru_stime),
+    })
+
+def worker(sockets, options: dict, conn):
+    asyncio.run(run_clients(sockets, options, conn))
+
+# Results
+
+def percentiles(values: array) -> dict:
+    if not values:
+        return {"p50": None, "p99": None, "p999": None, "max": None, "mean": None}
+    ordered = sorted(values)
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+    return {
+        "p50": at(0.5),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(ordered[-1] * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+def traffic(kind: str, reports, duration: float) -> dict:
+    latencies = array("d")
+    for report in reports:
+        latencies.frombytes(report["latencies"][kind])
+    sent = sum(report["sent"][kind] for report in reports)
+    expected = sum(report["expected"][kind] for report in reports)
+    return {
+        "sent": sent,
+        "sent_per_second": round(sent / duration, 1),
+        "expected": expected,
+        "delivered": len(latencies),
+        # Rates are over the sending time; deliveries that arrive while draining count too
+        "delivered_per_second": round(len(latencies) / duration, 1),
+        # Share of deliveries that never arrived (dropped for slow consumers, or still queued)
+        "missing": round(max(0, expected - len(latencies)) / expected, 6) if expected else 0.0,
+        "latency_ms": percentiles(latencies),
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args) -> dict:
+    files = raise_file_limit()
+    if args.encoding == "msgpack" and msgpack is None:
+        raise SystemExit("--encoding msgpack needs the msgpack package")
+    env_overrides = dict(item.split("=", 1) for item in args.env)
+    with tempfile.TemporaryDirectory() as tmp, open(os.path.join(tmp, "server.log"), "w+") as log:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = start_server(tmp, port, env_overrides, log)
+        processes = []
+        try:
+            wait_until_up(server, url)
+            print(f"server pid {server.pid} on port {port}, file limit {files}")
+
+            started = time.monotonic()
+            accounts, channels = populate(url, args.users, args.servers, args.setup_concurrency)
+            print(f"{args.users} users, {args.servers} servers in {time.monotonic() - started:.1f}s")
+            plans, chat_counts, voice_counts = plan_sockets(accounts, channels, args.chat, args.voice, args.workers)
+            time.sleep(1)
+            _, rss_idle = process_usage(server.pid)
+
+            options = {
+                "url": url,
+                "encoding": args.encoding,
+                "coalesce_ms": args.coalesce_ms,
+                "deflate": args.deflate,
+                "connect_concurrency": args.connect_concurrency,
+                "duration": args.duration,
+                "drain": args.drain,
+                "rate": args.rate,
+                "voice_rate": args.voice_rate,
+                "size": args.size,
+                "workers": args.workers,
+                "chat_counts": chat_counts,
+                "voice_counts": voice_counts,
+            }
+            context = multiprocessing.get_context("spawn")
+            pipes = []
+            for plan in plans:
+                parent, child = context.Pipe()
+                process = context.Process(target=worker, args=(plan, options, child), daemon=True)
+                process.start()
+                processes.append(process)
+                pipes.append(parent)
+            connected = [pipe.recv() for pipe in pipes]
+            sockets = sum(report["connected"] for report in connected)
+            failed = sum(report["failed"] for report in connected)
+            connect_seconds = max(report["seconds"] for report in connected)
+            print(f"{sockets} sockets open ({failed} failed) in {connect_seconds:.1f}s")
+            # Let the presence announcements of the newcomers go out before measuring
+            time.sleep(args.settle)
+            _, rss_connected = process_usage(server.pid)
+
+            before = scrape(url)
+            start = time.monotonic() + 0.5
+            for pipe in pipes:
+                pipe.send(start)
+            time.sleep(max(0.0, start - time.monotonic()))
+            cpu_start, _ = process_usage(server.pid)
+            time.sleep(args.duration)
+            cpu_end, _ = process_usage(server.pid)
+            reports = [pipe.recv() for pipe in pipes]
+            _, rss_end = process_usage(server.pid)
+            after = scrape(url)
+        finally:
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            if server.returncode not in (0, -15, None):
+                log.seek(0)
+                print(log.read()[-4000:], file=sys.stderr)
+
+    def delta(name: str) -> float:
+        return after.get(name, 0) - before.get(name, 0)
+
+    window = args.duration + args.drain
+    client_cpu = sum(report["cpu_seconds"] for report in reports)
+    persisted = delta("ankachat_messages_persisted_total")
+    return {
+        "benchmark": "load",
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            key: getattr(args, key) for key in (
+                "users", "servers", "chat", "voice", "rate", "voice_rate", "size", "duration", "drain",
+                "workers", "encoding", "coalesce_ms", "deflate",
+            )
+        } | {"env": env_overrides},
+        "results": {
+            "connections": {
+                "open": sockets,
+                "failed": failed,
+                "connect_seconds": round(connect_seconds, 3),
+                "closed_by_server": sum(report["closed"] for report in reports),
+            },
+            "chat": traffic("chat", reports, args.duration),
+            "voice": traffic("voice", reports, args.duration),
+            "server": {
+                "cpu_seconds": round(cpu_end - cpu_start, 3),
+                "cpu_percent": round((cpu_end - cpu_start) / args.duration * 100, 1),
+                "rss_idle_mb": round(rss_idle / 2**20, 1),
+                "rss_connected_mb": round(rss_connected / 2**20, 1),
+                "rss_end_mb": round(rss_end / 2**20, 1),
+                "memory_per_connection_kb": round((rss_connected - rss_idle) / sockets / 1024, 2) if sockets else None,
+                "dropped_messages": delta("ankachat_ws_dropped_messages_total"),
+                "slow_disconnects": delta("ankachat_ws_slow_disconnects_total"),
+            },
+            "client": {
+                "cpu_seconds": round(client_cpu, 3),
+                "cpu_percent": round(client_cpu / window * 100, 1),
+            },
+            "persistence": {
+                "messages": persisted,
+                "per_second": round(persisted / args.duration, 1),
+                "batches": delta("ankachat_persist_batches_total"),
+                "errors": delta("ankachat_persist_errors_total"),
+            },
+        },
+    }
+
+def report(result: dict):
+    results = result["results"]
+    connections, server, client = results["connections"], results["server"], results["client"]
+    print(f"sockets          {connections['open']} open, {connections['failed']} failed, "
+          f"{connections['closed_by_server']} closed by the server")
+    for kind in ("chat", "voice"):
+        traffic = results[kind]
+        if not traffic["sent"]:
+            continue
+        latency = traffic["latency_ms"]
+        print(f"{kind:16} sent {traffic['sent_per_second']:>9,.1f}/s, delivered {traffic['delivered_per_second']:>10,.1f}/s, "
+              f"missing {traffic['missing']:.2%}")
+        if latency["p50"] is not None:
+            print(f"{'':16} latency p50 {latency['p50']:.2f} ms, p99 {latency['p99']:.2f} ms, "
+                  f"p999 {latency['p999']:.2f} ms, max {latency['max']:.2f} ms")
+    print(f"server           cpu {server['cpu_percent']:.1f}%, rss {server['rss_idle_mb']} -> "
+          f"{server['rss_connected_mb']} -> {server['rss_end_mb']} MiB, "
+          f"{server['memory_per_connection_kb']} KiB per socket, {server['dropped_messages']:.0f} dropped")
+    print(f"client           cpu {client['cpu_percent']:.1f}% of one core in total")
+    print(f"persistence      {results['persistence']['per_second']:,.1f} messages/s in "
+          f"{results['persistence']['batches']:.0f} batches")
+
+# Comparison
+
+def lookup(results: dict, path: str):
+    for key in path.split("."):
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """Prints the figures side by side; True when one is worse than the baseline by more than threshold percent."""
+    for key in ("users", "chat", "voice", "rate", "voice_rate", "duration"):
+        if baseline["config"].get(key) != current["config"].get(key):
+            print(f"warning: {key} differs ({baseline['config'].get(key)} vs {current['config'].get(key)}), "
+                  f"the runs are not directly comparable")
+    print(f"{'':34} {'baseline':>12} {'current':>12} {'change':>9}")
+    regressed = False
+    for path, higher_is_better in COMPARED:
+        old, new = lookup(baseline["results"], path), lookup(current["results"], path)
+        if old is None or new is None:
+            continue
+        if old == new:
+            change = 0.0
+        elif old == 0:
+            change = float("inf") if new > 0 else float("-inf")
+        else:
+            change = (new - old) / abs(old) * 100
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        elif -worse > threshold:
+            flag = "  improved"
+        print(f"{path:34} {old:>12,.3f} {new:>12,.3f} {change:>+8.1f}%{flag}")
+    return regressed
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--chat", type=int, default=2000, help="chat sockets")
+    parser.add_argument("--voice", type=int, default=200, help="voice sockets")
+    parser.add_argument("--rate", type=float, default=200, help="chat messages sent per second, in total")
+    parser.add_argument("--voice-rate", type=float, default=200, help="voice signals sent per second, in total")
+    parser.add_argument("--size", type=int, default=64, help="chat message length")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after sending")
+    parser.add_argument("--settle", type=float, default=2, help="seconds between connecting and sending")
+    parser.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 1) // 2)),
+                        help="client processes")
+    parser.add_argument("--encoding", choices=["json", "binary", "msgpack"], default="json")
+    parser.add_argument("--coalesce-ms", type=int, default=0)
+    parser.add_argument("--deflate", action="store_true", help="negotiate permessage-deflate, as browsers do")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="handshakes in flight per worker")
+    parser.add_argument("--setup-concurrency", type=int, default=20)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="setting for the server")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this earlier run")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two saved runs and exit")
+    parser.add_argument("--threshold", type=float, default=10, help="percent worse than the baseline that fails")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(load(args.compare[0]), load(args.compare[1]), args.threshold) else 0)
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.output}")
+    if args.baseline:
+        sys.exit(1 if compare(load(args.baseline), result, args.threshold) else 0)
@@ -0,0 +1,103 @@
+"""Cost of the metrics instrumentation on the hot paths, and of a scrape.
+
+Times, per call:
+- a histogram observation, unlabelled and by route label;
+- an indexed SQLite lookup on a plain engine against one instrumented by
+  instrument_database (statement timing per route);
+- ConnectionManager._deliver to a channel of N local sockets, which now
+  observes the fan-out and delivery time (reported next to the share the
+  two observations take of it);
+- rendering /metrics with every collector the app registers.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_metrics --iterations 200000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select
+
+from app.database import Base
+from app.models import User
+from app.routes import metrics as metrics_route  # noqa: F401 (registers the scrape-time collectors)
+from app.sockets.codecs import JSONCodec
+from app.sockets.connection_manager import ClientConnection, ConnectionManager
+from app.sockets.frames import Frame
+from app.utils.metrics import Histogram, instrument_database, metrics
+
+class FakeSocket:
+    # No subprotocols offered: plain JSON, as before
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+def per_call(function, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+def observations(iterations: int):
+    histogram = Histogram("bench_seconds", "Benchmark histogram")
+    labelled = Histogram("bench_route_seconds", "Benchmark histogram by route", ["route"])
+    print(f"histogram observe             {per_call(lambda: histogram.observe(0.003), iterations) * 1e9:8.0f} ns")
+    print(f"histogram observe, by route   "
+          f"{per_call(lambda: labelled.labels('/messages/channel/{channel_id}').observe(0.003), iterations) * 1e9:8.0f} ns")
+
+def queries(iterations: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for instrumented in (False, True):
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, f'{instrumented}.db')}")
+            Base.metadata.create_all(bind=engine)
+            with engine.begin() as conn:
+                conn.execute(insert(User), [
+                    {"id": i, "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": "x"}
+                    for i in range(1, 1001)
+                ])
+            if instrumented:
+                instrument_database(engine)
+            query = select(User.username).where(User.id == 500)
+            with engine.connect() as conn:
+                results[instrumented] = per_call(lambda: conn.execute(query).scalar(), iterations // 10)
+            engine.dispose()
+    print(f"indexed query, plain engine   {results[False] * 1e6:8.2f} us")
+    print(f"indexed query, instrumented   {results[True] * 1e6:8.2f} us "
+          f"(+{(results[True] - results[False]) * 1e9:.0f} ns)")
+
+async def deliveries(iterations: int, recipients: int):
+    manager = ConnectionManager(queue_size=iterations + 1)
+    for i in range(recipients):
+        websocket = FakeSocket()
+        # Queues only: no writer tasks, so the loop measures delivery alone
+        manager.outbound[websocket] = ClientConnection(websocket, iterations + 1, JSONCodec())
+        manager.connection_user[websocket] = {"id": i, "username": f"user{i}"}
+        manager.subscribe(websocket, 1)
+    frame = Frame.from_event({"type": "chat_message", "data": {"id": 1, "content": "hello"}})
+    iterations = max(1, iterations // recipients)
+    elapsed = per_call(lambda: manager._deliver(1, frame, None, None), iterations)
+    overhead = per_call(lambda: (manager.delivery_seconds.observe(0.0001), manager.fanout.observe(recipients)), iterations)
+    print(f"deliver to {recipients:>5} sockets      {elapsed * 1e6:8.2f} us, observations {overhead * 1e9:.0f} ns "
+          f"({overhead / elapsed:.1%})")
+
+def scrape(iterations: int):
+    iterations = max(1, iterations // 100)
+    text = metrics.render()
+    print(f"render /metrics               {per_call(metrics.render, iterations) * 1e6:8.1f} us, "
+          f"{len(text.splitlines())} lines")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    parser.add_argument("--recipients", type=int, nargs="+", default=[1, 50, 1000])
+    args = parser.parse_args()
+    observations(args.iterations)
+    queries(args.iterations)
+    for recipients in args.recipients:
+        asyncio.run(deliveries(args.iterations, recipients))
+    scrape(args.iterations)
@@ -0,0 +1,98 @@
+"""Chat message persistence benchmark: inline commits vs. group commit.
+
+Many concurrent producers (standing in for chat sockets) each save a
+stream of messages against a temporary SQLite database. The inline mode
+reproduces the old per-message add/commit/refresh on the event loop; the
+other modes go through MessageWriter with different batch settings.
+Reports throughput and per-message latency percentiles.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_persistence --producers 200 --messages 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models import Message
+from app.sockets.persistence import MessageWriter
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def make_session_factory(path: str):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async def run_inline(session_factory, producers: int, messages: int):
+    db = session_factory()
+    latencies = []
+
+    async def producer(user_id: int):
+        for i in range(messages):
+            start = time.perf_counter()
+            message = Message(content=f"message {i}", user_id=user_id, channel_id=user_id % 10)
+            db.add(message)
+            db.commit()
+            db.refresh(message)
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(producer(user_id) for user_id in range(producers)))
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed, latencies
+
+async def run_writer(session_factory, producers: int, messages: int, batch_size: int, delay_ms: float):
+    writer = MessageWriter(session_factory, batch_size=batch_size, batch_delay_ms=delay_ms)
+    writer.start()
+    latencies = []
+
+    async def producer(user_id: int):
+        for i in range(messages):
+            start = time.perf_counter()
+            await writer.save(f"message {i}", user_id, user_id % 10)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(producer(user_id) for user_id in range(producers)))
+    elapsed = time.perf_counter() - start
+    await writer.stop()
+    return elapsed, latencies
+
+def report(name: str, elapsed: float, latencies):
+    total = len(latencies)
+    print(
+        f"{name:24} {total / elapsed:9.0f} msg/s"
+        f"  p50 {statistics.median(latencies) * 1000:7.2f} ms"
+        f"  p99 {percentile(latencies, 99) * 1000:7.2f} ms"
+    )
+
+async def main(producers: int, messages: int):
+    settings = [(1, 0), (16, 2), (64, 5), (256, 10)]
+    with tempfile.TemporaryDirectory() as tmp:
+        elapsed, latencies = await run_inline(make_session_factory(os.path.join(tmp, "inline.db")), producers, messages)
+        report("inline commit", elapsed, latencies)
+
+        for batch_size, delay_ms in settings:
+            path = os.path.join(tmp, f"batch-{batch_size}.db")
+            elapsed, latencies = await run_writer(make_session_factory(path), producers, messages, batch_size, delay_ms)
+            report(f"batch={batch_size} delay={delay_ms}ms", elapsed, latencies)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--producers", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.producers, args.messages))
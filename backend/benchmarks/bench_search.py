@@ -0,0 +1,228 @@
+"""Message search latency: FTS index vs. scanning with LIKE.
+
+Fills a temporary SQLite database with a synthetic corpus (words drawn
+from a Zipf-like vocabulary, spread over many servers and channels),
+builds the FTS5 index from it the way search_index.create() does for an
+existing database, and then times search_messages' query for common,
+rare and multi-word terms, scoped to a busy channel, a quiet one, one server and every
+server of a user, first page and a deep page. The same searches as a
+LIKE '%word%' scan over the messages table are timed for comparison
+(pass --like-limit 0 to skip them on big corpora).
+
+It also measures what the write hook costs: inserting messages in
+MessageWriter-sized batches with and without indexing them.
+
+Run from the backend directory (the default builds 10M messages, which
+takes a while and a few GB of disk):
+
+    python -m benchmarks.bench_search --messages 10000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database import Base
+from app.models import Channel, Message, Server, User, server_members
+from app.utils.search import SearchIndex
+
+SERVERS = 200
+CHANNELS_PER_SERVER = 10
+VOCABULARY = 50_000
+BODIES = 200_000
+PAGE_SIZE = 25
+REPEAT = 5
+# The searching user is in a tenth of the servers
+MEMBER_SERVERS = list(range(1, SERVERS + 1, 10))
+
+def make_vocabulary(rng: random.Random):
+    letters = "abcdefghijklmnopqrstuvwxyzçğıöşü"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+def make_bodies(rng: random.Random, words):
+    # A fixed pool of message texts is enough to give every term a realistic frequency
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    bodies = []
+    for _ in range(BODIES):
+        bodies.append(" ".join(rng.choices(words, weights, k=rng.randint(3, 20))))
+    return bodies
+
+def fill(engine, count: int, bodies, rng: random.Random):
+    start = datetime(2024, 1, 1)
+    channels = SERVERS * CHANNELS_PER_SERVER
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": "x"} for i in range(1, 101)
+        ])
+        conn.execute(insert(Server), [{"id": i, "name": f"server {i}", "owner_id": 1} for i in range(1, SERVERS + 1)])
+        conn.execute(insert(Channel), [
+            {"id": i, "name": f"channel {i}", "type": "text", "server_id": (i - 1) // CHANNELS_PER_SERVER + 1}
+            for i in range(1, channels + 1)
+        ])
+        conn.execute(insert(server_members), [{"user_id": 1, "server_id": i} for i in MEMBER_SERVERS])
+
+        batch = []
+        for i in range(1, count + 1):
+            content = bodies[rng.randrange(len(bodies))]
+            if i % 100_000 == 0:
+                content += " zephyrine"
+            batch.append({
+                "id": i,
+                "content": content,
+                "user_id": i % 100 + 1,
+                # Busy channels get most of the traffic
+                "channel_id": min(channels, int(rng.paretovariate(1.2))),
+                "created_at": start + timedelta(seconds=i)
+            })
+            if len(batch) == 50_000:
+                conn.execute(insert(Message), batch)
+                batch = []
+                if i % 1_000_000 == 0:
+                    print(f"  {i} messages")
+        if batch:
+            conn.execute(insert(Message), batch)
+
+def scopes():
+    # (channel_ids, server_ids) as search_messages passes them
+    return {
+        "channel": ([1], None),
+        # Few messages: the newest matches of a common word are mostly elsewhere
+        "quiet": ([SERVERS * CHANNELS_PER_SERVER // 2], None),
+        "server": (None, [1]),
+        "member": (None, MEMBER_SERVERS),
+    }
+
+async def best_of(function) -> float:
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        await function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+async def run_searches(async_engine, index: SearchIndex, terms, like_limit: int):
+    results = []
+    async with async_engine.connect() as conn:
+        for label, query in terms:
+            parsed = index.parse(query)
+            words = query.split()
+            for scope, (channel_ids, server_ids) in scopes().items():
+                rows = []
+
+                async def search(before_id=None):
+                    nonlocal rows
+                    rows = (await conn.execute(index.query(parsed, channel_ids, server_ids, before_id, PAGE_SIZE))).all()
+
+                first = await best_of(search)
+                hits = len(rows)
+                deep = None
+                if hits == PAGE_SIZE:
+                    # Walk ten pages in, then time the page after
+                    cursor = None
+                    for _ in range(10):
+                        await search(cursor)
+                        if len(rows) < PAGE_SIZE:
+                            break
+                        cursor = rows[-1].id
+                    deep = await best_of(lambda: search(cursor))
+
+                like = None
+                if like_limit:
+                    if channel_ids is None:
+                        channel_ids = select(Channel.id).where(Channel.server_id.in_(server_ids))
+                    like_query = select(Message.id) \
+                        .where(Message.channel_id.in_(channel_ids), *[Message.content.like(f"%{word}%") for word in words]) \
+                        .order_by(Message.id.desc()).limit(PAGE_SIZE)
+                    start = time.perf_counter()
+                    await conn.execute(like_query)
+                    like = time.perf_counter() - start
+
+                results.append((label, scope, hits, first, deep, like))
+    return results
+
+def write_cost(engine, index: SearchIndex, bodies, first_id: int, batches: int = 200, batch_size: int = 64):
+    # Inserts MessageWriter-sized batches, one transaction each, with and without the index hook
+    results = {}
+    next_id = first_id
+    for indexed in (False, True):
+        start = time.perf_counter()
+        for _ in range(batches):
+            rows = [{"id": next_id + i, "content": bodies[(next_id + i) % len(bodies)], "user_id": 1, "channel_id": 1}
+                    for i in range(batch_size)]
+            next_id += batch_size
+            with engine.begin() as conn:
+                conn.execute(insert(Message), rows)
+                if indexed:
+                    conn.execute(text(index.backend.insert), rows)
+        results[indexed] = (time.perf_counter() - start) / (batches * batch_size)
+    return results
+
+def main(count: int, like_limit: int, seed: int):
+    rng = random.Random(seed)
+    words = make_vocabulary(rng)
+    bodies = make_bodies(rng, words)
+    terms = [
+        ("common word", words[1]),
+        ("mid word", words[500]),
+        ("rare word", "zephyrine"),
+        ("two words", f"{words[2]} {words[40]}"),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "search.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=engine)
+
+        print(f"filling {count} messages...")
+        start = time.perf_counter()
+        fill(engine, count, bodies, rng)
+        print(f"filled in {time.perf_counter() - start:.1f}s, {os.path.getsize(path) / 2**20:.0f} MiB")
+
+        index = SearchIndex("sqlite")
+        start = time.perf_counter()
+        index.create(engine)
+        print(f"index built in {time.perf_counter() - start:.1f}s, database now {os.path.getsize(path) / 2**20:.0f} MiB")
+
+        with engine.connect() as conn:
+            for label, query in terms:
+                matches = conn.execute(
+                    text("SELECT count(*) FROM messages_fts WHERE messages_fts MATCH :q"), {"q": index.parse(query)}
+                ).scalar()
+                print(f"  {label:12} {query!r}: {matches} matching messages")
+
+        if like_limit and count > like_limit:
+            print(f"skipping the LIKE scans above {like_limit} messages")
+            like_limit = 0
+
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        results = asyncio.run(run_searches(async_engine, index, terms, like_limit))
+        asyncio.run(async_engine.dispose())
+
+        print(f"\n{'term':12} {'scope':8} {'hits':>5} {'first page':>11} {'page 11':>9} {'LIKE scan':>10}")
+        for label, scope, hits, first, deep, like in results:
+            deep_ms = f"{deep * 1000:7.2f}ms" if deep is not None else f"{'-':>9}"
+            like_ms = f"{like * 1000:8.1f}ms" if like is not None else f"{'-':>10}"
+            print(f"{label:12} {scope:8} {hits:>5} {first * 1000:9.2f}ms {deep_ms} {like_ms}")
+
+        costs = write_cost(engine, index, bodies, count + 1)
+        print(f"\nwrite cost per message in 64-message batches: "
+              f"{costs[False] * 1e6:.1f} us without the index, {costs[True] * 1e6:.1f} us with it")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10_000_000)
+    parser.add_argument("--like-limit", type=int, default=2_000_000,
+                        help="only run the LIKE comparison up to this many messages (0 disables it)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.messages, args.like_limit, args.seed)
@@ -0,0 +1,88 @@
+"""Targeted voice signaling relay latency with many connected sockets.
+
+Connects N fake sockets spread over voice channels, then relays ICE
+candidates to specific users. The old lookup (scan every connection, then
+a list membership test on the channel) is compared with
+ConnectionManager.send_to_user, which goes through the channel -> user ->
+sockets index. Only the relay (lookup + enqueue) is timed.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_signaling --sockets 10000 --channels 100
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from app.sockets.connection_manager import ConnectionManager
+from app.sockets.frames import Frame
+
+class FakeSocket:
+    # No subprotocols offered: plain JSON, as before
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        pass
+
+    async def send_bytes(self, data: bytes):
+        pass
+
+def legacy_relay(connection_user, active_connections, channel_id: int, target_user_id: int, sent: list):
+    # The scan handle_voice_connection used to do for every targeted signal
+    for conn, conn_user in connection_user.items():
+        if conn_user.get("id") == target_user_id and conn in active_connections.get(channel_id, []):
+            sent.append(conn)
+            break
+
+async def main(socket_count: int, channel_count: int, signals: int):
+    manager = ConnectionManager(queue_size=signals + 1)
+    members = []
+    sockets = []
+    for i in range(socket_count):
+        socket = FakeSocket()
+        channel_id = i % channel_count
+        await manager.connect(socket, channel_id, {"id": i, "username": f"user{i}"})
+        members.append((channel_id, i))
+        sockets.append((socket, channel_id))
+
+    # The old structures: a list per channel and the connection -> user map
+    legacy_channels = {channel_id: list(connections) for channel_id, connections in manager.active_connections.items()}
+    connection_user = dict(manager.connection_user)
+
+    random.seed(1)
+    targets = [random.choice(members) for _ in range(signals)]
+    frame = Frame.from_event({"type": "ice-candidate", "signal": {"candidate": "x" * 64}})
+
+    sent = []
+    start = time.perf_counter()
+    for channel_id, user_id in targets:
+        legacy_relay(connection_user, legacy_channels, channel_id, user_id, sent)
+    legacy = (time.perf_counter() - start) / signals
+
+    start = time.perf_counter()
+    for channel_id, user_id in targets:
+        await manager.send_to_user(frame, channel_id, user_id)
+    indexed = (time.perf_counter() - start) / signals
+
+    start = time.perf_counter()
+    for socket, channel_id in sockets:
+        manager.disconnect(socket)
+    disconnect = (time.perf_counter() - start) / socket_count
+
+    print(f"{socket_count} sockets in {channel_count} channels, {signals} targeted signals")
+    print(f"legacy scan   {legacy * 1e6:10.1f} us/signal")
+    print(f"indexed       {indexed * 1e6:10.1f} us/signal")
+    print(f"disconnect    {disconnect * 1e6:10.1f} us/socket")
+    await manager.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=10000)
+    parser.add_argument("--channels", type=int, default=100)
+    parser.add_argument("--signals", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.sockets, args.channels, args.signals))
@@ -0,0 +1,82 @@
+"""Cost of the tracing hooks, and of running the sampling profiler.
+
+Times, per call:
+- opening and closing a span with tracing off (no exporter: the shared
+  no-op span every hook gets by default), in a trace left out by
+  sampling, and recorded into the memory exporter;
+- the same with the OTLP file exporter, which buffers and writes from its
+  own thread;
+- a CPU-bound loop on the main thread, alone and while the sampling
+  profiler takes samples of it at a few intervals.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_tracing --iterations 200000
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from app.utils.profiler import SamplingProfiler, collapsed
+from app.utils.tracing import MemoryExporter, OTLPFileExporter, Tracer
+
+def per_call(function, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+def nested(tracer: Tracer):
+    # A root and one phase inside it, like a socket message and its broadcast
+    def run():
+        with tracer.span("ws.chat_message", channel_id=1):
+            with tracer.span("broadcast", channel_id=1) as span:
+                span.set("recipients", 50)
+    return run
+
+def spans(iterations: int):
+    cases = [
+        ("tracing off", Tracer([])),
+        ("sampled out (rate 0)", Tracer([MemoryExporter()], sample_rate=0.0)),
+        ("memory exporter", Tracer([MemoryExporter()])),
+    ]
+    for label, tracer in cases:
+        print(f"root + child span, {label:22} {per_call(nested(tracer), iterations) * 1e6:8.2f} us")
+    with tempfile.TemporaryDirectory() as tmp:
+        exporter = OTLPFileExporter(os.path.join(tmp, "traces.jsonl"), interval=0.2)
+        elapsed = per_call(nested(Tracer([exporter])), iterations)
+        exporter.shutdown()
+        size = os.path.getsize(os.path.join(tmp, "traces.jsonl"))
+        print(f"root + child span, {'OTLP file exporter':22} {elapsed * 1e6:8.2f} us ({size / 2**20:.1f} MiB written)")
+
+def busy(iterations: int) -> float:
+    start = time.perf_counter()
+    total = 0
+    for i in range(iterations):
+        total += i * i % 7
+    return time.perf_counter() - start
+
+def profiling(iterations: int, intervals):
+    for interval in intervals:
+        # Measured next to each profiled run, the machine's speed drifts
+        baseline = busy(iterations * 50)
+        profiler = SamplingProfiler()
+        result = {}
+        # Long enough to cover the loop even when sampling slows it down
+        thread = threading.Thread(target=lambda: result.update(counts=profiler.profile(baseline * 2, interval / 1000)))
+        thread.start()
+        elapsed = busy(iterations * 50)
+        thread.join()
+        stacks = collapsed(result["counts"]).count("\n")
+        print(f"busy loop {baseline:.3f} s, sampled every {interval:>4g} ms {elapsed:.3f} s "
+              f"({elapsed / baseline - 1:+.1%}), {profiler.stats['samples']} samples, {stacks} stacks")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    parser.add_argument("--intervals", type=float, nargs="+", default=[1, 10, 50], help="profiler intervals in ms")
+    args = parser.parse_args()
+    spans(args.iterations)
+    profiling(args.iterations, args.intervals)
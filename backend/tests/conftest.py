@@ -0,0 +1,66 @@
+"""Shared setup for the backend tests.
+
+The app reads its settings on import, so the environment is set up here,
+before any test module imports it: a throwaway database and data directory,
+and no background archiver (tests that need archiving run its steps
+themselves).
+
+Run from the backend directory:
+
+    python -m pytest tests
+"""
+import os
+import tempfile
+import uuid
+
+DATA_DIR = tempfile.mkdtemp(prefix="ankachat-tests-")
+os.environ["DATA_DIR"] = DATA_DIR
+os.environ["DATABASE_URL"] = f"sqlite:///{DATA_DIR}/test.db"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ["ARCHIVE_AFTER_DAYS"] = "0"
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+class TestUser:
+    __test__ = False
+
+    def __init__(self, client: TestClient, username: str):
+        response = client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "password"
+        })
+        assert response.status_code == 201, response.text
+        self.id = response.json()["id"]
+        self.username = username
+        self.token = client.post(
+            "/auth/token", data={"username": username, "password": "password"}
+        ).json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+@pytest.fixture
+def make_user(client):
+    # Usernames are unique across the whole session, which shares one database
+    def make(prefix: str = "user") -> TestUser:
+        return TestUser(client, f"{prefix}_{uuid.uuid4().hex[:8]}")
+    return make
+
+@pytest.fixture
+def make_channel(client):
+    # A new server owned by the user, with one channel of the given type
+    def make(owner: TestUser, type: str = "text") -> dict:
+        server = client.post("/servers/", json={"name": "server"}, headers=owner.headers).json()
+        return client.post("/channels/", json={
+            "name": type,
+            "type": type,
+            "server_id": server["id"]
+        }, headers=owner.headers).json()
+    return make
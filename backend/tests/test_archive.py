@@ -0,0 +1,186 @@
+"""Reads, edits and deletes of messages that moved to the archive, and crash repair."""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app.database import SessionLocal
+from app.models import Message, MessageOverlay
+from app.utils.archive import message_archive
+from app.utils.search import search_index
+
+def insert_old(channel_id: int, user_id: int, contents) -> list:
+    # Messages written long ago, indexed for search like the message writer does
+    db = SessionLocal()
+    try:
+        created_at = datetime.utcnow() - timedelta(days=90)
+        messages = [
+            Message(content=content, user_id=user_id, channel_id=channel_id, created_at=created_at)
+            for content in contents
+        ]
+        db.add_all(messages)
+        db.flush()
+        search_index.add_sync(db, messages)
+        db.commit()
+        return [message.id for message in messages]
+    finally:
+        db.close()
+
+def archive_everything() -> int:
+    # Every message so far counts as old; other tests' messages move too and stay readable
+    moved = 0
+    while True:
+        count = message_archive.archive_step(datetime.utcnow() + timedelta(days=1))
+        moved += count
+        if count < message_archive.batch_size:
+            return moved
+
+def hot_ids(message_ids) -> set:
+    db = SessionLocal()
+    try:
+        return set(db.execute(select(Message.id).where(Message.id.in_(message_ids))).scalars())
+    finally:
+        db.close()
+
+@pytest.fixture
+def archived_channel(client, make_user, make_channel):
+    user = make_user("archive")
+    channel = make_channel(user)
+    old_ids = insert_old(channel["id"], user.id, [f"old message {index} walrus{index}" for index in range(40)])
+    archive_everything()
+    assert not hot_ids(old_ids)
+    # Newer messages stay in the messages table
+    new_ids = [
+        client.post("/messages/", json={"content": f"new message {index}", "channel_id": channel["id"]},
+                    headers=user.headers).json()["id"]
+        for index in range(5)
+    ]
+    return user, channel, old_ids, new_ids
+
+def history(client, user, channel_id: int, query: str = "") -> list:
+    response = client.get(f"/messages/channel/{channel_id}?{query}", headers=user.headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_history_falls_through_to_archive(client, archived_channel):
+    user, channel, old_ids, new_ids = archived_channel
+    expected = list(reversed(old_ids + new_ids))
+
+    assert [message["id"] for message in history(client, user, channel["id"], "limit=100")] == expected
+
+    # Cursor pages walk across the boundary between the table and the archive
+    seen, cursor = [], ""
+    while True:
+        page = history(client, user, channel["id"], f"limit=7&{cursor}")
+        seen += [message["id"] for message in page]
+        if len(page) < 7:
+            break
+        cursor = f"before_id={page[-1]['id']}"
+    assert seen == expected
+
+    walk = history(client, user, channel["id"], f"limit=10&after_id={old_ids[30]}")
+    assert [message["id"] for message in walk] == list(reversed((old_ids + new_ids)[31:41]))
+
+    assert [message["id"] for message in history(client, user, channel["id"], "limit=5&offset=10")] == expected[10:15]
+
+    # Both cursors: still newest first, from before_id down, even when before_id is in the table
+    both = history(client, user, channel["id"], f"limit=8&before_id={new_ids[2]}&after_id={old_ids[5]}")
+    assert [message["id"] for message in both] == list(reversed((old_ids + new_ids)[34:42]))
+
+def test_archived_message_by_id(client, archived_channel):
+    user, _, old_ids, _ = archived_channel
+    response = client.get(f"/messages/?ids={old_ids[0]},{old_ids[1]}", headers=user.headers)
+    assert response.status_code == 200, response.text
+    contents = {message["id"]: message["content"] for message in response.json()["messages"]}
+    assert contents == {old_ids[0]: "old message 0 walrus0", old_ids[1]: "old message 1 walrus1"}
+
+def test_edit_and_delete_archived_messages(client, archived_channel):
+    user, channel, old_ids, _ = archived_channel
+    # Read once so the channel's overlays are cached before they change
+    history(client, user, channel["id"], "limit=100")
+
+    response = client.put(f"/messages/{old_ids[3]}", json={"content": "edited walrus"}, headers=user.headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["content"] == "edited walrus"
+    assert client.delete(f"/messages/{old_ids[4]}", headers=user.headers).status_code == 204
+
+    page = {message["id"]: message["content"] for message in history(client, user, channel["id"], "limit=100")}
+    assert page[old_ids[3]] == "edited walrus"
+    assert old_ids[4] not in page
+    assert client.delete(f"/messages/{old_ids[4]}", headers=user.headers).status_code == 404
+    assert client.put(f"/messages/{old_ids[4]}", json={"content": "x"}, headers=user.headers).status_code == 404
+
+    # Segments are untouched: the changes are overlays
+    db = SessionLocal()
+    try:
+        overlays = {
+            overlay.message_id: (overlay.content, overlay.deleted)
+            for overlay in db.execute(select(MessageOverlay).where(MessageOverlay.channel_id == channel["id"])).scalars()
+        }
+    finally:
+        db.close()
+    assert overlays == {old_ids[3]: ("edited walrus", False), old_ids[4]: (None, True)}
+
+def test_archived_messages_stay_searchable(client, archived_channel):
+    user, channel, old_ids, _ = archived_channel
+
+    def search(query: str) -> list:
+        response = client.get(f"/messages/search?q={query}&channel_id={channel['id']}", headers=user.headers)
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    results = search("walrus7")
+    assert [result["id"] for result in results] == [old_ids[7]]
+    assert results[0]["username"] == user.username
+    assert "<mark>walrus7</mark>" in results[0]["snippet"]
+
+    client.put(f"/messages/{old_ids[7]}", json={"content": "now about narwhals"}, headers=user.headers)
+    client.delete(f"/messages/{old_ids[8]}", headers=user.headers)
+    assert search("walrus7") == []
+    assert [result["id"] for result in search("narwhals")] == [old_ids[7]]
+    assert search("walrus8") == []
+
+def test_repair_after_crash_before_delete(client, make_user, make_channel, monkeypatch):
+    user = make_user("repair")
+    channel = make_channel(user)
+    archive_everything()
+    message_ids = insert_old(channel["id"], user.id, ["kept", "edited later", "deleted later"])
+
+    # The step dies right after the new watermark is written, before the rows are deleted
+    write_manifest = message_archive._write_manifest
+
+    def crash(*args):
+        write_manifest(*args)
+        raise RuntimeError("crash")
+
+    monkeypatch.setattr(message_archive, "_write_manifest", crash)
+    with pytest.raises(RuntimeError):
+        message_archive.archive_step(datetime.utcnow() + timedelta(days=1))
+    monkeypatch.undo()
+    assert message_archive.current_watermark() >= message_ids[-1]
+    assert hot_ids(message_ids) == set(message_ids)
+
+    # Meanwhile the rows, still in the table, are edited and deleted
+    db = SessionLocal()
+    try:
+        db.get(Message, message_ids[1]).content = "edited after the crash"
+        db.delete(db.get(Message, message_ids[2]))
+        db.commit()
+    finally:
+        db.close()
+
+    message_archive._repair()
+
+    assert not hot_ids(message_ids)
+    page = {message["id"]: message["content"] for message in history(client, user, channel["id"], "limit=10")}
+    assert page == {message_ids[0]: "kept", message_ids[1]: "edited after the crash"}
+
+def test_repair_after_completed_step(client, archived_channel):
+    user, channel, old_ids, _ = archived_channel
+    message_archive._repair()
+    assert len(history(client, user, channel["id"], "limit=100")) == len(old_ids) + 5
+    db = SessionLocal()
+    try:
+        assert db.execute(select(MessageOverlay).where(MessageOverlay.channel_id == channel["id"])).first() is None
+    finally:
+        db.close()
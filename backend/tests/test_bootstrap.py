@@ -0,0 +1,51 @@
+"""Number of SQL statements GET /bootstrap runs."""
+import pytest
+from sqlalchemy import event
+
+from app.database import async_engine, engine
+
+# Servers and channels of the first page load, plus one channel's history
+MAX_BOOTSTRAP_STATEMENTS = 3
+
+@pytest.fixture
+def statements():
+    # Every statement, through the sync engine and the async one alike
+    executed = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    for target in (engine, async_engine.sync_engine):
+        event.listen(target, "before_cursor_execute", count)
+    yield executed
+    for target in (engine, async_engine.sync_engine):
+        event.remove(target, "before_cursor_execute", count)
+
+def test_bootstrap_statement_count(client, make_user, statements):
+    user = make_user("bootstrap")
+    headers = user.headers
+    text_channels = []
+    for server_index in range(4):
+        server = client.post("/servers/", json={"name": f"server {server_index}"}, headers=headers).json()
+        for channel_index in range(3):
+            channel = client.post("/channels/", json={
+                "name": f"channel {channel_index}",
+                "type": "voice" if channel_index == 2 else "text",
+                "server_id": server["id"]
+            }, headers=headers).json()
+            if channel["type"] == "text":
+                text_channels.append(channel["id"])
+    for index in range(5):
+        client.post("/messages/", json={"content": f"message {index}", "channel_id": text_channels[-1]}, headers=headers)
+
+    statements.clear()
+    response = client.get("/bootstrap", headers=headers)
+    assert response.status_code == 200, response.text
+    assert len(response.json()["servers"]) == 4
+    assert len(statements) <= MAX_BOOTSTRAP_STATEMENTS, statements
+
+    statements.clear()
+    response = client.get(f"/bootstrap?channel_id={text_channels[0]}", headers=headers)
+    assert response.status_code == 200, response.text
+    assert sum(len(server["channels"]) for server in response.json()["servers"]) == 12
+    assert len(statements) <= MAX_BOOTSTRAP_STATEMENTS, statements
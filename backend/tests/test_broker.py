@@ -0,0 +1,91 @@
+"""SocketBroker client: round trips, request timeouts, backpressure from a stuck broker."""
+import asyncio
+
+import pytest
+
+from app.sockets.broker import BrokerServer, SocketBroker
+from app.sockets.frames import Frame
+
+def ignore(*event):
+    pass
+
+async def stuck_broker(path: str, read: bool):
+    # Accepts workers and never answers; reads their writes only if asked to
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        while read and await reader.read(65536):
+            pass
+
+    server = await asyncio.start_unix_server(handle, path)
+    return server, connections
+
+def test_events_and_requests_round_trip(tmp_path):
+    url = f"unix://{tmp_path}/broker.sock"
+
+    async def run():
+        server = BrokerServer(url)
+        await server.start()
+        delivered = []
+        client = SocketBroker(url)
+        await client.start(lambda channel_id, frame, *rest: delivered.append((channel_id, frame.data)))
+        client.subscribe(7)
+        await client.presence_users(7)
+        client.publish(7, Frame(b'{"type":"chat_message"}'))
+        await client.drain()
+        users = await client.presence_update(7, [{"id": 1, "username": "alice"}], [])
+        while not delivered:
+            await asyncio.sleep(0.01)
+        await client.stop()
+        await server.stop()
+        return delivered, users
+
+    delivered, users = asyncio.run(run())
+    assert delivered[0][0] == 7
+    assert delivered[0][1].startswith(b'{"seq":')
+    assert [user["id"] for user in users.added] == [1]
+
+def test_request_times_out(tmp_path):
+    path = f"{tmp_path}/broker.sock"
+
+    async def run():
+        server, _ = await stuck_broker(path, read=True)
+        client = SocketBroker(f"unix://{path}", request_timeout_ms=100)
+        await client.start(ignore)
+        with pytest.raises(ConnectionError):
+            await client.presence_users(7)
+        pending = dict(client.pending)
+        await client.stop()
+        server.close()
+        return client.stats, pending
+
+    stats, pending = asyncio.run(run())
+    assert stats["timeouts"] == 1
+    assert pending == {}
+
+def test_stuck_broker_holds_publishers_back_and_is_dropped(tmp_path):
+    path = f"{tmp_path}/broker.sock"
+    payload = Frame(b"x" * 65536)
+
+    async def run():
+        server, _ = await stuck_broker(path, read=False)
+        client = SocketBroker(f"unix://{path}", max_buffer=1024 * 1024, request_timeout_ms=100)
+        await client.start(ignore)
+        transport = client.writer.transport
+        # Nobody drains: the buffer stops growing at the high-water mark
+        for _ in range(100):
+            client.publish(7, payload)
+        buffered = transport.get_write_buffer_size()
+        # Publishers waiting on drain() give up on a broker that never reads
+        await client.drain()
+        aborted = transport.is_closing()
+        await client.stop()
+        server.close()
+        return client.stats, buffered, aborted
+
+    stats, buffered, aborted = asyncio.run(run())
+    assert stats["dropped"] > 0
+    assert buffered <= 1024 * 1024 + 2 * 65536
+    assert stats["timeouts"] == 1
+    assert aborted
@@ -0,0 +1,100 @@
+"""Broadcast fan-out: per-connection queues and writers, and the slow consumer policies."""
+import asyncio
+import json
+
+from app.sockets.broker import MemoryBroker
+from app.sockets.connection_manager import SLOW_CONSUMER_CLOSE_CODE, ConnectionManager
+from app.sockets.frames import Frame
+
+CHANNEL = 1
+
+class FakeSocket:
+    """Just enough of a WebSocket for the manager; a stalled one blocks in send until released."""
+
+    def __init__(self, stalled: bool = False, broken: bool = False):
+        self.scope = {"subprotocols": []}
+        self.sent = []
+        self.close_code = None
+        self.broken = broken
+        self.released = asyncio.Event()
+        if not stalled:
+            self.released.set()
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text: str):
+        if self.broken:
+            raise RuntimeError("connection reset")
+        await self.released.wait()
+        self.sent.append(json.loads(text)["data"])
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+async def connected(manager: ConnectionManager, *sockets):
+    for user_id, websocket in enumerate(sockets, 1):
+        await manager.connect(websocket, CHANNEL, {"id": user_id, "username": f"user{user_id}"})
+
+async def broadcast(manager: ConnectionManager, count: int):
+    for number in range(count):
+        await manager.broadcast(Frame.from_event({"type": "event", "data": number}), CHANNEL)
+        # Each writer takes the next frame while a stalled one stays in send
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+
+def test_slow_and_broken_sockets_do_not_hold_up_the_others():
+    async def run():
+        manager = ConnectionManager(broker=MemoryBroker())
+        fast, stalled, broken = FakeSocket(), FakeSocket(stalled=True), FakeSocket(broken=True)
+        await connected(manager, fast, stalled, broken)
+        await broadcast(manager, 3)
+        received = (list(fast.sent), list(stalled.sent))
+        stalled.released.set()
+        await asyncio.sleep(0.01)
+        await manager.stop()
+        return received, stalled.sent
+
+    (fast, stalled_before), stalled_after = asyncio.run(run())
+    assert fast == [0, 1, 2]
+    assert stalled_before == []
+    assert stalled_after == [0, 1, 2]
+
+def test_drop_oldest_keeps_the_newest_events():
+    async def run():
+        manager = ConnectionManager(queue_size=2, slow_consumer_policy="drop_oldest", broker=MemoryBroker())
+        stalled = FakeSocket(stalled=True)
+        await connected(manager, stalled)
+        await broadcast(manager, 5)
+        stalled.released.set()
+        await asyncio.sleep(0.01)
+        await manager.stop()
+        return manager.stats, stalled.sent
+
+    stats, sent = asyncio.run(run())
+    # The first event was already with the writer; the queue kept the newest two
+    assert sent == [0, 3, 4]
+    assert stats["dropped_messages"] == 2
+    assert stats["slow_disconnects"] == 0
+
+def test_disconnect_after_repeated_overflows():
+    async def run():
+        manager = ConnectionManager(
+            queue_size=1, slow_consumer_policy="disconnect", max_overflows=2, broker=MemoryBroker()
+        )
+        stalled, fast = FakeSocket(stalled=True), FakeSocket()
+        await connected(manager, stalled, fast)
+        client = manager.outbound[stalled]
+        await broadcast(manager, 4)
+        state = (stalled in manager.outbound, client.queue.empty(), client.writer.done())
+        await manager.stop()
+        return manager.stats, stalled.close_code, state, fast.sent
+
+    stats, close_code, (still_connected, queue_empty, writer_done), fast = asyncio.run(run())
+    assert stats["overflows"] == 2
+    assert stats["slow_disconnects"] == 1
+    assert close_code == SLOW_CONSUMER_CLOSE_CODE
+    assert not still_connected
+    # Its queued frames are released with the writer
+    assert queue_empty and writer_done
+    assert fast == [0, 1, 2, 3]
@@ -0,0 +1,75 @@
+"""First-page history cache: seeding, writes racing a seed, failed seeds, messages from other workers."""
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from app.routes import messages
+from app.sockets.connection_manager import ConnectionManager
+from app.sockets.frames import Frame
+from app.utils.history_cache import HistoryCache, history_cache
+
+def message(message_id: int, content: str = "hello") -> dict:
+    return {"id": message_id, "content": content, "user_id": 1, "channel_id": 1, "created_at": datetime.utcnow()}
+
+def test_seeded_channel_serves_first_pages():
+    cache = HistoryCache(capacity=3)
+    assert cache.latest(1, 2) is None
+
+    cache.seed(1, [message(2), message(1)], cache.begin_seed(1))
+    assert [item["id"] for item in cache.latest(1, 5)] == [2, 1]
+
+    cache.add(1, message(3))
+    cache.add(1, message(4))
+    # Full now, and no longer known to hold the whole channel
+    assert [item["id"] for item in cache.latest(1, 3)] == [4, 3, 2]
+    assert cache.latest(1, 4) is None
+
+def test_write_during_seed_discards_it():
+    cache = HistoryCache(capacity=3)
+    token = cache.begin_seed(1)
+    cache.update(1, 1, "edited meanwhile")
+    cache.seed(1, [message(1)], token)
+    assert cache.latest(1, 1) is None
+    assert cache.seeding == {}
+
+def test_failed_seed_releases_its_token():
+    cache = HistoryCache(capacity=3)
+    cache.begin_seed(1)
+    token = cache.begin_seed(1)
+    cache.abort_seed(1)
+    assert cache.seeding == {1: [0, 1]}
+
+    cache.seed(1, [message(1)], token)
+    assert cache.seeding == {}
+    assert [item["id"] for item in cache.latest(1, 1)] == [1]
+
+def test_failed_seeding_query_does_not_leak(client, make_user, make_channel, monkeypatch):
+    user = make_user("history")
+    channel = make_channel(user)
+    client.post("/messages/", json={"content": "first", "channel_id": channel["id"]}, headers=user.headers)
+    history_cache.drop(channel["id"])
+
+    async def broken(*args, **kwargs):
+        raise OperationalError("SELECT", {}, Exception("database is gone"))
+
+    monkeypatch.setattr(messages, "load_history", broken)
+    with pytest.raises(OperationalError):
+        client.get(f"/messages/channel/{channel['id']}", headers=user.headers)
+    assert channel["id"] not in history_cache.seeding
+    monkeypatch.undo()
+
+    page = client.get(f"/messages/channel/{channel['id']}", headers=user.headers).json()
+    assert [item["content"] for item in page] == ["first"]
+    assert [item["content"] for item in history_cache.latest(channel["id"], 1)] == ["first"]
+
+def test_messages_from_other_workers_reach_the_cache():
+    cache_channel = 987654
+    history_cache.seed(cache_channel, [message(1)], history_cache.begin_seed(cache_channel))
+    event = Frame.from_event({
+        "type": "chat_message",
+        "data": {**message(2, "from another worker"), "created_at": datetime.utcnow().isoformat()}
+    })
+    ConnectionManager()._deliver(cache_channel, event, None, None, 1)
+    assert [item["content"] for item in history_cache.latest(cache_channel, 2)] == ["from another worker", "hello"]
+    history_cache.drop(cache_channel)
@@ -0,0 +1,109 @@
+"""Message writer: batched writes, one-by-one retry of failed batches, bounded queue."""
+import asyncio
+import threading
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from app.database import SessionLocal
+from app.models import Message
+from app.sockets.persistence import MessageWriter, WriterBusy
+
+def picky_session(**kwargs):
+    # A session that fails any flush holding a "bad" message, after the rows got their ids
+    db = SessionLocal(**kwargs)
+
+    @event.listens_for(db, "after_flush")
+    def check(session, context):
+        if any(isinstance(row, Message) and row.content == "bad" for row in session.new):
+            raise IntegrityError("INSERT INTO messages", {}, Exception("bad message"))
+
+    return db
+
+def saved(message_id: int) -> Message:
+    db = SessionLocal()
+    try:
+        return db.get(Message, message_id)
+    finally:
+        db.close()
+
+def test_batch_is_written_together(make_user, make_channel):
+    user = make_user("writer")
+    channel = make_channel(user)
+    writer = MessageWriter(batch_size=8, batch_delay_ms=50)
+
+    async def run():
+        messages = await asyncio.gather(*(writer.save(f"m{i}", user.id, channel["id"]) for i in range(5)))
+        await writer.stop()
+        return messages
+
+    messages = asyncio.run(run())
+    assert writer.stats["batches"] == 1
+    assert writer.stats["messages"] == 5
+    assert [saved(message.id).content for message in messages] == [f"m{i}" for i in range(5)]
+
+def test_failed_batch_fails_only_the_bad_message(make_user, make_channel):
+    user = make_user("writer")
+    channel = make_channel(user)
+    writer = MessageWriter(session_factory=picky_session, batch_size=8, batch_delay_ms=50)
+    contents = ["one", "bad", "three"]
+
+    async def run():
+        results = await asyncio.gather(
+            *(writer.save(content, user.id, channel["id"]) for content in contents),
+            return_exceptions=True
+        )
+        await writer.stop()
+        return results
+
+    first, failed, third = asyncio.run(run())
+    assert isinstance(failed, IntegrityError)
+    assert saved(first.id).content == "one"
+    assert saved(third.id).content == "three"
+    assert writer.stats["errors"] == 1
+    assert writer.stats["retried"] == 3
+    assert writer.stats["failed"] == 1
+    assert writer.stats["messages"] == 2
+
+def test_full_queue_refuses_messages(make_user, make_channel):
+    user = make_user("writer")
+    channel = make_channel(user)
+    release = threading.Event()
+
+    class StuckWriter(MessageWriter):
+        def _write_batch(self, messages):
+            release.wait(5)
+            super()._write_batch(messages)
+
+    writer = StuckWriter(batch_size=1, batch_delay_ms=0, queue_size=1, queue_timeout_ms=50)
+
+    async def run():
+        # One message held by the stuck writer, one filling the queue
+        pending = [asyncio.create_task(writer.save(f"m{i}", user.id, channel["id"])) for i in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(WriterBusy):
+            await writer.save("refused", user.id, channel["id"])
+        release.set()
+        messages = await asyncio.gather(*pending)
+        await writer.stop()
+        return messages
+
+    messages = asyncio.run(run())
+    assert [message.content for message in messages] == ["m0", "m1"]
+    assert writer.stats["rejected"] == 1
+
+def test_sequence_numbers_are_stored_without_touching_the_message(make_user, make_channel):
+    user = make_user("writer")
+    channel = make_channel(user)
+    writer = MessageWriter()
+
+    async def run():
+        message = await writer.save("numbered", user.id, channel["id"])
+        writer.sequence(message.id, 1234)
+        await writer.stop()
+        return message
+
+    message = saved(asyncio.run(run()).id)
+    assert message.seq == 1234
+    assert message.updated_at is None
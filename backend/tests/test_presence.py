@@ -0,0 +1,117 @@
+"""Presence: debounced joins and leaves, per-user reference counts, socket cleanup."""
+import asyncio
+import time
+
+import pytest
+
+from app.sockets.broker import MemoryBroker
+from app.sockets.connection_manager import ConnectionManager, manager
+from app.sockets.presence import PresenceEngine
+
+ALICE = {"id": 1, "username": "alice"}
+BOB = {"id": 2, "username": "bob"}
+
+def engine(leave_grace_ms: int = 50) -> PresenceEngine:
+    # Flushed by hand: the tick never comes
+    presence = ConnectionManager(broker=MemoryBroker()).presence
+    presence.tick = 3600
+    presence.leave_grace = leave_grace_ms / 1000
+    return presence
+
+def users(presence: PresenceEngine, channel_id: int):
+    return sorted(user["id"] for user in asyncio.run(presence.manager.broker.presence_users(channel_id)))
+
+def test_join_and_leave_are_reported_on_flush():
+    presence = engine()
+    presence.online(10, ALICE)
+    presence.online(10, BOB)
+    assert users(presence, 10) == []
+    asyncio.run(presence.flush())
+    assert users(presence, 10) == [1, 2]
+
+    presence.offline(10, BOB["id"])
+    asyncio.run(presence.flush())
+    # Still within the grace period
+    assert users(presence, 10) == [1, 2]
+    time.sleep(0.06)
+    asyncio.run(presence.flush())
+    assert users(presence, 10) == [1]
+    assert presence.stats["diffs"] == 2
+
+def test_quick_reconnect_never_leaves():
+    presence = engine()
+    presence.online(10, ALICE)
+    asyncio.run(presence.flush())
+    presence.offline(10, ALICE["id"])
+    presence.online(10, ALICE)
+    time.sleep(0.06)
+    asyncio.run(presence.flush())
+    assert users(presence, 10) == [1]
+    assert presence.stats["suppressed_flaps"] == 1
+    assert presence.stats["diffs"] == 1
+
+def test_user_stays_while_any_connection_is_open():
+    presence = engine(leave_grace_ms=0)
+    presence.online(10, ALICE)
+    presence.online(10, ALICE)
+    asyncio.run(presence.flush())
+    presence.offline(10, ALICE["id"])
+    asyncio.run(presence.flush())
+    assert users(presence, 10) == [1]
+    presence.offline(10, ALICE["id"])
+    asyncio.run(presence.flush())
+    assert users(presence, 10) == []
+
+def connections(channel_id: int, user_id: int) -> int:
+    entry = manager.presence.local.get(channel_id, {}).get(user_id)
+    return entry.connections if entry is not None else 0
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_failed_resume_keeps_other_sockets_present(client, make_user, make_channel, monkeypatch):
+    user = make_user("presence")
+    channel = make_channel(user)
+
+    with client.websocket_connect(f"/ws/chat/{channel['id']}?token={user.token}") as first:
+        assert first.receive_json()["type"] == "presence_snapshot"
+        assert connections(channel["id"], user.id) == 1
+
+        async def broken_replay(channel_id, since):
+            raise RuntimeError("broker unavailable")
+
+        monkeypatch.setattr(manager, "replay", broken_replay)
+        with pytest.raises(Exception):
+            with client.websocket_connect(f"/ws/chat/{channel['id']}?token={user.token}&since=5") as second:
+                second.receive_json()
+        monkeypatch.undo()
+
+        # The second socket never entered, so it must not take the first one's count
+        wait_for(lambda: len(manager.outbound) == 1)
+        assert connections(channel["id"], user.id) == 1
+    wait_for(lambda: connections(channel["id"], user.id) == 0)
+
+def test_gateway_leaves_only_entered_channels(client, make_user, make_channel, monkeypatch):
+    user = make_user("gateway")
+    channel = make_channel(user)
+
+    with client.websocket_connect(f"/ws/chat/{channel['id']}?token={user.token}") as chat:
+        chat.receive_json()
+
+        async def broken_replay(channel_id, since):
+            raise RuntimeError("broker unavailable")
+
+        monkeypatch.setattr(manager, "replay", broken_replay)
+        with pytest.raises(Exception):
+            with client.websocket_connect(f"/ws/gateway?token={user.token}") as gateway:
+                assert gateway.receive_json()["type"] == "ready"
+                gateway.send_json({"type": "subscribe", "channel_id": channel["id"], "since": 5})
+                assert gateway.receive_json()["type"] == "subscribed"
+                gateway.receive_json()
+        monkeypatch.undo()
+
+        wait_for(lambda: len(manager.outbound) == 1)
+        assert connections(channel["id"], user.id) == 1
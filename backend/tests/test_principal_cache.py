@@ -0,0 +1,81 @@
+"""Verified-token cache: hits, expiry at the token's exp, the LRU bound, and invalidation on user updates."""
+import time
+from datetime import datetime
+
+from app.schemas.auth import Principal
+from app.utils.auth import PrincipalCache, principal_cache
+
+def principal(user_id: int) -> Principal:
+    return Principal(
+        id=user_id,
+        username=f"user{user_id}",
+        email=f"user{user_id}@example.com",
+        is_active=True,
+        created_at=datetime.utcnow()
+    )
+
+def test_hit_after_set():
+    cache = PrincipalCache(max_size=10, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", principal(1))
+    assert cache.get("a").id == 1
+    assert cache.stats == {"hits": 1, "misses": 1}
+
+def test_entry_expires_at_token_exp():
+    cache = PrincipalCache(max_size=10, ttl=60)
+    # The token is already past its exp: never served from the cache, however long the TTL
+    cache.set("a", principal(1), exp=time.time() - 1)
+    assert cache.get("a") is None
+    assert cache.entries == {}
+    assert cache.tokens_by_user == {}
+
+def test_entry_expires_after_ttl():
+    cache = PrincipalCache(max_size=10, ttl=0)
+    cache.set("a", principal(1), exp=time.time() + 3600)
+    assert cache.get("a") is None
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PrincipalCache(max_size=2, ttl=60)
+    cache.set("a", principal(1))
+    cache.set("b", principal(2))
+    # Touching "a" leaves "b" as the oldest
+    assert cache.get("a") is not None
+    cache.set("c", principal(3))
+    assert list(cache.entries) == ["a", "c"]
+    assert 2 not in cache.tokens_by_user
+
+def test_invalidate_user_drops_all_their_tokens():
+    cache = PrincipalCache(max_size=10, ttl=60)
+    cache.set("a", principal(1))
+    cache.set("b", principal(1))
+    cache.set("c", principal(2))
+    cache.invalidate_user(1)
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c").id == 2
+    assert cache.tokens_by_user == {2: {"c"}}
+
+def test_requests_reuse_the_cached_principal(client, make_user):
+    user = make_user("cached")
+    assert client.get("/users/me", headers=user.headers).status_code == 200
+    assert user.token in principal_cache.entries
+
+    hits = principal_cache.stats["hits"]
+    assert client.get("/users/me", headers=user.headers).json()["username"] == user.username
+    assert principal_cache.stats["hits"] == hits + 1
+
+def test_user_update_invalidates_cached_principal(client, make_user):
+    user = make_user("renamed")
+    assert client.get("/users/me", headers=user.headers).status_code == 200
+    assert user.token in principal_cache.entries
+
+    response = client.put("/users/me", json={"username": f"{user.username}_new"}, headers=user.headers)
+    assert response.status_code == 200, response.text
+    assert user.token not in principal_cache.entries
+    assert user.id not in principal_cache.tokens_by_user
+
+    # The token names the old username, which no longer exists: a stale cached
+    # principal would have let it through
+    misses = principal_cache.stats["misses"]
+    assert client.get("/users/me", headers=user.headers).status_code == 401
+    assert principal_cache.stats["misses"] == misses + 1
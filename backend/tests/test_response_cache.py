@@ -0,0 +1,137 @@
+"""ETags and cached bodies for servers, channel lists and profiles: 304s, hits, and invalidation on writes."""
+from app.schemas.user import UserResponse
+from app.utils.response_cache import ResponseCache, response_cache
+
+def body(user_id: int, username: str) -> UserResponse:
+    return UserResponse(id=user_id, username=username, email=f"{username}@example.com", is_active=True, created_at="2024-01-01T00:00:00")
+
+def test_bump_retires_cached_body():
+    cache = ResponseCache(max_size=10, ttl=60)
+    assert cache.get("user", 1) is None
+    cache.put("user", 1, cache.version("user", 1), body(1, "a"))
+    assert cache.get("user", 1) is not None
+
+    cache.user_changed(1)
+    assert cache.get("user", 1) is None
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 2
+    assert cache.stats["invalidations"] == 1
+
+def test_body_loaded_across_a_bump_is_not_kept():
+    cache = ResponseCache(max_size=10, ttl=60)
+    version = cache.version("user", 1)
+    cache.user_changed(1)
+    entry = cache.put("user", 1, version, body(1, "a"))
+    assert entry.body
+    assert cache.entries == {}
+
+def test_least_recently_used_body_is_evicted():
+    cache = ResponseCache(max_size=2, ttl=60)
+    for user_id in (1, 2):
+        cache.put("user", user_id, 0, body(user_id, f"u{user_id}"))
+    assert cache.get("user", 1) is not None
+    cache.put("user", 3, 0, body(3, "u3"))
+    assert list(cache.entries) == [("user", 1), ("user", 3)]
+
+def test_expired_body_is_reloaded():
+    cache = ResponseCache(max_size=10, ttl=-1)
+    cache.put("user", 1, 0, body(1, "a"))
+    assert cache.get("user", 1) is None
+
+def test_etag_is_derived_from_the_body():
+    cache = ResponseCache(max_size=10, ttl=60)
+    first = cache.put("user", 1, 0, body(1, "a"))
+    same = cache.put("user", 2, 0, body(1, "a"))
+    other = cache.put("user", 3, 0, body(1, "b"))
+    assert first.etag == same.etag != other.etag
+
+def revalidate(client, url: str, headers: dict):
+    # Fetch, then ask again with the ETag we were given
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200, response.text
+    etag = response.headers["ETag"]
+    again = client.get(url, headers={**headers, "If-None-Match": etag})
+    return etag, again
+
+def test_unchanged_server_answers_304(client, make_user):
+    owner = make_user("etag")
+    server = client.post("/servers/", json={"name": "etag"}, headers=owner.headers).json()
+    url = f"/servers/{server['id']}"
+
+    not_modified = response_cache.stats["not_modified"]
+    etag, again = revalidate(client, url, owner.headers)
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["ETag"] == etag
+    assert response_cache.stats["not_modified"] == not_modified + 1
+
+    # Weak and listed validators match too
+    weak = client.get(url, headers={**owner.headers, "If-None-Match": f'"other", W/{etag}'})
+    assert weak.status_code == 304
+
+def test_cached_body_is_served_from_the_cache(client, make_user):
+    owner = make_user("hit")
+    server = client.post("/servers/", json={"name": "hit"}, headers=owner.headers).json()
+    url = f"/servers/{server['id']}"
+
+    first = client.get(url, headers=owner.headers)
+    hits = response_cache.stats["hits"]
+    second = client.get(url, headers=owner.headers)
+    assert response_cache.stats["hits"] == hits + 1
+    assert second.json() == first.json()
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+def test_server_update_changes_etag(client, make_user):
+    owner = make_user("server")
+    server = client.post("/servers/", json={"name": "before"}, headers=owner.headers).json()
+    url = f"/servers/{server['id']}"
+    etag, _ = revalidate(client, url, owner.headers)
+
+    assert client.put(url, json={"name": "after"}, headers=owner.headers).status_code == 200
+    response = client.get(url, headers={**owner.headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["name"] == "after"
+    assert response.headers["ETag"] != etag
+
+def test_new_member_changes_server_etag(client, make_user):
+    owner = make_user("owner")
+    member = make_user("member")
+    server = client.post("/servers/", json={"name": "members"}, headers=owner.headers).json()
+    url = f"/servers/{server['id']}"
+    etag, _ = revalidate(client, url, owner.headers)
+
+    assert client.post(f"{url}/members/{member.id}", headers=owner.headers).status_code == 204
+    response = client.get(url, headers={**owner.headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert member.id in response.json()["members"]
+
+def test_channel_writes_change_channel_list_etag(client, make_user, make_channel):
+    owner = make_user("channels")
+    channel = make_channel(owner)
+    url = f"/channels/server/{channel['server_id']}"
+    etag, again = revalidate(client, url, owner.headers)
+    assert again.status_code == 304
+
+    assert client.put(f"/channels/{channel['id']}", json={"name": "renamed"}, headers=owner.headers).status_code == 200
+    response = client.get(url, headers={**owner.headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert [item["name"] for item in response.json()] == ["renamed"]
+    etag = response.headers["ETag"]
+
+    client.post("/channels/", json={"name": "second", "type": "text", "server_id": channel["server_id"]}, headers=owner.headers)
+    response = client.get(url, headers={**owner.headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+def test_profile_update_changes_user_etag(client, make_user):
+    user = make_user("profile")
+    viewer = make_user("viewer")
+    url = f"/users/{user.id}"
+    etag, again = revalidate(client, url, viewer.headers)
+    assert again.status_code == 304
+
+    response = client.put("/users/me", json={"email": f"new_{user.username}@example.com"}, headers=user.headers)
+    assert response.status_code == 200, response.text
+    response = client.get(url, headers={**viewer.headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["email"] == f"new_{user.username}@example.com"
@@ -0,0 +1,102 @@
+"""Resuming a channel: replay from the broker's log, from stored sequence numbers, or resync."""
+import time
+
+from app.database import SessionLocal
+from app.models import Message
+from app.sockets import chat
+from app.sockets.broker import ReplayLog
+from app.sockets.connection_manager import manager
+from app.sockets.frames import Frame
+
+def event(number: int) -> Frame:
+    return Frame(b'{"type":"event","data":%d}' % number)
+
+def test_replay_from_the_log():
+    log = ReplayLog(log_size=4, max_gap=8)
+    seqs = [log.append(1, event(number), message_id=number)[0] for number in range(6)]
+
+    replay = log.replay(1, seqs[3])
+    assert [seq for seq, _ in replay.events] == seqs[4:]
+    assert replay.messages == [] and replay.stored is None
+
+    # Older than the event log: the chat messages in between come as ids
+    replay = log.replay(1, seqs[0])
+    assert [seq for seq, _ in replay.events] == seqs[2:]
+    assert replay.messages == [(seqs[1], 1)]
+
+def test_gap_too_large_needs_resync():
+    log = ReplayLog(log_size=4, max_gap=2)
+    seqs = [log.append(1, event(number), message_id=number)[0] for number in range(6)]
+    assert log.replay(1, seqs[0]) is None
+    # A sequence number the channel never reached
+    assert log.replay(1, seqs[-1] + 1) is None
+
+def test_gap_before_the_log_is_stored():
+    log = ReplayLog()
+    assert log.replay(1, 5).stored == (5, None)
+
+    seq, _ = log.append(1, event(1), message_id=1)
+    replay = log.replay(1, 5)
+    assert replay.stored == (5, seq - 1)
+    assert [logged for logged, _ in replay.events] == [seq]
+
+def receive_until(websocket, content: str) -> list:
+    # chat_message events up to and including the one with this content
+    events = []
+    while True:
+        message = websocket.receive_json()
+        if message["type"] in ("chat_message", "resync_required"):
+            events.append(message)
+        if message["type"] == "resync_required" or message["data"].get("content") == content:
+            return events
+
+def post(websocket, content: str) -> dict:
+    websocket.send_json({"type": "chat_message", "data": {"content": content}})
+    return receive_until(websocket, content)[-1]
+
+def stored_seqs(message_ids) -> dict:
+    db = SessionLocal()
+    try:
+        return {message.id: message.seq for message in db.query(Message).filter(Message.id.in_(message_ids))}
+    finally:
+        db.close()
+
+def post_and_lose_the_log(client, user, channel_id: int):
+    with client.websocket_connect(f"/ws/chat/{channel_id}?token={user.token}") as websocket:
+        events = [post(websocket, f"before {number}") for number in range(3)]
+        ids = [event["data"]["id"] for event in events]
+        deadline = time.monotonic() + 5
+        while stored_seqs(ids) != {event["data"]["id"]: event["seq"] for event in events}:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        # As after a broker restart or a log eviction
+        del manager.broker.hub.log.channels[channel_id]
+        events.append(post(websocket, "after"))
+    return events
+
+def test_resume_across_a_lost_log(client, make_user, make_channel):
+    user = make_user("resume")
+    channel = make_channel(user)
+    events = post_and_lose_the_log(client, user, channel["id"])
+
+    url = f"/ws/chat/{channel['id']}?token={user.token}&since={events[0]['seq']}"
+    with client.websocket_connect(url) as websocket:
+        websocket.send_json({"type": "chat_message", "data": {"content": "live"}})
+        replayed = receive_until(websocket, "live")
+
+    assert [event["data"]["content"] for event in replayed] == ["before 1", "before 2", "after", "live"]
+    assert [event["seq"] for event in replayed[:3]] == [event["seq"] for event in events[1:]]
+
+def test_resume_across_a_lost_log_with_too_large_a_gap(client, make_user, make_channel, monkeypatch):
+    user = make_user("resync")
+    channel = make_channel(user)
+    events = post_and_lose_the_log(client, user, channel["id"])
+    monkeypatch.setattr(chat, "RESUME_MAX_GAP", 1)
+
+    url = f"/ws/chat/{channel['id']}?token={user.token}&since={events[0]['seq']}"
+    with client.websocket_connect(url) as websocket:
+        replayed = receive_until(websocket, "never")
+
+    assert replayed[-1]["type"] == "resync_required"
+    assert replayed[-1]["data"]["since"] == events[0]["seq"]
@@ -0,0 +1,112 @@
+"""Message search: the SQLite FTS5 index through the route, the PostgreSQL tsvector index directly."""
+import asyncio
+import os
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.database import Base, get_async_database_url
+from app.models import Channel, Message, Server, User
+from app.utils.search import SearchIndex
+
+# A PostgreSQL database the test may fill and empty again, e.g. postgresql://localhost/ankachat_test
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+def post_messages(client, user, channel_id: int, contents) -> list:
+    with client.websocket_connect(f"/ws/chat/{channel_id}?token={user.token}") as websocket:
+        ids = []
+        for content in contents:
+            websocket.send_json({"type": "chat_message", "data": {"content": content}})
+            while True:
+                event = websocket.receive_json()
+                if event["type"] == "chat_message" and event["data"]["content"] == content:
+                    ids.append(event["data"]["id"])
+                    break
+    return ids
+
+def test_search_pages_newest_first(client, make_user, make_channel):
+    user = make_user("search")
+    channel = make_channel(user)
+    word = f"w{uuid.uuid4().hex[:8]}"
+    ids = post_messages(client, user, channel["id"], [f"{word} number {number}" for number in range(5)] + ["unrelated"])
+
+    params = {"q": word, "channel_id": channel["id"], "limit": 3}
+    first = client.get("/messages/search", params=params, headers=user.headers)
+    assert first.status_code == 200
+    assert [result["id"] for result in first.json()] == ids[4:1:-1]
+    assert f"<mark>{word}</mark>" in first.json()[0]["snippet"]
+
+    second = client.get("/messages/search", params={**params, "before_id": ids[2]}, headers=user.headers)
+    assert [result["id"] for result in second.json()] == ids[1::-1]
+
+@pytest.mark.parametrize("limit", [0, -1, 101])
+def test_search_limit_is_bounded(client, make_user, make_channel, limit):
+    user = make_user("search")
+    channel = make_channel(user)
+    response = client.get(
+        "/messages/search", params={"q": "hello", "channel_id": channel["id"], "limit": limit}, headers=user.headers
+    )
+    assert response.status_code == 422
+
+@pytest.mark.parametrize("params", [{"limit": 0}, {"limit": 101}, {"offset": -1}])
+def test_history_paging_is_bounded(client, make_user, make_channel, params):
+    user = make_user("history")
+    channel = make_channel(user)
+    response = client.get(f"/messages/channel/{channel['id']}", params=params, headers=user.headers)
+    assert response.status_code == 422
+
+@pytest.mark.skipif(not TEST_POSTGRES_URL, reason="TEST_POSTGRES_URL is not set")
+def test_tsvector_search():
+    pytest.importorskip("psycopg2")
+    pytest.importorskip("asyncpg")
+    engine = create_engine(TEST_POSTGRES_URL)
+    Base.metadata.create_all(engine)
+    index = SearchIndex("postgresql")
+    index.create(engine)
+    assert index.ready
+
+    try:
+        with engine.begin() as connection:
+            user_id = connection.execute(
+                User.__table__.insert().values(username="pg", email="pg@example.com", hashed_password="x")
+                .returning(User.__table__.c.id)
+            ).scalar()
+            server_id = connection.execute(
+                Server.__table__.insert().values(name="pg", owner_id=user_id).returning(Server.__table__.c.id)
+            ).scalar()
+            channel_id = connection.execute(
+                Channel.__table__.insert().values(name="pg", type="text", server_id=server_id)
+                .returning(Channel.__table__.c.id)
+            ).scalar()
+            ids = [
+                connection.execute(
+                    Message.__table__.insert().values(content=content, user_id=user_id, channel_id=channel_id)
+                    .returning(Message.__table__.c.id)
+                ).scalar()
+                for content in ["quick brown fox", "lazy dog", "the fox jumps"]
+            ]
+            connection.execute(text(index.backend.insert), [
+                {"id": message_id, "content": content, "channel_id": channel_id}
+                for message_id, content in zip(ids, ["quick brown fox", "lazy dog", "the fox jumps"])
+            ])
+
+        async def search(query: str, **kwargs):
+            async_engine = create_async_engine(get_async_database_url(TEST_POSTGRES_URL))
+            try:
+                async with AsyncSession(async_engine) as db:
+                    return await index.search(db, index.parse(query), channel_ids=[channel_id], **kwargs)
+            finally:
+                await async_engine.dispose()
+
+        rows = asyncio.run(search("fox"))
+        assert [row.id for row in rows] == [ids[2], ids[0]]
+        assert "fox" in rows[0].snippet
+        assert [row.id for row in asyncio.run(search("fox", before_id=ids[2]))] == [ids[0]]
+        assert [row.id for row in asyncio.run(search('"brown fox" -lazy'))] == [ids[0]]
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS message_search"))
+        Base.metadata.drop_all(engine)
+        engine.dispose()
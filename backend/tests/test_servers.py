@@ -0,0 +1,75 @@
+"""Server membership: duplicate adds are refused by the table, not the cache."""
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import IntegrityError
+import pytest
+
+from app.database import Base, SessionLocal, create_indexes
+from app.models import server_members
+from app.utils.membership import membership
+
+def member_rows(server_id: int, user_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(func.count()).select_from(server_members).where(
+                server_members.c.server_id == server_id,
+                server_members.c.user_id == user_id
+            )
+        ).scalar()
+    finally:
+        db.close()
+
+def test_add_member_twice_is_refused_with_a_stale_cache(client, make_user, make_channel, monkeypatch):
+    owner, member = make_user("owner"), make_user("member")
+    server_id = make_channel(owner)["server_id"]
+
+    assert client.post(f"/servers/{server_id}/members/{member.id}", headers=owner.headers).status_code == 204
+    # A cached "not a member" must not let the same user in twice
+    monkeypatch.setattr(membership, "is_member_sync", lambda db, server_id, user_id: False)
+    response = client.post(f"/servers/{server_id}/members/{member.id}", headers=owner.headers)
+    assert response.status_code == 400
+    assert member_rows(server_id, member.id) == 1
+
+def test_batch_add_skips_existing_members(client, make_user, make_channel):
+    owner, member, newcomer = make_user("owner"), make_user("member"), make_user("newcomer")
+    server_id = make_channel(owner)["server_id"]
+    client.post(f"/servers/{server_id}/members/{member.id}", headers=owner.headers)
+
+    response = client.post(
+        f"/servers/{server_id}/members", json={"user_ids": [member.id, newcomer.id]}, headers=owner.headers
+    )
+    assert response.json()["added"] == [newcomer.id]
+    assert response.json()["already_members"] == [member.id]
+    assert member_rows(server_id, member.id) == 1
+
+def test_unique_index_is_added_to_an_existing_table(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    Base.metadata.create_all(engine, tables=[table for table in Base.metadata.sorted_tables if table.name != "server_members"])
+    with engine.begin() as connection:
+        # The table as older releases created it, with a duplicate membership
+        connection.exec_driver_sql("CREATE TABLE server_members (user_id INTEGER, server_id INTEGER)")
+        connection.exec_driver_sql("INSERT INTO server_members VALUES (1, 1), (1, 1), (2, 1), (1, 2)")
+
+    create_indexes(engine)
+    create_indexes(engine)
+
+    with engine.begin() as connection:
+        rows = connection.exec_driver_sql("SELECT user_id, server_id FROM server_members ORDER BY 2, 1").all()
+        assert rows == [(1, 1), (2, 1), (1, 2)]
+        unique = connection.exec_driver_sql(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = 'server_members'"
+        ).scalar()
+        assert unique == 1
+    with pytest.raises(IntegrityError):
+        with engine.begin() as connection:
+            connection.exec_driver_sql("INSERT INTO server_members VALUES (2, 1)")
+
+def test_new_tables_get_no_extra_index(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/fresh.db")
+    Base.metadata.create_all(engine)
+    create_indexes(engine)
+    with engine.begin() as connection:
+        names = connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'server_members'"
+        ).scalars().all()
+    assert names == ["sqlite_autoindex_server_members_1"]
@@ -0,0 +1,39 @@
+"""WebRTC signals are relayed with server-set sender, channel and sequence fields."""
+import json
+
+def receive_signal(websocket):
+    # The event, plus its top-level keys as sent so a duplicated key shows up
+    while True:
+        text = websocket.receive_text()
+        event = json.loads(text)
+        if event["type"] == "offer":
+            keys = [key for key, _ in json.loads(text, object_pairs_hook=lambda pairs: pairs)]
+            return event, keys
+
+def test_client_cannot_spoof_signal_fields(client, make_user, make_channel):
+    alice, bob = make_user("alice"), make_user("bob")
+    channel = make_channel(alice, "voice")
+    response = client.post(f"/servers/{channel['server_id']}/members/{bob.id}", headers=alice.headers)
+    assert response.status_code == 204
+
+    with client.websocket_connect(f"/ws/voice/{channel['id']}?token={alice.token}") as sender, \
+            client.websocket_connect(f"/ws/voice/{channel['id']}?token={bob.token}") as receiver:
+        sender.receive_json()
+        receiver.receive_json()
+        sender.send_json({
+            "type": "offer",
+            "target": bob.id,
+            "signal": {"type": "offer", "sdp": "v=0"},
+            "from": {"id": bob.id, "username": "mallory"},
+            "seq": 1,
+            "channel_id": 999999,
+            "admin": True
+        })
+        event, keys = receive_signal(receiver)
+
+    assert len(keys) == len(set(keys))
+    assert event["from"] == {"id": alice.id, "username": alice.username}
+    assert event["channel_id"] == channel["id"]
+    assert event["signal"] == {"type": "offer", "sdp": "v=0"}
+    assert "admin" not in event
+    assert event.get("seq") != 1
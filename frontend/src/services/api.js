@@ -58,6 +58,24 @@ export const authService = {
   },
 };
 
+// Session bootstrap: servers, channels, voice participants and the opened channel's first page
+export const bootstrapService = {
+  bootstrap: async (channelId, limit = 50) => {
+    const params = { limit };
+    if (channelId) params.channel_id = channelId;
+    const response = await api.get('/bootstrap', { params });
+    return response.data;
+  },
+};
+
+// User services
+export const userService = {
+  getUsers: async (ids) => {
+    const response = await api.get('/users', { params: { ids: ids.join(',') } });
+    return response.data;
+  },
+};
+
 // Server services
 export const serverService = {
   getServers: async () => {
@@ -80,6 +98,10 @@ export const serverService = {
     const response = await api.delete(`/servers/${id}`);
     return response.data;
   },
+  addMembers: async (id, userIds) => {
+    const response = await api.post(`/servers/${id}/members`, { user_ids: userIds });
+    return response.data;
+  },
 };
 
 // Channel services
@@ -112,6 +134,10 @@ export const messageService = {
     const response = await api.get(`/messages/channel/${channelId}?limit=${limit}&offset=${offset}`);
     return response.data;
   },
+  getMessagesByIds: async (ids) => {
+    const response = await api.get('/messages', { params: { ids: ids.join(',') } });
+    return response.data;
+  },
   createMessage: async (messageData) => {
     const response = await api.post('/messages', messageData);
     return response.data;
@@ -124,6 +150,14 @@ export const messageService = {
     const response = await api.delete(`/messages/${id}`);
     return response.data;
   },
+  searchMessages: async (q, { serverId, channelId, beforeId, limit = 25 } = {}) => {
+    const params = { q, limit };
+    if (serverId) params.server_id = serverId;
+    if (channelId) params.channel_id = channelId;
+    if (beforeId) params.before_id = beforeId;
+    const response = await api.get('/messages/search', { params });
+    return response.data;
+  },
 };
 
 export default api;
@@ -14,6 +14,8 @@ class SocketService {
       onVoiceUsers: () => {},
     };
     this.stream = null;
+    // Voice participants by user id, kept up to date from presence diffs
+    this.voiceUsers = {};
   }
 
   // Connect to text channel WebSocket
@@ -37,11 +39,21 @@ class SocketService {
         case 'chat_message':
           this.callbacks.onMessage(data.data);
           break;
-        case 'user_joined':
-          this.callbacks.onUserJoined(data.data);
+        case 'presence_snapshot':
+          (data.data.users || []).forEach(user => {
+            this.callbacks.onUserJoined({ channel_id: data.data.channel_id, user });
+          });
           break;
-        case 'user_left':
-          this.callbacks.onUserLeft(data.data);
+        case 'presence_update':
+          data.data.added.forEach(user => {
+            this.callbacks.onUserJoined({ channel_id: data.data.channel_id, user });
+          });
+          data.data.removed.forEach(id => {
+            this.callbacks.onUserLeft({ channel_id: data.data.channel_id, user: { id } });
+          });
+          break;
+        case 'presence_count':
+          // Large channel: only the number of online users is sent
           break;
         default:
           console.log('Unknown message type:', data.type);
@@ -78,8 +90,21 @@ class SocketService {
       const data = JSON.parse(event.data);
       
       switch (data.type) {
-        case 'voice_users_update':
-          this.handleVoiceUsersUpdate(data.data);
+        case 'presence_snapshot':
+          this.voiceUsers = {};
+          (data.data.users || []).forEach(user => {
+            this.voiceUsers[user.id] = user;
+          });
+          this.handleVoiceUsersUpdate({ users: Object.values(this.voiceUsers) });
+          break;
+        case 'presence_update':
+          data.data.added.forEach(user => {
+            this.voiceUsers[user.id] = user;
+          });
+          data.data.removed.forEach(id => {
+            delete this.voiceUsers[id];
+          });
+          this.handleVoiceUsersUpdate({ users: Object.values(this.voiceUsers) });
           break;
         case 'offer':
           this.handleOffer(data);
@@ -99,6 +124,7 @@ class SocketService {
       console.log(`Disconnected from voice channel ${channelId}`);
       this.voiceSocket = null;
       this.currentVoiceChannel = null;
+      this.voiceUsers = {};
       this.destroyAllPeers();
     };
 
@@ -262,6 +288,7 @@ class SocketService {
       this.voiceSocket.close();
       this.voiceSocket = null;
       this.currentVoiceChannel = null;
+      this.voiceUsers = {};
       this.destroyAllPeers();
       
       if (this.stream) {